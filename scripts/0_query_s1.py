@@ -100,6 +100,21 @@ parser.add_argument(
     Defaults to 300 meters.
     This is checked forward and backwards.'''
 )
+parser.add_argument(
+    '--baseline_url',
+    type=str,
+    default='https://api.daac.asf.alaska.edu/services/search/baseline',
+    help='''URL of the ASF baseline service used to find matching scenes.
+    Can point to a local stand-in for offline runs and benchmarks.'''
+)
+parser.add_argument(
+    '--geo_search_csv',
+    type=str,
+    default=None,
+    help='''path to a CSV file with the results of a previous ASF geographic
+    search (with a fileID column). When given, the ASF search is skipped
+    and these scenes are used instead.'''
+)
 args = parser.parse_args()
 
 # Input login credentials
@@ -149,6 +164,12 @@ if repo == 'sentinelhub':  # not active currently, seems to only query recent im
     # Convert list of available images to Pandas DataFrame
     products_df = api.to_dataframe(products)
 
+    # Write to CSV file
+    file_name = os.path.join(args.download_folder, tempfile1)
+    products_df.to_csv(file_name, index=False)
+elif args.geo_search_csv is not None:
+    products_df = pd.read_csv(args.geo_search_csv)
+
     # Write to CSV file
     file_name = os.path.join(args.download_folder, tempfile1)
     products_df.to_csv(file_name, index=False)
@@ -178,7 +199,7 @@ geo_ids = geo_prod['fileID'].map(lambda fileID: str.replace(fileID, '-SLC', ''))
 # Loop over geo_ids to get matching scenes with desired temporal and perpendicular baselines
 tempfile2 = 'tmpbaseline.csv'
 for i in range(0, len(geo_ids)):
-    order_url = "https://api.daac.asf.alaska.edu/services/search/baseline?reference="
+    order_url = args.baseline_url + "?reference="
     scene_id = geo_ids[i]
     output_type = "&output=csv"
     url = order_url + scene_id + output_type
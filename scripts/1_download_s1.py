@@ -6,6 +6,8 @@ import asf_search as asf
 from dotenv import load_dotenv
 import os
 import pandas as pd
+import re
+import requests
 
 # Arguments
 parser = argparse.ArgumentParser(
@@ -37,6 +39,15 @@ parser.add_argument(
   help='''path to the CSV file with query results from 0_query_s1.py. 
   Should be located in the specified download_folder.'''
 )
+parser.add_argument(
+  '--orbit_dir',
+  type=str,
+  default=os.path.expanduser('~/.snap/auxdata/Orbits/Sentinel-1'),
+  help='''path to the local orbit store, where precise (POEORB) or, if not
+  available yet, restituted (RESORB) orbit files are prefetched for all the
+  scenes to process. Uses the same layout as SNAP and defaults to SNAP's
+  own orbit directory, so that 2_dem_generation.py can run offline.'''
+)
 args = parser.parse_args()
 
 # Change credentials inside a .env file
@@ -76,3 +87,68 @@ urls = [f"https://datapool.asf.alaska.edu/SLC/SB/{s}.zip" for s in productIDs_do
 asf.download_urls(urls=urls, path=args.download_folder, session=session, processes=4)
 
 print("All images downloaded!")
+
+# Prefetch orbit files
+# Orbit files are organized as <type>/<mission>/<year>/<month>/ both on the
+# server and in the local store, and their names give the validity window:
+# S1A_OPER_AUX_POEORB_OPOD_<production>_V<validity start>_<validity stop>.EOF.zip
+orbit_url = 'https://step.esa.int/auxdata/orbits/Sentinel-1'
+orbit_listings = {}
+
+
+def orbit_validity(orbit_file):
+  validity = orbit_file.split('_V')[1].split('.')[0].split('_')
+  return pd.to_datetime(validity[0]), pd.to_datetime(validity[1])
+
+
+def orbit_month_folders(orbit_type, mission, start):
+  # Precise orbits start the day before the acquisition,
+  # so the previous month may hold the right file
+  months = sorted(set([(start - pd.Timedelta(days=1)).strftime('%Y/%m'), start.strftime('%Y/%m')]))
+  return [f"{orbit_type}/{mission}/{month}" for month in months]
+
+
+def find_orbit(orbit_type, mission, start, stop, local=True):
+  for folder in orbit_month_folders(orbit_type, mission, start):
+    if local:
+      local_folder = os.path.join(args.orbit_dir, folder)
+      files = os.listdir(local_folder) if os.path.exists(local_folder) else []
+    else:
+      if folder not in orbit_listings:
+        response = requests.get(f"{orbit_url}/{folder}/")
+        orbit_listings[folder] = sorted(set(
+          re.findall(r'href="(S1[AB]_OPER_AUX_[A-Z]+_OPOD_[^"/]+\.EOF\.zip)"', response.text)
+        )) if response.ok else []
+      files = orbit_listings[folder]
+    for f in files:
+      if '.EOF' not in f:
+        continue
+      valid_from, valid_to = orbit_validity(f)
+      if valid_from <= start and valid_to >= stop:
+        return folder, f
+  return None, None
+
+
+orbitsFound = 0
+for s in productIDs:
+  mission = s[:3]
+  start = pd.to_datetime(s[17:32])
+  stop = pd.to_datetime(s[33:48])
+  for orbit_type in ['POEORB', 'RESORB']:
+    folder, orbit_file = find_orbit(orbit_type, mission, start, stop, local=True)
+    if orbit_file is None:
+      folder, orbit_file = find_orbit(orbit_type, mission, start, stop, local=False)
+      if orbit_file is None:
+        continue
+      os.makedirs(os.path.join(args.orbit_dir, folder), exist_ok=True)
+      response = requests.get(f"{orbit_url}/{folder}/{orbit_file}")
+      response.raise_for_status()
+      with open(os.path.join(args.orbit_dir, folder, orbit_file), 'wb') as f:
+        f.write(response.content)
+    print(f"{s}: {orbit_type} {orbit_file}")
+    orbitsFound += 1
+    break
+  else:
+    print(f"{s}: no orbit file found, SNAP will need to download it.")
+
+print("Orbit files available for", orbitsFound, "of", len(productIDs), "scenes in", args.orbit_dir)
@@ -2,14 +2,37 @@
 
 # Import modules
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import fcntl
+import geopandas as gpd
 import glob
+import hashlib
+import itertools
 import json
+import math
+import numpy as np
 import os
 import pandas as pd
-from shapely.geometry import shape, GeometryCollection
+import rasterio
+import re
+from rasterio.enums import Resampling
+import rasterio.merge
+import rasterio.shutil
+import rasterio.warp
+from rasterio.windows import Window
+import resource
+from scipy.fftpack import dctn, idctn
+from scipy.ndimage import map_coordinates
+from shapely.geometry import shape, GeometryCollection, Polygon
 from snappy import ProductIO, jpy, GPF
-import stsa
+import shutil
+import sqlite3
 import subprocess
+import sys
+import time
+from xml.etree import ElementTree
+import zipfile
 
 # Arguments
 parser = argparse.ArgumentParser(
@@ -78,8 +101,34 @@ parser.add_argument(
     '--dem',
     type=str,
     default="Copernicus 30m Global DEM",
-    help='''Set DEM for back-geocoding, defaults to
-    Copernicus 30m Global DEM.'''
+    help='''Set DEM for back-geocoding, topographic phase removal,
+    phase to elevation and terrain correction. Either the name of a
+    DEM handled by SNAP or the path to a local GeoTIFF (e.g. a high
+    resolution reference DEM), defaults to Copernicus 30m Global DEM.'''
+)
+parser.add_argument(
+    '--dem_cache_dir',
+    type=str,
+    default=None,
+    help='''relative path (refers to mounted volume) to a directory where
+    one DEM mosaic per AOI is built from the Copernicus 30m tiles, or
+    clipped from the local DEM given in --dem. It covers the bursts
+    intersecting the AOI plus --dem_margin and is reused for all
+    operators and pairs. By default SNAP handles the DEM itself.'''
+)
+parser.add_argument(
+    '--dem_margin',
+    type=float,
+    default=0.05,
+    help='''Margin in degrees added around the bursts when building
+    the DEM mosaic, defaults to 0.05'''
+)
+parser.add_argument(
+    '--dem_ellipsoidal',
+    action='store_true',
+    help='''Set if a local DEM given in --dem has ellipsoidal heights.
+    By default heights are taken as geoid heights and the
+    EGM96 correction is applied, as for the Copernicus DEM.'''
 )
 parser.add_argument(
     '--subset_toggle',
@@ -182,28 +231,339 @@ parser.add_argument(
 parser.add_argument(
     '--snaphu_tiles',
     type=int,
-    default=1,
-    help='''Number of tiles parameter for snaphu export. 
-    (Usually increasing this argument causes problems).
-    Defaults to 1'''
+    default=None,
+    help='''Number of tiles (per row and per column) for snaphu export.
+    By default it is computed from the raster size and the available
+    memory, so that small rasters are unwrapped as 1 tile.'''
 )
 parser.add_argument(
     '--snaphu_tile_overlap_row',
-    type=float,
-    default=200,
+    type=int,
+    default=None,
     help='''If more than one tile is set, what should the overlap
     between tiles be for the rows. Ignored when snaphu_tiles = 1.
-    Defaults to 200'''
+    By default 10%% of the tile height, with a minimum of 200'''
 )
 parser.add_argument(
     '--snaphu_tile_overlap_col',
-    type=float,
-    default=200,
+    type=int,
+    default=None,
     help='''If more than one tile is set, what should the overlap
-    between tiles be for the columns. 
-    Defaults to 200'''
+    between tiles be for the columns. Ignored when snaphu_tiles = 1.
+    By default 10%% of the tile width, with a minimum of 200'''
+)
+parser.add_argument(
+    '--snaphu_nproc',
+    type=int,
+    default=None,
+    help='''Number of tiles snaphu should unwrap in parallel.
+    By default it is computed from the number of tiles, the
+    available cores and the available memory.'''
+)
+parser.add_argument(
+    '--subswath',
+    type=str,
+    default=None,
+    help='''Internal argument used when the AOI intersects several subswaths.
+    Each subswath is then processed by a separate worker that calls this
+    script again with --subswath set (e.g. IW2). Do not set it manually.'''
+)
+parser.add_argument(
+    '--subswath_workers',
+    type=str,
+    default='processes',
+    choices=['processes', 'threads'],
+    help='''How to process several subswaths in parallel: "processes" (default)
+    starts one worker process (and JVM) per subswath, "threads" runs them on
+    threads of this process, sharing its JVM and heap.'''
+)
+parser.add_argument(
+    '--unwrapper',
+    type=str,
+    default='snaphu',
+    choices=['snaphu', 'lsq'],
+    help='''Backend used for phase unwrapping. 
+    snaphu runs the external snaphu binary (default).
+    lsq runs a least-squares unwrapper with NumPy/SciPy inside this process,
+    useful for small AOIs and quick-look runs.'''
+)
+parser.add_argument(
+    '--unwrap_benchmark',
+    action='store_true',
+    help='''Run all unwrapping backends, record their run time and
+    difference to the selected backend in unwrap_benchmark.json.
+    The result of --unwrapper is used for the next steps.'''
+)
+parser.add_argument(
+    '--geocoding_cache',
+    type=str,
+    default=None,
+    help='''relative path (refers to mounted volume) to a directory where
+    geocoding lookup tables are stored. When set, the first pair processed
+    on a track and AOI stores the SAR to map geometry, and later pairs with
+    the same geometry are resampled with it instead of running SNAP
+    Terrain-Correction. Disabled by default.'''
+)
+parser.add_argument(
+    '--geocoding_cache_tolerance',
+    type=float,
+    default=5,
+    help='''Maximum shift in meters between the corners of a product and
+    those of a stored lookup table for the table to be reused.
+    Defaults to 5'''
+)
+parser.add_argument(
+    '--coherence_thresholds',
+    type=float,
+    nargs='*',
+    default=[0.3],
+    help='''Coherence thresholds (between 0 and 1) used to mask the final
+    elevation. One elevation GeoTIFF is written per threshold, keeping only
+    pixels with coherence >= threshold. Several values can be given,
+    e.g. --coherence_thresholds 0.3 0.5 0.7. Defaults to 0.3.
+    Pass the flag without values to skip masking.'''
+)
+parser.add_argument(
+    '--output_format',
+    type=str,
+    default='GeoTIFF',
+    choices=['GeoTIFF', 'COG'],
+    help='''Format of the final elevation, coherence and phase rasters.
+    GeoTIFF (default) keeps the plain GeoTIFF written by SNAP.
+    COG writes Cloud-Optimized GeoTIFFs with internal tiling,
+    compression and overviews.'''
+)
+parser.add_argument(
+    '--cog_compress',
+    type=str,
+    default='DEFLATE',
+    choices=['DEFLATE', 'ZSTD', 'LZW'],
+    help='''Compression for COG output, defaults to DEFLATE.
+    A floating point predictor is always used.'''
+)
+parser.add_argument(
+    '--cog_blocksize',
+    type=int,
+    default=512,
+    help='''Internal tile size for COG output, defaults to 512'''
+)
+parser.add_argument(
+    '--orbit_dir',
+    type=str,
+    default=os.path.expanduser('~/.snap/auxdata/Orbits/Sentinel-1'),
+    help='''path to the local orbit store prefetched by 1_download_s1.py.
+    SNAP is pointed to this directory and the orbit type (precise or
+    restituted) is chosen per scene from the files available in it.
+    Defaults to SNAP's own orbit directory.'''
+)
+parser.add_argument(
+    '--orbit_offline',
+    action='store_true',
+    help='''Fail if a scene has no orbit file in the local orbit store,
+    instead of letting SNAP download it.'''
+)
+parser.add_argument(
+    '--burst_index',
+    type=str,
+    default=None,
+    help='''path to the GeoPackage where burst footprints are stored.
+    Each scene is parsed only once and later lookups use the spatial index.
+    Defaults to burst_index.gpkg in the download_dir'''
+)
+parser.add_argument(
+    '--build_burst_index',
+    action='store_true',
+    help='''Only add all scenes with Download=True in the query_result
+    to the burst index and exit, without processing any pair.'''
+)
+parser.add_argument(
+    '--max_memory',
+    type=float,
+    default=None,
+    help='''Memory in GB this run may use. The JVM heap and SNAP tile cache
+    are sized from the number of bursts, the AOI size and the multilook
+    factor within this limit. Defaults to the memory available now.'''
+)
+parser.add_argument(
+    '--ignore_memory_check',
+    action='store_true',
+    help='''Run even if the estimated memory does not fit in --max_memory'''
+)
+parser.add_argument(
+    '--stack',
+    action='store_true',
+    help='''Time-series stack mode. All scenes with Download=True of the same
+    orbit and pass as this pair are coregistered once to a common master
+    (one Back-Geocoding/ESD stack, written to stack_<pass>_<orbit>_<polarization>
+    in the output_dir). The interferogram of this pair is then formed from
+    the stack, so the stack is only built by the first pair that needs it.
+    Pairs without the stack master as one of their scenes are processed as
+    single pairs (without the stack).'''
+)
+parser.add_argument(
+    '--stack_master',
+    type=str,
+    default=None,
+    help='''Date (YYYYMMDD) of the stack master in stack mode. Defaults to
+    the scene in the middle of the time series.'''
+)
+parser.add_argument(
+    '--host_scheduler',
+    type=str,
+    default=None,
+    help='''Path to a ledger file shared by all runs on this host, e.g.
+    /tmp/slidem_host.json. Each pipeline then gets a set of cores and memory
+    from the host budget (host_cpus, host_memory) before it starts, and waits
+    while the budget is taken by other runs. SNAP threads, snaphu processors
+    and the CPU affinity of the run are set to the cores it got.'''
+)
+parser.add_argument(
+    '--host_cpus',
+    type=int,
+    default=None,
+    help='''Number of cores of the host budget, defaults to all cores'''
+)
+parser.add_argument(
+    '--host_memory',
+    type=float,
+    default=None,
+    help='''Memory in GB of the host budget, defaults to the memory of the host'''
+)
+parser.add_argument(
+    '--stage_cpus',
+    type=int,
+    default=None,
+    help='''Number of cores for each pipeline with host_scheduler,
+    defaults to a quarter of host_cpus'''
+)
+parser.add_argument(
+    '--safe_cache_dir',
+    type=str,
+    default=None,
+    help='''Directory on fast local storage (e.g. tmpfs or NVMe) to extract scenes
+    into. Only the manifest, support files and the annotation and measurement
+    files of the subswaths and polarization intersecting the AOI are extracted,
+    once per scene, and SNAP reads them from there instead of from the .zip.
+    By default scenes are read from the .zip.'''
+)
+parser.add_argument(
+    '--safe_cache_quota',
+    type=float,
+    default=50,
+    help='''Size in GB the SAFE cache may take. The least recently used scenes
+    are removed to stay below it. Defaults to 50'''
+)
+parser.add_argument(
+    '--dry_run',
+    action='store_true',
+    help='''Do not process anything, but estimate runtime per pipeline, peak
+    memory and disk footprint of every pair with Download=True and of the
+    whole batch, with the options given. Estimates are calibrated with the
+    metrics.json of pairs processed before in the output_dir.
+    Written to dry_run.csv in the output_dir.'''
+)
+parser.add_argument(
+    '--quicklook',
+    action='store_true',
+    help='''Screen the pair before processing it. A quick look of the coherence
+    over the AOI is computed (only the AOI bursts, without ESD, subset after
+    deburst, heavily multilooked and not unwrapped) and its statistics are
+    written to quicklook.json. The pair is only processed further if enough
+    of the AOI is coherent (see quicklook_min_valid).'''
+)
+parser.add_argument(
+    '--quicklook_only',
+    action='store_true',
+    help='''Stop after the quick look, e.g. to screen all pairs of a query result'''
+)
+parser.add_argument(
+    '--quicklook_multilook',
+    type=int,
+    default=20,
+    help='''Number of range looks for the quick look, defaults to 20'''
+)
+parser.add_argument(
+    '--quicklook_min_valid',
+    type=float,
+    default=0.5,
+    help='''Fraction of the AOI that must have a coherence of at least the first
+    of the coherence_thresholds for the pair to pass the quick look,
+    defaults to 0.5'''
+)
+parser.add_argument(
+    '--retention',
+    type=str,
+    default='all',
+    choices=['all', 'compressed', 'final'],
+    help='''What to keep of the intermediate products (out_P1, out_P2, the snaphu
+    export and out_P4) once the pair is complete: "all" (default), "compressed"
+    (each product zipped) or "final" (only the GeoTIFFs, logs and reports).
+    Stacks of the stack mode are kept, since other pairs use them.'''
+)
+parser.add_argument(
+    '--min_free_disk',
+    type=float,
+    default=None,
+    help='''Free disk space in GB that must be left on the output volume to start
+    a pair. Below it, the pair waits for space to be freed (see
+    --min_free_disk_timeout), x_dem_queue.py workers wait before claiming pairs.'''
+)
+parser.add_argument(
+    '--min_free_disk_timeout',
+    type=float,
+    default=None,
+    help='''Seconds a pair waits for --min_free_disk to be free on the output
+    volume before failing. Waits without limit by default.'''
+)
+parser.add_argument(
+    '--early_subset',
+    action='store_true',
+    help='''Subset to the AOI (plus aoi_buffer and early_subset_margin) right
+    after deburst, so that topographic phase removal, multilooking, filtering
+    and the out_P2 product only cover the AOI. SNAP then also only forms the
+    interferogram for the bursts and lines needed for it.'''
+)
+parser.add_argument(
+    '--early_subset_margin',
+    type=float,
+    default=0.01,
+    help='''Margin in degrees added around the AOI for the early subset, so
+    that filter windows and unwrapping have context at the edges of the AOI.
+    Defaults to 0.01 (about 1 km)'''
+)
+parser.add_argument(
+    '--sweep',
+    type=str,
+    default=None,
+    help='''Path to a JSON file with a grid of P2-P4 parameters to compare,
+    e.g. {"multilook_range": [4, 6], "gpf_fftsize": [32, 64]}. P1 is run once,
+    then every combination is processed from its out_P1 product into
+    out_<dates>/sweep/<variant>, and a comparison of coherence and valid
+    pixels is written to sweep_comparison.csv in out_<dates>.'''
+)
+parser.add_argument(
+    '--sweep_workers',
+    type=int,
+    default=None,
+    help='''Number of sweep variants processed at the same time. Defaults to
+    what fits into the cores and the memory of the resource plan.'''
+)
+parser.add_argument(
+    '--variant',
+    type=str,
+    default=None,
+    help='''Internal argument used in sweep mode. Each variant is processed
+    by a worker that calls this script again with --variant set, reusing
+    the P1 output of the pair. Do not set it manually.'''
 )
 args = parser.parse_args()
+if args.burst_index is None:
+    args.burst_index = os.path.join(args.download_dir, 'burst_index.gpkg')
+
+# Keep track of how this script was called, so that subswath
+# workers can be launched in the same way
+script_path = os.path.abspath(__file__)
+launch_dir = os.getcwd()
 
 # Set home as current directory
 os.chdir('home/')
@@ -227,8 +587,20 @@ else:
     file_path_2 = os.path.join(args.download_dir, productsIn.iloc[args.pair_index]['ReferenceID'] + '.zip')
 
 # Hashmap is used to give us access to all JAVA operators
+# Every operator call gets its own HashMap (see create_product)
 HashMap = jpy.get_type('java.util.HashMap')
-parameters = HashMap()
+
+# Point SNAP to the local orbit store
+# Apply-Orbit-File looks for (and downloads) Sentinel-1 orbits in the
+# directories of the OrbitFiles.* keys of the snap.auxdata settings.
+# Settings are loaded first, so that loading them does not reset the keys.
+args.orbit_dir = os.path.abspath(args.orbit_dir)
+jpy.get_type('org.esa.snap.engine_utilities.util.Settings').instance()
+Config = jpy.get_type('org.esa.snap.runtime.Config')
+Config.instance('snap.auxdata').preferences().put(
+    'OrbitFiles.sentinel1POEOrbitPath', os.path.join(args.orbit_dir, 'POEORB'))
+Config.instance('snap.auxdata').preferences().put(
+    'OrbitFiles.sentinel1RESOrbitPath', os.path.join(args.orbit_dir, 'RESORB'))
 
 # Create output_dir if not existing
 if not os.path.exists(args.output_dir):
@@ -247,8 +619,12 @@ mat_date_str = pd.to_datetime(
     ).strftime('%Y%m%d')
 date_bundle = ref_date_str + '_' + mat_date_str
 output_dir = os.path.join(args.output_dir, 'out_' + date_bundle)
+# Sweep variants reuse P1 of the pair and write to their own directory
+p1_dir = output_dir
+if args.variant is not None:
+    output_dir = os.path.join(p1_dir, 'sweep', args.variant)
 if not os.path.exists(output_dir):
-    os.mkdir(output_dir)
+    os.makedirs(output_dir)
 
 # Get some metadata from the CSV file:
 ref_date = productsIn.iloc[args.pair_index]['ReferenceDate']
@@ -256,6 +632,82 @@ mat_date = productsIn.iloc[args.pair_index]['MatchDate']
 passf = productsIn.iloc[args.pair_index]['Pass']
 orbit = productsIn.iloc[args.pair_index]['Orbit']
 
+# Performance metrics
+# Wall time, CPU time (incl. subprocesses like snaphu), peak RSS, JVM heap,
+# bytes read and written and output sizes are recorded for each pipeline
+# (stage), each SNAP operator initialization (operator) and each product
+# written to disk (write), where SNAP does the actual computation.
+# They are saved to metrics.json and metrics_summary.txt in the output dir.
+metrics = dict(pair=date_bundle, subswath=args.subswath, records=[])
+Runtime = jpy.get_type('java.lang.Runtime')
+
+
+def resource_snapshot():
+    io = {}
+    if os.path.exists('/proc/self/io'):
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                io[key] = int(value)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    runtime = Runtime.getRuntime()
+    return dict(
+        time=time.time(),
+        cpu=self_usage.ru_utime + self_usage.ru_stime +
+        children_usage.ru_utime + children_usage.ru_stime,
+        # ru_maxrss is given in kB on Linux
+        peak_rss_mb=max(self_usage.ru_maxrss, children_usage.ru_maxrss) / 1024,
+        heap_mb=(runtime.totalMemory() - runtime.freeMemory()) / 1024 ** 2,
+        read_bytes=io.get('read_bytes', 0) + children_usage.ru_inblock * 512,
+        write_bytes=io.get('write_bytes', 0) + children_usage.ru_oublock * 512
+    )
+
+
+def path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+@contextlib.contextmanager
+def measure(name, kind='stage'):
+    start = resource_snapshot()
+    record = dict(name=name, kind=kind)
+    try:
+        yield record
+    finally:
+        end = resource_snapshot()
+        record.update(
+            wall_seconds=round(end['time'] - start['time'], 3),
+            cpu_seconds=round(end['cpu'] - start['cpu'], 3),
+            peak_rss_mb=round(end['peak_rss_mb'], 1),
+            jvm_heap_used_mb=round(max(start['heap_mb'], end['heap_mb']), 1),
+            read_mb=round((end['read_bytes'] - start['read_bytes']) / 1024 ** 2, 1),
+            written_mb=round((end['write_bytes'] - start['write_bytes']) / 1024 ** 2, 1)
+        )
+        metrics['records'].append(record)
+
+
+def write_metrics(out_dir):
+    suffix = '_' + args.subswath if args.subswath else ''
+    with open(os.path.join(out_dir, 'metrics' + suffix + '.json'), 'w') as f:
+        json.dump(metrics, f, indent=2)
+    columns = ['wall_seconds', 'cpu_seconds', 'peak_rss_mb', 'jvm_heap_used_mb',
+               'read_mb', 'written_mb', 'output_mb']
+    with open(os.path.join(out_dir, 'metrics_summary' + suffix + '.txt'), 'w') as f:
+        f.write('Performance metrics for pair ' + date_bundle + suffix + '\n\n')
+        f.write('%-10s %-32s' % ('kind', 'name') +
+                ''.join('%18s' % column for column in columns) + '\n')
+        for record in metrics['records']:
+            f.write('%-10s %-32s' % (record['kind'], record['name'][:32]) +
+                    ''.join('%18s' % record.get(column, '') for column in columns) + '\n')
+
+
 # Functions:
 # From this section I define a set of functions that are called
 # within a pipeline at the end of the script. Each function will start with a
@@ -273,81 +725,426 @@ def read_aoi(aoi, buffer):
     )
 
 
+# [P1] Function to read the burst footprints of a scene
+# Parses the annotation XML of each subswath and polarization directly
+# from the .zip. Burst polygons are built from the geolocation grid lines
+# closest to the first and last line of each burst.
+def read_burst_footprints(filename):
+    scene_id = os.path.basename(filename).replace('.zip', '')
+    bursts = []
+    with zipfile.ZipFile(filename) as zf:
+        for name in zf.namelist():
+            parts = name.split('/')
+            if len(parts) < 3 or parts[-2] != 'annotation' or not name.endswith('.xml'):
+                continue
+            # Annotation files are named like s1a-iw1-slc-vv-<start>-<stop>-...xml
+            swath, polar = os.path.basename(name).split('-')[1:4:2]
+            root = ElementTree.fromstring(zf.read(name))
+            lines_per_burst = int(root.find('swathTiming/linesPerBurst').text)
+            n_bursts = len(root.findall('swathTiming/burstList/burst'))
+            grid = {}
+            for point in root.findall('geolocationGrid/geolocationGridPointList/geolocationGridPoint'):
+                grid.setdefault(int(point.find('line').text), []).append((
+                    int(point.find('pixel').text),
+                    float(point.find('longitude').text),
+                    float(point.find('latitude').text)
+                ))
+            lines = sorted(grid)
+            for burst in range(n_bursts):
+                first = min(lines, key=lambda line: abs(line - burst * lines_per_burst))
+                last = min(lines, key=lambda line: abs(line - (burst + 1) * lines_per_burst))
+                top = [(lon, lat) for _, lon, lat in sorted(grid[first])]
+                bottom = [(lon, lat) for _, lon, lat in sorted(grid[last], reverse=True)]
+                bursts.append(dict(
+                    scene=scene_id,
+                    subswath=swath.upper(),
+                    burst=burst + 1,
+                    polarization=polar.upper(),
+                    geometry=Polygon(top + bottom)
+                ))
+    return bursts
+
+
+# [P1] Function to add a scene to the burst index
+# The index is a GeoPackage, so burst polygons get an R-tree spatial index.
+# Checking for the scene and adding it hold a lock on <index>.lock, so
+# that concurrent processes neither add a scene twice nor write at once.
+def index_scene(filename, index=args.burst_index):
+    scene_id = os.path.basename(filename).replace('.zip', '')
+    with open(index + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(index):
+            con = sqlite3.connect(index)
+            found = con.execute('SELECT COUNT(*) FROM bursts WHERE scene = ?', (scene_id,)).fetchone()[0]
+            con.close()
+            if found:
+                return
+            mode = 'a'
+        else:
+            mode = 'w'
+        print('Adding ' + scene_id + ' to burst index...')
+        bursts = gpd.GeoDataFrame(read_burst_footprints(filename), crs='EPSG:4326')
+        bursts.to_file(index, layer='bursts', driver='GPKG', mode=mode)
+
+
 # [P1] Function to get subswaths and bursts
-def get_swath_burst(filename, aoi, polar=args.polarization):
+def get_swath_burst(filename, aoi, polar=args.polarization, index=args.burst_index):
     print('Extracting subswath and bursts for AOI...')
     aoi_geom = read_aoi(aoi, buffer=args.aoi_buffer)
-
-    # Apply Top Split Analyzer to S1 file with stsa
-    # Initialize object
-    img = stsa.TopsSplitAnalyzer(
-        target_subswaths=['iw1', 'iw2', 'iw3'],
-        polarization=polar.lower()
-    )
-    # Load zip file
-    img.load_data(zip_path=filename)
-    #  Create geodataframe with subswaths, bursts and geoms
-    #  Calling an internal method to avoid writing to json and reloading
-    img._create_subswath_geometry()
-    img_df = img.df
-
-    # Intersect geodataframe with aoi
-    img_df = img_df[img_df.intersects(aoi_geom)]
-
-    # Return intersecting subswaths and bursts as a dictionary
+    scene_id = os.path.basename(filename).replace('.zip', '')
+    index_scene(filename, index)
+
+    # Query bursts within the AOI bounding box through the
+    # spatial index and intersect them with the AOI
+    with open(index + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        img_df = gpd.read_file(index, layer='bursts', bbox=aoi_geom.bounds)
+    img_df = img_df[(img_df['scene'] == scene_id) &
+                    (img_df['polarization'] == polar.upper())]
+    img_df = img_df[img_df.intersects(aoi_geom)].sort_values(['subswath', 'burst'])
+
+    # Return intersecting subswaths, bursts and their bounds as a dictionary
     return dict(
         subswath=img_df['subswath'].tolist(),
-        burst=img_df['burst'].tolist()
+        burst=img_df['burst'].tolist(),
+        bounds=tuple(img_df.total_bounds)
     )
 
 
+# [P1|P2|P4] Function to build or reuse the DEM mosaic of a site
+# The mosaic is written once per AOI as a tiled GeoTIFF and reused as
+# long as it covers the requested bounds (lon/lat), otherwise it is
+# rebuilt for the union of both. Copernicus 30m tiles are read from the
+# public AWS bucket, local DEMs are clipped in their own CRS.
+# Returns the DEM to give to SNAP operators (see dem_parameters).
+COPERNICUS_DEM = "Copernicus 30m Global DEM"
+COPERNICUS_DEM_URL = "https://copernicus-dem-30m.s3.amazonaws.com/" \
+                     "Copernicus_DSM_COG_10_{0}_00_{1}_00_DEM/Copernicus_DSM_COG_10_{0}_00_{1}_00_DEM.tif"
+DEM_NODATA = -9999
+
+
+def prepare_dem(dem, bounds, cache_dir=args.dem_cache_dir, margin=args.dem_margin):
+    if cache_dir is None:
+        return dem
+    if dem != COPERNICUS_DEM and not os.path.isfile(dem):
+        print('DEM ' + dem + ' is handled by SNAP, no mosaic is built.')
+        return dem
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    source = 'cop30' if dem == COPERNICUS_DEM else os.path.splitext(os.path.basename(dem))[0]
+    site = os.path.splitext(os.path.basename(args.aoi_path))[0]
+    mosaic = os.path.join(cache_dir, site + '_' + source + '.tif')
+    bounds = (bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin)
+    # Other pairs and workers may read or rebuild the mosaic at the same time
+    with open(mosaic + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(mosaic + '.json'):
+            with open(mosaic + '.json') as f:
+                cached = json.load(f)['bounds']
+            if cached[0] <= bounds[0] and cached[1] <= bounds[1] and \
+                    cached[2] >= bounds[2] and cached[3] >= bounds[3]:
+                print('Using DEM mosaic ' + mosaic)
+                return mosaic
+            bounds = (min(cached[0], bounds[0]), min(cached[1], bounds[1]),
+                      max(cached[2], bounds[2]), max(cached[3], bounds[3]))
+
+        print('Building DEM mosaic ' + mosaic + '...')
+        if dem == COPERNICUS_DEM:
+            sources = []
+            for lat in range(int(math.floor(bounds[1])), int(math.floor(bounds[3])) + 1):
+                for lon in range(int(math.floor(bounds[0])), int(math.floor(bounds[2])) + 1):
+                    url = COPERNICUS_DEM_URL.format(
+                        ('N' if lat >= 0 else 'S') + '%02d' % abs(lat),
+                        ('E' if lon >= 0 else 'W') + '%03d' % abs(lon)
+                    )
+                    try:
+                        sources.append(rasterio.open(url))
+                    except rasterio.errors.RasterioIOError:
+                        # No tile over the sea
+                        continue
+            if not sources:
+                raise ValueError("No Copernicus DEM tiles found for " + str(bounds))
+            mosaic_bounds = bounds
+        else:
+            sources = [rasterio.open(dem)]
+            mosaic_bounds = rasterio.warp.transform_bounds('EPSG:4326', sources[0].crs, *bounds)
+        try:
+            array, transform = rasterio.merge.merge(sources, bounds=mosaic_bounds, nodata=DEM_NODATA)
+            profile = dict(
+                driver='GTiff', dtype='float32', count=1,
+                width=array.shape[2], height=array.shape[1],
+                crs=sources[0].crs, transform=transform, nodata=DEM_NODATA,
+                tiled=True, blockxsize=512, blockysize=512,
+                compress='DEFLATE', predictor=3
+            )
+            # Replace the mosaic in one step, readers that still have
+            # the previous one open keep reading it
+            with rasterio.open(mosaic + '.tmp.tif', 'w', **profile) as dst:
+                dst.write(array.astype('float32'))
+            os.replace(mosaic + '.tmp.tif', mosaic)
+        finally:
+            for source in sources:
+                source.close()
+        with open(mosaic + '.json.tmp', 'w') as f:
+            json.dump(dict(dem=dem, bounds=bounds), f)
+        os.replace(mosaic + '.json.tmp', mosaic + '.json')
+    return mosaic
+
+
+# [P1|P2|P4] Function to get the DEM parameters of an operator
+# A DEM given as file is passed to SNAP as external DEM.
+def dem_parameters(dem):
+    if os.path.isfile(dem):
+        File = jpy.get_type('java.io.File')
+        with rasterio.open(dem) as src:
+            nodata = src.nodata if src.nodata is not None else DEM_NODATA
+        return dict(
+            demName="External DEM",
+            externalDEMFile=File(os.path.abspath(dem)),
+            externalDEMNoDataValue=float(nodata),
+            externalDEMApplyEGM=not args.dem_ellipsoidal
+        )
+    return dict(demName=dem)
+
+
+# [P1] Function to extract the needed files of a scene to the SAFE cache
+# Members of the .zip are extracted when their name matches the subswaths
+# and polarization (e.g. s1a-iw2-slc-vv-...), and so are the manifest and
+# the support files. More subswaths are added to a scene when needed.
+# Scenes are locked while extracted and the modification time of their
+# directory marks their last use. Returns the path of manifest.safe.
+def extract_safe(filename, subswaths, polar=args.polarization,
+                 cache_dir=args.safe_cache_dir, quota=args.safe_cache_quota):
+    scene_id = os.path.basename(filename).replace('.zip', '')
+    scene_dir = os.path.join(cache_dir, scene_id)
+    if not os.path.exists(scene_dir):
+        os.makedirs(scene_dir, exist_ok=True)
+    keys = ['-' + IW.lower() + '-slc-' + polar.lower() + '-' for IW in subswaths]
+    with open(os.path.join(cache_dir, scene_id + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with zipfile.ZipFile(filename) as zf:
+            members = [member for member in zf.infolist() if not member.filename.endswith('/') and (
+                       member.filename.endswith('manifest.safe') or '/support/' in member.filename or
+                       any(key in os.path.basename(member.filename) for key in keys))]
+            missing = [member for member in members
+                       if not os.path.exists(os.path.join(scene_dir, member.filename))]
+            if missing:
+                print('Extracting ' + str(len(missing)) + ' files of ' + scene_id + ' to the SAFE cache...')
+                for member in missing:
+                    # Extract to a temporary name so that a crash leaves no partial file
+                    target = os.path.join(scene_dir, member.filename)
+                    if not os.path.exists(os.path.dirname(target)):
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                    with zf.open(member) as src, open(target + '.part', 'wb') as dst:
+                        shutil.copyfileobj(src, dst, 16 * 1024 ** 2)
+                    os.rename(target + '.part', target)
+        os.utime(scene_dir)
+    evict_safe_cache(cache_dir, quota)
+    manifest = glob.glob(os.path.join(scene_dir, '*.SAFE', 'manifest.safe'))
+    if not manifest:
+        raise ValueError("No manifest.safe in " + filename)
+    return manifest[0]
+
+
+# [P1] Function to keep the SAFE cache below its quota
+# Removes the least recently used scenes first. Scenes in use by any
+# process (see use_safe_scene) are skipped, SNAP reads them lazily.
+def evict_safe_cache(cache_dir, quota):
+    with open(os.path.join(cache_dir, 'cache.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        scenes = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+                  if os.path.isdir(os.path.join(cache_dir, name))]
+        sizes = dict((scene, path_size(scene)) for scene in scenes)
+        total = sum(sizes.values())
+        for scene in sorted(scenes, key=os.path.getmtime):
+            if total <= quota * 1024 ** 3:
+                break
+            with open(scene + '.use', 'w') as use:
+                try:
+                    fcntl.flock(use, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                print('Removing ' + os.path.basename(scene) + ' from the SAFE cache...')
+                shutil.rmtree(scene, ignore_errors=True)
+            total -= sizes[scene]
+
+
+# [P1] Function to mark a scene of the SAFE cache as in use
+# A shared lock on <scene>.use is held until the process ends, since
+# products read from the scene may be read from until then.
+safe_scenes_in_use = {}
+
+
+def use_safe_scene(filename, cache_dir=args.safe_cache_dir):
+    scene_id = os.path.basename(filename).replace('.zip', '')
+    if scene_id not in safe_scenes_in_use:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        use = open(os.path.join(cache_dir, scene_id + '.use'), 'w')
+        fcntl.flock(use, fcntl.LOCK_SH)
+        safe_scenes_in_use[scene_id] = use
+
+
 # [P1|P2|P3|P4] Function to read the .zip file into SNAP
+# With a SAFE cache, scenes are read from their extracted files instead.
+# They are marked as in use before extracting, so no eviction removes them.
 def read(filename):
     print('Reading...')
+    if args.safe_cache_dir is not None and filename.endswith('.zip'):
+        subswaths = sorted(set(get_swath_burst(filename, args.aoi_path)['subswath']))
+        use_safe_scene(filename)
+        filename = extract_safe(filename, subswaths)
     return ProductIO.readProduct(filename)
 
 
+# Fixed parameters of the SNAP operators, by operator name.
+# Names are the GPF parameter names (see `gpt <operator> -h`).
+# Settings that depend on the run are given by the operator functions.
+OPERATOR_PARAMETERS = {
+    'Apply-Orbit-File': dict(polyDegree=3, continueOnFail=False),
+    'Back-Geocoding': dict(
+        demResamplingMethod='BILINEAR_INTERPOLATION',
+        resamplingType='BILINEAR_INTERPOLATION',
+        maskOutAreaWithoutElevation=True,
+        outputDerampDemodPhase=True,
+        disableReramp=False
+    ),
+    'Interferogram': dict(
+        subtractFlatEarthPhase=True,
+        srpPolynomialDegree=5,
+        srpNumberOfPoints=501,
+        orbitDegree=3,
+        includeCoherence=True
+    ),
+    'TopoPhaseRemoval': dict(
+        orbitDegree=3,
+        tileExtensionPercent='100',
+        outputTopoPhaseBand=True,
+        outputElevationBand=False
+    ),
+    'Multilook': dict(grSquarePixel=True),
+    'GoldsteinPhaseFiltering': dict(alpha=1.0),
+    'Subset': dict(copyMetadata=True),
+    'SnaphuExport': dict(initMethod='MCF', tileCostThreshold=500),
+    'Terrain-Correction': dict(
+        imgResamplingMethod='BILINEAR_INTERPOLATION',
+        saveSelectedSourceBand=True,
+        nodataValueAtSea=False
+    )
+}
+
+
+# [P1|P2|P3|P4] Function to create a SNAP operator product
+# The parameters are built for each call from OPERATOR_PARAMETERS and the
+# given settings, so that nothing carries over from other operators and
+# operators can be created from several threads. None values are left out
+# to use the operator default. Records how long the operator takes to initialize.
+def create_product(operator, operator_parameters, source):
+    settings = dict(OPERATOR_PARAMETERS.get(operator, {}))
+    settings.update(operator_parameters or {})
+    parameters = HashMap()
+    for name, value in settings.items():
+        if value is not None:
+            parameters.put(name, value)
+    with measure(operator, kind='operator'):
+        return GPF.createProduct(operator, parameters, source)
+
+
+# [P1|P2|P3|P4] Function to write a SNAP product
+# This is where SNAP computes the chain of operators, so the
+# time, memory and size of each written product are recorded
+def write_product(product, filename, format_name, output=None):
+    with measure(os.path.basename(filename), kind='write') as record:
+        ProductIO.writeProduct(product, filename, format_name)
+        output = output or filename
+        record['width'] = product.getSceneRasterWidth()
+        record['height'] = product.getSceneRasterHeight()
+    if os.path.exists(output):
+        size = path_size(output)
+        data_dir = os.path.splitext(output)[0] + '.data'
+        if os.path.isdir(data_dir):
+            size += path_size(data_dir)
+        record['output_mb'] = round(size / 1024 ** 2, 1)
+
+
 # [P1|P2|P3] Function to write SNAP product to GeoTIFF
 def write_TIFF_format(product, filename):
-    ProductIO.writeProduct(product, filename, "GeoTiff")
+    write_product(product, filename, "GeoTiff")
 
 
 # [P1|P2|P3] Function to write SNAP product to BEAM-DIMAP format
 def write_BEAM_DIMAP_format(product, filename):
     print('Saving BEAM-DIMAP format.')
-    ProductIO.writeProduct(product, filename + '.dim', 'BEAM-DIMAP')
+    write_product(product, filename + '.dim', 'BEAM-DIMAP')
 
 
 # [P1] Function to apply TOPSAR split with SNAP
 def topsar_split(product, IW, firstBurstIndex, lastBurstIndex, polar=args.polarization):
     print('Applying TOPSAR Split...')
-    parameters.put('subswath', IW)
-    parameters.put('firstBurstIndex', firstBurstIndex)
-    parameters.put('lastBurstIndex', lastBurstIndex)
-    parameters.put('selectedPolarisations', polar)
-    output = GPF.createProduct("TOPSAR-Split", parameters, product)
+    output = create_product("TOPSAR-Split", dict(
+        subswath=IW,
+        firstBurstIndex=firstBurstIndex,
+        lastBurstIndex=lastBurstIndex,
+        selectedPolarisations=polar
+    ), product)
     return output
 
 
+# [P1] Orbit types of Apply-Orbit-File for Sentinel-1, by folder of the
+# orbit store. Only these values are accepted for Sentinel-1 (see
+# `gpt Apply-Orbit-File -h`): SNAP takes the file from the orbit store
+# when it is there and only downloads it otherwise.
+ORBIT_TYPES = {
+    'POEORB': 'Sentinel Precise (Auto Download)',
+    'RESORB': 'Sentinel Restituted (Auto Download)'
+}
+
+
+# [P1] Function to find the orbit file of a scene in the local orbit store
+# The store has the same layout as SNAP: <type>/<mission>/<year>/<month>/
+# and file names give the validity window of each orbit file:
+# S1A_OPER_AUX_POEORB_OPOD_<production>_V<validity start>_<validity stop>.EOF.zip
+# Returns the SNAP orbit type and the orbit file (for the log), precise
+# orbits first.
+def find_orbit_file(filename, orbit_dir=args.orbit_dir):
+    scene_id = os.path.basename(filename).replace('.zip', '')
+    mission = scene_id[:3]
+    start = pd.to_datetime(scene_id[17:32])
+    stop = pd.to_datetime(scene_id[33:48])
+    # Precise orbits start the day before the acquisition
+    months = set([(start - pd.Timedelta(days=1)).strftime('%Y/%m'), start.strftime('%Y/%m')])
+    for folder in ['POEORB', 'RESORB']:
+        for month in sorted(months):
+            pattern = os.path.join(orbit_dir, folder, mission, month, '*.EOF*')
+            for orbit_file in glob.glob(pattern):
+                validity = os.path.basename(orbit_file).split('_V')[1].split('.')[0].split('_')
+                if pd.to_datetime(validity[0]) <= start and pd.to_datetime(validity[1]) >= stop:
+                    return ORBIT_TYPES[folder], orbit_file
+    if args.orbit_offline:
+        raise ValueError("No orbit file for " + scene_id + " in " + orbit_dir +
+                         ". Run 1_download_s1.py to prefetch it.")
+    return ORBIT_TYPES['POEORB'], None
+
+
 # [P1] Function to apply Orbit file with SNAP
-def apply_orbit_file(product):
-    print('Applying orbit file...')
-    parameters.put("Orbit State Vectors", "Sentinel Precise (Auto Download)")
-    parameters.put("Polynomial Degree", 3)
-    parameters.put("Do not fail if new orbit file is not found", True)
-    return GPF.createProduct("Apply-Orbit-File", parameters, product)
+# The orbit file SNAP applied is read from the metadata of the product
+# and written to log.txt in the log_dir (defaults to the output directory).
+def apply_orbit_file(product, orbit_type=ORBIT_TYPES['POEORB'], log_dir=None):
+    print('Applying orbit file (' + orbit_type + ')...')
+    output = create_product("Apply-Orbit-File", dict(orbitType=orbit_type), product)
+    applied = output.getMetadataRoot().getElement('Abstracted_Metadata') \
+        .getAttributeString('orbit_state_vector_file', 'unknown')
+    print('Orbit file applied: ' + applied)
+    file = open(os.path.join(log_dir or output_dir, 'log.txt'), 'a')
+    file.write('Orbit file applied to ' + product.getName() + ': ' + applied + '\n')
+    file.close()
+    return output
 
 
 # [P1] Function to do back geocoding with SNAP
 def back_geocoding(product, dem):
     print('Back geocoding...')
-    parameters.put("demName", dem)
-    parameters.put("demResamplingMethod", "BILINEAR_INTERPOLATION")
-    parameters.put("resamplingType", "BILINEAR_INTERPOLATION")
-    parameters.put("maskOutAreaWithoutElevation", True)
-    parameters.put("outputDerampDemodPhase", True)
-    parameters.put("disableReramp", False)
-    return GPF.createProduct("Back-Geocoding", parameters, product)
+    return create_product("Back-Geocoding", dem_parameters(dem), product)
 
 
 # [P1] Function to apply Enhanced Spectral Diversity with SNAP
@@ -355,47 +1152,42 @@ def enhanced_spectral_diversity(product):
     print('Applying Enhanced Spectral Diversity...')
     # called with defaults
     # should only be applied if multiple bursts were used in topsar_split
-    return GPF.createProduct("Enhanced-Spectral-Diversity", parameters, product)
+    return create_product("Enhanced-Spectral-Diversity", None, product)
 
 
 # [P1] Function for TOPSAR deburst
-def topsar_deburst(sources):
+def topsar_deburst(sources, polar=args.polarization):
     print('Running TOPSAR deburst...')
-    parameters.put("Polarisations", args.polarization)
-    output = GPF.createProduct("TOPSAR-Deburst", parameters, sources)
+    output = create_product("TOPSAR-Deburst", dict(selectedPolarisations=polar), sources)
     return output
 
 
-# [P1] Function for TOPSAR deburst
-def topsar_merge(source):
+# [P2] Function for TOPSAR merge
+# Used when the AOI intersects multiple subswaths, merges the
+# debursted interferograms of each subswath into one product
+def topsar_merge(sources, polar=args.polarization):
     print('Running TOPSAR merge...')
-    output = GPF.createProduct("TOPSAR-Merge", source)
+    products = jpy.array('org.esa.snap.core.datamodel.Product', len(sources))
+    for i, source in enumerate(sources):
+        products[i] = source
+    output = create_product("TOPSAR-Merge", dict(selectedPolarisations=polar), products)
     return output
 
 
 # [P2] Function to calculate the interferogram
-def interferogram(product, ifg_squarepixel, ifg_cohwin_az, ifg_cohwin_rg):
+def interferogram(product, ifg_squarepixel, ifg_cohwin_rg, ifg_cohwin_az):
     print('Creating interferogram...')
-    parameters.put("Subtract flat-earth phase", True)
-    parameters.put("Degree of \"Flat Earth\" polynomial", 5)
-    parameters.put("Number of \"Flat Earth\" estimation points", 501)
-    parameters.put("Orbit interpolation degree", 3)
-    parameters.put("Include coherence estimation", True)
-    parameters.put("Square Pixel", ifg_squarepixel)
-    parameters.put("Independent Window Sizes", not ifg_squarepixel)
-    parameters.put("Coherence Range Window Size", ifg_cohwin_rg)
-    parameters.put("Coherence Azimuth Window Size", ifg_cohwin_az)
-    return GPF.createProduct("Interferogram", parameters, product)
+    return create_product("Interferogram", dict(
+        squarePixel=ifg_squarepixel,
+        independentWindowSizes=not ifg_squarepixel,
+        cohWinRg=ifg_cohwin_rg,
+        cohWinAz=ifg_cohwin_az
+    ), product)
 
 
 # [P2] Function for topophase removal (optional)
 def topophase_removal(product, dem):
-    parameters.put("Orbit Interpolation Degree", 3)
-    parameters.put("demName", dem)
-    parameters.put("Tile Extension[%]", 100)
-    parameters.put("Output topographic phase band", True)
-    parameters.put("Output elevation band", False)
-    return GPF.createProduct("TopoPhaseRemoval", parameters, product)
+    return create_product("TopoPhaseRemoval", dem_parameters(dem), product)
 
 
 # [P2] Function for multilooking (optional)
@@ -406,9 +1198,8 @@ def topophase_removal(product, dem):
 # https://forum.step.esa.int/t/alterring-spatial-resolution-of-sentinel-1-image/21906/7
 def multilook(product, ML_nRgLooks):
     print('Multi-looking...')
-    parameters.put('grSquarePixel', True)
-    parameters.put("nRgLooks", ML_nRgLooks) # half of range looks on metadata
-    output = GPF.createProduct("Multilook", parameters, product)
+    # half of range looks on metadata
+    output = create_product("Multilook", dict(nRgLooks=ML_nRgLooks), product)
     return output
 
 
@@ -416,66 +1207,309 @@ def multilook(product, ML_nRgLooks):
 def goldstein_phase_filter(product, gpf_fftsize, gpf_win,
                            gpf_cohmask, gpf_cohth):
     print('Applying Goldstein phase filtering...')
-    parameters.put("Adaptive Filter Exponent in(0,1]:", 1.0)
-    parameters.put("FFT Size", gpf_fftsize)
-    parameters.put("Window Size", gpf_win)
-    parameters.put("Use coherence mask", gpf_cohmask)
-    parameters.put("Coherence Threshold in[0,1]:", gpf_cohth)
-    return GPF.createProduct("GoldsteinPhaseFiltering", parameters, product)
+    return create_product("GoldsteinPhaseFiltering", dict(
+        FFTSizeString=str(gpf_fftsize),
+        windowSizeString=str(gpf_win),
+        useCoherenceMask=gpf_cohmask,
+        coherenceThreshold=gpf_cohth
+    ), product)
 
 
 # [P2] Function to create a subset
 def subset(source, aoi, buffer):
     print('Subsetting...')
     wkt = read_aoi(aoi, buffer).wkt
-    parameters.put('geoRegion', wkt)
-    parameters.put('copyMetadata', True)
-    output = GPF.createProduct('Subset', parameters, source)
+    output = create_product('Subset', dict(geoRegion=wkt), source)
     return output
 
 
+# [P3] Function to get the memory available on the machine in bytes
+def available_memory():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+# [P3] Function to choose tiles, overlaps and processors for snaphu
+# Values set by the user are kept, the rest is derived from the raster size,
+# the number of cores and the available memory. Snaphu needs roughly
+# SNAPHU_BYTES_PER_PIXEL for each pixel of a tile (incl. overlap) and
+# performs well up to SNAPHU_TILE_PIXELS pixels per tile.
+SNAPHU_TILE_PIXELS = 2000 * 2000
+SNAPHU_BYTES_PER_PIXEL = 100
+SNAPHU_MIN_OVERLAP = 200
+SNAPHU_MAX_TILES = 20
+
+
+def plan_snaphu_tiles(width, height, tiles=None, tile_overlap_row=None,
+                      tile_overlap_col=None, nproc=None):
+    memory = available_memory()
+
+    def tile_shape(n):
+        rows = int(math.ceil(height / n))
+        cols = int(math.ceil(width / n))
+        if n == 1:
+            return rows, cols, 0, 0
+        overlap_row = tile_overlap_row if tile_overlap_row is not None \
+            else max(SNAPHU_MIN_OVERLAP, int(0.1 * rows))
+        overlap_col = tile_overlap_col if tile_overlap_col is not None \
+            else max(SNAPHU_MIN_OVERLAP, int(0.1 * cols))
+        # snaphu only takes whole pixels for ROWOVRLP and COLOVRLP
+        return rows, cols, int(overlap_row), int(overlap_col)
+
+    def tile_bytes(n):
+        rows, cols, overlap_row, overlap_col = tile_shape(n)
+        return (rows + overlap_row) * (cols + overlap_col) * SNAPHU_BYTES_PER_PIXEL
+
+    if tiles is None:
+        tiles = max(1, int(math.ceil(math.sqrt(width * height / SNAPHU_TILE_PIXELS))))
+        # Make tiles smaller until at least one of them fits in memory
+        while tile_bytes(tiles) > memory and tiles < SNAPHU_MAX_TILES:
+            tiles += 1
+    rows, cols, overlap_row, overlap_col = tile_shape(tiles)
+    if nproc is None:
+        nproc = min(os.cpu_count() or 1, tiles * tiles,
+                    max(1, memory // tile_bytes(tiles)))
+    return dict(
+        tiles=tiles,
+        tile_overlap_row=overlap_row,
+        tile_overlap_col=overlap_col,
+        nproc=int(nproc)
+    )
+
+
 # [P3] Function to export to snaphu
-def snaphu_export(product, snaphu_exp_folder, tiles, cost_mode, tile_overlap_row, tile_overlap_col):
+def snaphu_export(product, snaphu_exp_folder, tiles, cost_mode,
+                  tile_overlap_row, tile_overlap_col, nproc):
     print("Exporting to SNAPHU format...")
-    parameters.put('targetFolder', snaphu_exp_folder)
-    parameters.put('statCostMode', cost_mode)
-    parameters.put('initMethod', 'MCF')
-    parameters.put('numberOfTileCols', tiles)
-    parameters.put('numberOfTileRows', tiles)
-    parameters.put('rowOverlap', tile_overlap_row)
-    parameters.put('colOverlap', tile_overlap_col)
-    parameters.put('numberOfProcessors', 4)
-    parameters.put('tileCostThreshold', 500)
-    output = GPF.createProduct('SnaphuExport', parameters, product)
-    ProductIO.writeProduct(output, snaphu_exp_folder, 'Snaphu')
+    output = create_product('SnaphuExport', dict(
+        targetFolder=snaphu_exp_folder,
+        statCostMode=cost_mode,
+        numberOfTileCols=tiles,
+        numberOfTileRows=tiles,
+        rowOverlap=tile_overlap_row,
+        colOverlap=tile_overlap_col,
+        numberOfProcessors=nproc
+    ), product)
+    write_product(output, snaphu_exp_folder, 'Snaphu')
     return output
 
 
-# [P3] Function for snaphu unwrapping
+# [P3] Function to read the header of an ENVI image
+def read_envi_header(img_file):
+    header = {}
+    with open(os.path.splitext(img_file)[0] + '.hdr') as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                header[key.strip()] = value.strip()
+    return header
+
+
+# [P3] Function to read an ENVI image as written by snaphu and SNAP
+def read_envi_image(img_file):
+    header = read_envi_header(img_file)
+    dtype = '>f4' if header.get('byte order', '0') == '1' else '<f4'
+    return np.fromfile(img_file, dtype=dtype).reshape(
+        int(header['lines']), int(header['samples'])
+    )
+
+
+# [P3] Function to check the unwrapped phase for tile seams
+# Compares how often the phase jumps by more than pi between neighbouring
+# pixels across tile boundaries vs. within the whole image.
+# Pixels equal to 0 are masked out by snaphu and ignored here.
+def check_tile_seams(unwrapped, tiles):
+    valid = unwrapped != 0
+    jumps_row = (np.abs(np.diff(unwrapped, axis=0)) > np.pi) & valid[1:, :] & valid[:-1, :]
+    jumps_col = (np.abs(np.diff(unwrapped, axis=1)) > np.pi) & valid[:, 1:] & valid[:, :-1]
+    n_valid = max(1, np.count_nonzero(valid))
+    interior_rate = (np.count_nonzero(jumps_row) + np.count_nonzero(jumps_col)) / (2 * n_valid)
+    rows, cols = unwrapped.shape
+    seam_jumps = 0
+    seam_pixels = 0
+    for i in range(1, tiles):
+        row = rows * i // tiles - 1
+        col = cols * i // tiles - 1
+        seam_jumps += np.count_nonzero(jumps_row[row, :]) + np.count_nonzero(jumps_col[:, col])
+        seam_pixels += np.count_nonzero(valid[row, :]) + np.count_nonzero(valid[:, col])
+    seam_rate = seam_jumps / max(1, seam_pixels)
+    return dict(
+        seam_jump_rate=float(seam_rate),
+        interior_jump_rate=float(interior_rate),
+        seams_ok=bool(tiles == 1 or seam_rate <= max(0.01, 5 * interior_rate))
+    )
+
+
+# [P3] Function to write an array as ENVI image, with the
+# data type and byte order given in its existing header
+def write_envi_image(array, img_file, hdr_file):
+    with open(hdr_file) as f:
+        big_endian = any(line.replace(' ', '').strip() == 'byteorder=1' for line in f)
+    array.astype('>f4' if big_endian else '<f4').tofile(img_file)
+    if os.path.abspath(os.path.splitext(img_file)[0] + '.hdr') != os.path.abspath(hdr_file):
+        shutil.copy(hdr_file, os.path.splitext(img_file)[0] + '.hdr')
+
+
+# [P3] Function to build the snaphu command for an exported phase
+def snaphu_command(phase_img, width, out_img, plan, tile_dir):
+    tiles = plan['tiles']
+    return ['snaphu', '-f', 'snaphu.conf', phase_img, str(width),
+            '-o', out_img,
+            '-C', 'NTILEROW ' + str(tiles), '-C', 'NTILECOL ' + str(tiles),
+            '-C', 'ROWOVRLP ' + str(plan['tile_overlap_row']),
+            '-C', 'COLOVRLP ' + str(plan['tile_overlap_col']),
+            '-C', 'NPROC ' + str(plan['nproc']),
+            '-C', 'TILEDIR ' + tile_dir, '-C', 'RMTMPTILE FALSE']
+
+
+# [P3] Unwrapping backend: snaphu
 # Unwrapping code adapted from:
 # https://forum.step.esa.int/t/snaphu-read-error-due-to-non-ascii-unreadable-file/14374/4
-def snaphu_unwrapping(snaphu_exp_folder):
+# The command is built from the exported phase and the snaphu plan, the
+# exported snaphu.conf only provides the remaining settings (cost mode,
+# coherence file). Temporary tiles are kept until unwrapping is done,
+# to record when each tile was finished, and removed afterwards.
+def snaphu_unwrapping(snaphu_exp_folder, out_img, plan):
+    print('Unwrapping with snaphu...')
+    phase_img = glob.glob(os.path.join(snaphu_exp_folder, "Phase*.img"))
+    if not phase_img:
+        raise ValueError("No wrapped phase found in " + snaphu_exp_folder + ".")
+    width = read_envi_header(phase_img[0])['samples']
+    tiles = plan['tiles']
+    tile_dir = 'snaphu_tiles'
+    snaphu_args = snaphu_command(os.path.basename(phase_img[0]), width,
+                                 os.path.basename(out_img), plan, tile_dir)
+    print("\nCommand sent to snaphu:\n", ' '.join(snaphu_args))
+    start = time.time()
+    process = subprocess.Popen(snaphu_args, cwd=str(snaphu_exp_folder),
+                               stderr=subprocess.PIPE, universal_newlines=True)
+    _, stderr = process.communicate()
+    if process.returncode != 0 or not os.path.exists(out_img):
+        raise ValueError("Snaphu unwrapping failed (exit code " + str(process.returncode) +
+                         "): " + stderr.strip()[-500:])
+
+    # Seconds from start until each tile was written
+    tile_seconds = {}
+    tile_dir = os.path.join(snaphu_exp_folder, tile_dir)
+    if os.path.isdir(tile_dir):
+        for tile_file in os.listdir(tile_dir):
+            if not tile_file.startswith('tmptile_'):
+                continue
+            tile_index = tile_file.rsplit('.', 1)[0].split('_')[-2:]
+            tile_seconds['_'.join(tile_index)] = round(
+                os.path.getmtime(os.path.join(tile_dir, tile_file)) - start, 2
+            )
+        shutil.rmtree(tile_dir)
+    info = dict(tiles=tiles, tile_seconds=tile_seconds)
+    info.update(check_tile_seams(read_envi_image(out_img), tiles))
+    if not info['seams_ok']:
+        print('WARNING: phase jumps found along snaphu tile boundaries, '
+              'consider fewer tiles or a larger overlap.')
+    return info
+
+
+# [P3] Unwrapping backend: least squares with NumPy/SciPy
+# Unweighted least-squares unwrapping solved with the discrete cosine
+# transform (Ghiglia & Romero, 1994), made congruent with the wrapped
+# phase afterwards. Fast and memory-bound, but less robust than snaphu
+# on noisy or discontinuous phase, so better for small AOIs and quick looks.
+def lsq_unwrapping(snaphu_exp_folder, out_img, plan):
+    print('Unwrapping with least squares...')
+    phase_img = glob.glob(os.path.join(snaphu_exp_folder, "Phase*.img"))
+    if not phase_img:
+        raise ValueError("No wrapped phase found in " + snaphu_exp_folder + ".")
+    wrapped = read_envi_image(phase_img[0]).astype('float64')
+    valid = wrapped != 0
+
+    def wrap(phase):
+        return (phase + np.pi) % (2 * np.pi) - np.pi
+
+    dx = wrap(np.diff(wrapped, axis=1))
+    dy = wrap(np.diff(wrapped, axis=0))
+    rho = np.zeros_like(wrapped)
+    rho[:, :-1] += dx
+    rho[:, 1:] -= dx
+    rho[:-1, :] += dy
+    rho[1:, :] -= dy
+    rows, cols = wrapped.shape
+    denominator = 2 * (np.cos(np.pi * np.arange(rows)[:, None] / rows) +
+                       np.cos(np.pi * np.arange(cols)[None, :] / cols) - 2)
+    denominator[0, 0] = 1
+    solution = dctn(rho, norm='ortho') / denominator
+    solution[0, 0] = 0
+    unwrapped = idctn(solution, norm='ortho')
+    unwrapped = wrapped + 2 * np.pi * np.round((unwrapped - wrapped) / (2 * np.pi))
+    unwrapped[~valid] = 0
+    hdr_file = os.path.splitext(out_img)[0] + '.hdr'
+    write_envi_image(unwrapped, out_img, hdr_file)
+    return dict(tiles=1)
+
+
+# [P3] Available unwrapping backends
+# Each backend takes the snaphu export folder, the path of the
+# unwrapped image to write and the snaphu plan (see plan_snaphu_tiles),
+# and returns
+# a dictionary with information about the run.
+UNWRAPPING_BACKENDS = {
+    'snaphu': snaphu_unwrapping,
+    'lsq': lsq_unwrapping
+}
+
+
+# [P3] Function for phase unwrapping with the selected backend
+# When benchmark=True all backends are run, each to its own file,
+# and compared with the selected one.
+def unwrapping(snaphu_exp_folder, plan, backend='snaphu', benchmark=False):
     print('Unwrapping...')
-    infile = os.path.join(snaphu_exp_folder, "snaphu.conf")
-    with open(str(infile)) as lines:
-        line = lines.readlines()[6]
-        snaphu_string = line[1:].strip()
-        snaphu_args = snaphu_string.split()
-    print("\nCommand sent to snaphu:\n", snaphu_string)
-    process = subprocess.Popen(snaphu_args, cwd=str(snaphu_exp_folder))
-    process.communicate()
-    process.wait()
-
-    unw_img_file = glob.glob(os.path.join(output_dir, str("out_P3_snaphu" + "/UnwPhase*.img")))
-    if not unw_img_file:
-        raise ValueError("Snaphu unwrapping failed. Pipeline [P3] incomplete.")
-
-    unwrapped_list = glob.glob(str(snaphu_exp_folder) + "/UnwPhase*.hdr")
-    unwrapped_hdr = str(unwrapped_list[0])
+    unwrapped_hdr = glob.glob(os.path.join(snaphu_exp_folder, "UnwPhase*.hdr"))
+    if not unwrapped_hdr:
+        raise ValueError("No UnwPhase header found in " + snaphu_exp_folder +
+                         ", was the snaphu export successful?")
+    unwrapped_hdr = unwrapped_hdr[0]
+    unwrapped_img = os.path.splitext(unwrapped_hdr)[0] + '.img'
+
+    start = time.time()
+    info = UNWRAPPING_BACKENDS[backend](snaphu_exp_folder, unwrapped_img, plan)
+    info['backend'] = backend
+    info['total_seconds'] = round(time.time() - start, 2)
+    with open(os.path.join(snaphu_exp_folder, 'unwrapping.json'), 'w') as f:
+        json.dump(info, f, indent=2)
+
+    if benchmark:
+        reference = read_envi_image(unwrapped_img)
+        valid = reference != 0
+        results = {backend: dict(seconds=info['total_seconds'], rms_difference=0.0)}
+        for other in UNWRAPPING_BACKENDS:
+            if other == backend:
+                continue
+            other_img = os.path.splitext(unwrapped_img)[0] + '_' + other + '.img'
+            shutil.copy(unwrapped_hdr, os.path.splitext(other_img)[0] + '.hdr')
+            start = time.time()
+            try:
+                UNWRAPPING_BACKENDS[other](snaphu_exp_folder, other_img, plan)
+            except ValueError as e:
+                results[other] = dict(error=str(e))
+                continue
+            seconds = time.time() - start
+            # Unwrapped phase is only defined up to a constant offset
+            difference = read_envi_image(other_img)[valid] - reference[valid]
+            difference = difference - np.median(difference)
+            results[other] = dict(
+                seconds=round(seconds, 2),
+                rms_difference=float(np.sqrt(np.mean(difference ** 2)))
+            )
+        with open(os.path.join(snaphu_exp_folder, 'unwrap_benchmark.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Unwrapping benchmark:', results)
+
     unwrapped_read = ProductIO.readProduct(unwrapped_hdr)
     fn = os.path.join(snaphu_exp_folder, "unwrapped")
     write_BEAM_DIMAP_format(unwrapped_read, fn)
     print('Phase unwrapping performed successfully.')
+    return info
 
 
 # [P4] Function to import snaphu object
@@ -484,49 +1518,1031 @@ def snaphu_import(product, unwrapped):
     snaphu_files = jpy.array('org.esa.snap.core.datamodel.Product', 2)
     snaphu_files[0] = product
     snaphu_files[1] = unwrapped
-    output = GPF.createProduct("SnaphuImport", parameters, snaphu_files)
+    output = create_product("SnaphuImport", None, snaphu_files)
     return output
 
 
 # [P4] Function to transform phase to elevation
 def phase_to_elev(unwrapped_product, dem):
     print('Converting phase to elevation...')
-    parameters.put("demName", dem)
-    output = GPF.createProduct("PhaseToElevation", parameters, unwrapped_product)
+    output = create_product("PhaseToElevation", dem_parameters(dem), unwrapped_product)
     return output
 
 
 # [P4] Function to perform terrain correction
-def terrain_correction(source, band=None, projected=True, pixel_size=30.0):
+def terrain_correction(source, dem, band=None, projected=True, pixel_size=30.0):
     print('Terrain correction...')
-    parameters.put('demName', args.dem)
-    parameters.put('imgResamplingMethod', 'BILINEAR_INTERPOLATION')
-    if projected:
-        parameters.put('mapProjection', 'AUTO:42001')
-    # parameters.put('saveProjectedLocalIncidenceAngle', False)
-    if band is not None:
-        parameters.put('sourceBands', band)
-    parameters.put('saveSelectedSourceBand', True)
-    parameters.put('nodataValueAtSea', False)
-    parameters.put('pixelSpacingInMeter', pixel_size)
-    output = GPF.createProduct('Terrain-Correction', parameters, source)
+    tc_parameters = dem_parameters(dem)
+    tc_parameters.update(
+        mapProjection='AUTO:42001' if projected else None,
+        # saveProjectedLocalIncidenceAngle=False,
+        sourceBands=band,
+        pixelSpacingInMeter=pixel_size
+    )
+    output = create_product('Terrain-Correction', tc_parameters, source)
     return output
 
 
-# [P4] Filter pixels by threshold
-# def filter_product_threshold(stack, th):
+# [P4] Function to select bands from a product
+def band_select(source, bands):
+    return create_product('BandSelect', dict(sourceBands=bands), source)
+
+
+# [P4] Function to merge the bands of products with the same geometry
+def band_merge(sources):
+    products = jpy.array('org.esa.snap.core.datamodel.Product', len(sources))
+    for i, source in enumerate(sources):
+        products[i] = source
+    return create_product('BandMerge', None, products)
+
+
+# [P4] Function to convert a GeoTIFF into a Cloud-Optimized GeoTIFF
+# The raster is copied block by block into a tiled, compressed GeoTIFF,
+# overviews are added and the result is copied again so that the
+# overviews come before the full resolution data, as COGs require.
+def convert_to_cog(filename, compress=args.cog_compress,
+                   blocksize=args.cog_blocksize):
+    print('Converting ' + os.path.basename(filename) + ' to COG...')
+    tmp_filename = filename + '.tmp.tif'
+    creation_options = dict(
+        tiled=True, blockxsize=blocksize, blockysize=blocksize,
+        compress=compress, predictor=3, BIGTIFF='IF_SAFER'
+    )
+    with rasterio.open(filename) as src:
+        profile = src.profile.copy()
+        profile.update(creation_options, driver='GTiff', dtype='float32',
+                       nodata=src.nodata if src.nodata is not None else -99999)
+        with rasterio.open(tmp_filename, 'w', **profile) as dst:
+            for _, window in dst.block_windows(1):
+                dst.write(src.read(window=window).astype('float32'), window=window)
+            factors = []
+            factor = 2
+            while max(src.width, src.height) / factor >= blocksize / 2:
+                factors.append(factor)
+                factor *= 2
+            if factors:
+                dst.build_overviews(factors, Resampling.average)
+                dst.update_tags(ns='rio_overview', resampling='average')
+    rasterio.shutil.copy(tmp_filename, filename, driver='GTiff',
+                         copy_src_overviews=True, **creation_options)
+    os.remove(tmp_filename)
+
+
+# [P4] Function to finish a final GeoTIFF in the selected output format
+def finalize_tiff(filename, output_format=args.output_format):
+    if output_format == 'COG':
+        convert_to_cog(filename)
+
+
+# [P4] Function to read a band of a SNAP product into an array
+# Reads the whole band, or only the window at x, y of width x height.
+def read_band(product, band, x=0, y=0, width=None, height=None):
+    if width is None:
+        width = product.getSceneRasterWidth()
+    if height is None:
+        height = product.getSceneRasterHeight()
+    data = np.zeros(width * height, dtype=np.float32)
+    product.getBand(band).readPixels(x, y, width, height, data)
+    return data.reshape(height, width)
+
+
+# [P4] Function to describe the geometry of a product for the geocoding cache
+# The key identifies track, subswaths, AOI, DEM and output grid settings,
+# the corners are used to check that the bursts cover the same footprint.
+def geocoding_geometry(product, subswaths, dem, proj, pixel_size):
+    key = dict(
+        orbit=str(orbit), passf=str(passf),
+        subswaths=sorted(subswaths or []),
+        aoi=os.path.abspath(args.aoi_path), aoi_buffer=args.aoi_buffer,
+        subset=args.subset_toggle, dem=dem,
+        projected=proj, pixel_size=pixel_size,
+        width=product.getSceneRasterWidth(),
+        height=product.getSceneRasterHeight()
+    )
+    key = hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    PixelPos = jpy.get_type('org.esa.snap.core.datamodel.PixelPos')
+    geocoding = product.getSceneGeoCoding()
+    corners = []
+    for x, y in [(0, 0), (product.getSceneRasterWidth(), 0),
+                 (0, product.getSceneRasterHeight()),
+                 (product.getSceneRasterWidth(), product.getSceneRasterHeight())]:
+        geo_pos = geocoding.getGeoPos(PixelPos(x, y), None)
+        corners.append([geo_pos.getLat(), geo_pos.getLon()])
+    return key, corners
+
+
+# [P4] Function to load a geocoding lookup table from the cache
+# Returns None if the table does not exist or if the product
+# footprint moved more than the tolerance (in meters).
+def load_geocoding_lut(cache_dir, key, corners, tolerance):
+    meta_file = os.path.join(cache_dir, key + '.json')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        lut = json.load(f)
+    for (lat_1, lon_1), (lat_2, lon_2) in zip(corners, lut['corners']):
+        shift = 111320 * math.hypot(lat_1 - lat_2, (lon_1 - lon_2) * math.cos(math.radians(lat_1)))
+        if shift > tolerance:
+            print('Geocoding lookup table found but footprint shifted by %.1f m.' % shift)
+            return None
+    lut['rows'] = np.load(os.path.join(cache_dir, key + '_rows.npy'), mmap_mode='r')
+    lut['cols'] = np.load(os.path.join(cache_dir, key + '_cols.npy'), mmap_mode='r')
+    return lut
+
+
+# [P4] Function to build a geocoding lookup table
+# Terrain corrects the pixel coordinates of the product, so that each
+# pixel of the output grid knows which SAR row and column it comes from.
+def build_geocoding_lut(product, cache_dir, key, corners, dem, proj, pixel_size):
+    print('Building geocoding lookup table...')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    ProductData = jpy.get_type('org.esa.snap.core.datamodel.ProductData')
+    product.addBand('lut_row', 'Y', ProductData.TYPE_FLOAT32)
+    product.addBand('lut_col', 'X', ProductData.TYPE_FLOAT32)
+    for band in ['lut_row', 'lut_col']:
+        product.getBand(band).setGeophysicalNoDataValue(-99999)
+        product.getBand(band).setNoDataValueUsed(True)
+    lut_tc = terrain_correction(product, dem, band='lut_row,lut_col',
+                                projected=proj, pixel_size=pixel_size)
+    lut_tiff = os.path.join(cache_dir, key + '.tif')
+    write_TIFF_format(lut_tc, lut_tiff)
+    with rasterio.open(lut_tiff) as src:
+        # SNAP band maths pixel coordinates refer to the pixel center
+        np.save(os.path.join(cache_dir, key + '_rows.npy'), src.read(1) - 0.5)
+        np.save(os.path.join(cache_dir, key + '_cols.npy'), src.read(2) - 0.5)
+        lut = dict(
+            corners=corners,
+            crs=src.crs.to_wkt(),
+            transform=list(src.transform)[:6],
+            width=src.width,
+            height=src.height
+        )
+    os.remove(lut_tiff)
+    with open(os.path.join(cache_dir, key + '.json'), 'w') as f:
+        json.dump(lut, f)
+
+
+# [P4] Function to geocode a band with a lookup table
+# Resamples bilinearly onto the output grid, in blocks of rows. For each
+# block only the window of the band covered by its lookup coordinates is
+# read, and the block is written right away, to keep memory bounded.
+def geocode_with_lut(product, band, lut, filename, block_rows=1024):
+    band_width = product.getSceneRasterWidth()
+    band_height = product.getSceneRasterHeight()
+    profile = dict(
+        driver='GTiff', dtype='float32', count=1, nodata=-99999,
+        crs=rasterio.crs.CRS.from_wkt(lut['crs']),
+        transform=rasterio.Affine(*lut['transform']),
+        width=lut['width'],
+        height=lut['height']
+    )
+    with rasterio.open(filename, 'w', **profile) as dst:
+        for row in range(0, lut['height'], block_rows):
+            rows = np.asarray(lut['rows'][row:row + block_rows])
+            cols = np.asarray(lut['cols'][row:row + block_rows])
+            block = np.full(rows.shape, -99999, dtype=np.float32)
+            valid = rows > -1
+            if valid.any():
+                # Window of the band around the coordinates, incl. the
+                # neighbours needed for bilinear interpolation
+                row_0 = max(0, int(np.floor(rows[valid].min())))
+                row_1 = min(band_height, int(np.ceil(rows[valid].max())) + 1)
+                col_0 = max(0, int(np.floor(cols[valid].min())))
+                col_1 = min(band_width, int(np.ceil(cols[valid].max())) + 1)
+                data = read_band(product, band, col_0, row_0, col_1 - col_0, row_1 - row_0)
+                data[data == -99999] = np.nan
+                values = map_coordinates(data, [rows[valid] - row_0, cols[valid] - col_0],
+                                         order=1, cval=np.nan)
+                block[valid] = np.where(np.isnan(values), -99999, values)
+            dst.write(block, 1, window=Window(0, row, lut['width'], rows.shape[0]))
+
+
+# [P4] Function to get the valid pixels of elevation and coherence
+# SNAP fills pixels without data with -99999, often without setting it as
+# nodata of the GeoTIFF, and coherence is 0 outside the swath.
+def valid_pixels(elevation, coherence, elev_nodata=None, coh_nodata=None):
+    elev_nodata = elev_nodata if elev_nodata is not None else -99999
+    coh_nodata = coh_nodata if coh_nodata is not None else -99999
+    return (elevation != elev_nodata) & (coherence != coh_nodata) & \
+        np.isfinite(elevation) & np.isfinite(coherence) & (coherence > 0)
+
+
+# [P4] Function to mask elevation by coherence thresholds
+# Elevation and coherence are read block by block, following the internal
+# tiling of the elevation GeoTIFF, and all thresholds are applied in the
+# same pass, so memory stays bounded whatever the scene size.
+def mask_elevation_by_coherence(elevation_tiff, coherence_tiff, thresholds, out_dir):
+    print('Masking elevation by coherence...')
+    masked_tiffs = {
+        th: os.path.join(out_dir, date_bundle + '_elevation_coh%02d.tif' % round(th * 100))
+        for th in thresholds
+    }
+    kept = dict((th, 0) for th in thresholds)
+    n_pixels = 0
+    n_valid = 0
+    with rasterio.open(elevation_tiff) as elev, rasterio.open(coherence_tiff) as coh:
+        profile = elev.profile.copy()
+        profile.update(dtype='float32', count=1, nodata=-99999)
+        outputs = dict((th, rasterio.open(masked_tiffs[th], 'w', **profile)) for th in thresholds)
+        try:
+            for _, window in elev.block_windows(1):
+                elevation = elev.read(1, window=window)
+                coherence = coh.read(1, window=window)
+                valid = valid_pixels(elevation, coherence, elev.nodata, coh.nodata)
+                n_pixels += elevation.size
+                n_valid += np.count_nonzero(valid)
+                for th in thresholds:
+                    keep = valid & (coherence >= th)
+                    kept[th] += np.count_nonzero(keep)
+                    outputs[th].write(np.where(keep, elevation, -99999).astype('float32'),
+                                      1, window=window)
+        finally:
+            for output in outputs.values():
+                output.close()
+    stats = pd.DataFrame([
+        dict(threshold=th, file=os.path.basename(masked_tiffs[th]),
+             pixels=n_pixels, valid_pixels=n_valid, kept_pixels=kept[th],
+             kept_fraction=kept[th] / n_valid if n_valid else 0)
+        for th in thresholds
+    ])
+    stats.to_csv(os.path.join(out_dir, date_bundle + '_coherence_mask_stats.csv'), index=False)
+    for masked_tiff in masked_tiffs.values():
+        finalize_tiff(masked_tiff)
+    return stats
+
+
+# [P1] Function to get the bursts of one subswath
+# out of the result of get_swath_burst
+def bursts_in_subswath(swath_burst, IW):
+    return [burst for swath, burst in
+            zip(swath_burst['subswath'], swath_burst['burst'])
+            if swath == IW]
+
+
+# [P1] Function to coregister both images for one subswath
+def process_subswath(product_1, product_2, IW, burst_1, burst_2, dem,
+                     orbit_1, orbit_2, esd=True):
+    print('Processing subswath ' + IW + '...')
+    product_TOPSAR_1 = topsar_split(product_1, IW,
+                                    min(burst_1), max(burst_1))
+    product_TOPSAR_2 = topsar_split(product_2, IW,
+                                    min(burst_2), max(burst_2))
+    product_orbitFile_1 = apply_orbit_file(product_TOPSAR_1, orbit_1)
+    product_orbitFile_2 = apply_orbit_file(product_TOPSAR_2, orbit_2)
+    product = back_geocoding([product_orbitFile_1, product_orbitFile_2], dem)
+    if esd and (len(burst_1) > 1 or len(burst_2) > 1):
+        product = enhanced_spectral_diversity(product)
+    return product
+
+
+# Resource planning
+# Memory model used to size the JVM heap and the SNAP tile cache of a run.
+# IW bursts have about BURST_PIXELS pixels; P1 holds both images as complex
+# data for the bursts being coregistered (ESD reads whole burst overlaps),
+# P2 forms the interferogram over the full bursts, P4 works on the
+# multilooked subset. Ground range pixels are about 3.7 m for IW, so a
+# multilooked (square) pixel covers (3.7 * multilook_range)^2 m2.
+# The constants are conservative and can be checked against the
+# jvm_heap_used_mb recorded in metrics.json.
+JVM_BASE_BYTES = 2 * 1024 ** 3
+BURST_PIXELS = 1500 * 21000
+STAGE_BYTES_PER_BURST = dict(P1=2 * 8 * BURST_PIXELS * 0.25, P2=3 * 4 * BURST_PIXELS * 0.25)
+P4_BYTES_PER_PIXEL = 6 * 4 * 4
+IW_GROUND_RANGE_SPACING = 3.7
+
+
+# Function to estimate the memory needed by each stage of a pair
+def estimate_memory(n_bursts, aoi_area, multilook_range):
+    ml_pixels = aoi_area / (IW_GROUND_RANGE_SPACING * max(1, multilook_range)) ** 2
+    return dict(
+        P1=JVM_BASE_BYTES + n_bursts * STAGE_BYTES_PER_BURST['P1'],
+        P2=JVM_BASE_BYTES + n_bursts * STAGE_BYTES_PER_BURST['P2'],
+        # snaphu runs outside the JVM and is tiled to fit (see plan_snaphu_tiles)
+        P3=ml_pixels * SNAPHU_BYTES_PER_PIXEL,
+        P4=JVM_BASE_BYTES + ml_pixels * P4_BYTES_PER_PIXEL
+    )
+
+
+# Function to plan JVM heap and tile cache for a pair
+def plan_resources(n_bursts, aoi_area, multilook_range, max_memory=None):
+    memory = max_memory * 1024 ** 3 if max_memory else available_memory()
+    estimate = estimate_memory(n_bursts, aoi_area, multilook_range)
+    heap = max(estimate['P1'], estimate['P2'], estimate['P4'])
+    # Leave room for the Python process and the OS outside of the heap
+    limit = 0.8 * memory
+    return dict(
+        n_bursts=n_bursts,
+        estimate_mb=dict((stage, int(value / 1024 ** 2)) for stage, value in estimate.items()),
+        heap_mb=int(min(max(heap * 1.25, JVM_BASE_BYTES), limit) / 1024 ** 2),
+        # SNAP caches computed tiles, half of the heap keeps room for operators
+        tile_cache_mb=int(min(max(heap * 1.25, JVM_BASE_BYTES), limit) / 2 / 1024 ** 2),
+        memory_mb=int(memory / 1024 ** 2),
+        fits=heap <= limit
+    )
+
+
+# Function to get the area of the AOI in m2
+def aoi_area(aoi, buffer):
+    aoi_geom = read_aoi(aoi, buffer)
+    lat = aoi_geom.centroid.y
+    return aoi_geom.area * 111320 ** 2 * math.cos(math.radians(lat))
+
+
+# Function to apply a resource plan to this run
+# The JVM heap can only be set when the JVM starts, and snappy starts it on
+# import, so the script is started again once with the planned heap in
+# _JAVA_OPTIONS (which takes precedence over the snappy configuration).
+def apply_resource_plan(plan):
+    if not os.environ.get('SLIDEM_RESOURCE_PLAN'):
+        max_heap_mb = Runtime.getRuntime().maxMemory() / 1024 ** 2
+        if abs(max_heap_mb - plan['heap_mb']) > 0.1 * plan['heap_mb']:
+            print('Restarting with JVM heap of %d MB (was %d MB)...' % (plan['heap_mb'], max_heap_mb))
+            java_options = os.environ.get('_JAVA_OPTIONS', '') + \
+                ' -Xmx%dm -Dsnap.jai.tileCacheSize=%d' % (plan['heap_mb'], plan['tile_cache_mb'])
+            env = dict(os.environ, SLIDEM_RESOURCE_PLAN='1', _JAVA_OPTIONS=java_options.strip())
+            sys.stdout.flush()
+            os.chdir(launch_dir)
+            os.execve(sys.executable, [sys.executable, script_path] + sys.argv[1:], env)
+    JAI = jpy.get_type('javax.media.jai.JAI')
+    JAI.getDefaultInstance().getTileCache().setMemoryCapacity(plan['tile_cache_mb'] * 1024 ** 2)
+
+
+# Host scheduler
+# Runs on the same host share a ledger (a JSON file, locked while used) of
+# the cores and memory given to each running pipeline. A pipeline waits
+# until enough cores and memory are free, or nothing else runs, and then
+# takes the lowest free cores. Allocations of processes that died are
+# dropped. The process is bound to its cores (children like snaphu
+# inherit this) and SNAP computes tiles with that many threads.
+HOST_SCHEDULER_POLL = 5
+
+
+# Function to get the cores this run may use at all (e.g. the cpuset of a
+# container), taken before any pipeline binds the process to its cores and
+# kept for the processes it starts
+def host_cores():
+    if 'SLIDEM_HOST_CORES' not in os.environ:
+        os.environ['SLIDEM_HOST_CORES'] = json.dumps(sorted(os.sched_getaffinity(0)))
+    return json.loads(os.environ['SLIDEM_HOST_CORES'])
+
+
+def read_ledger(ledger):
+    allocations = []
+    if os.path.exists(ledger) and os.path.getsize(ledger) > 0:
+        with open(ledger) as f:
+            allocations = json.load(f)['allocations']
+    alive = []
+    for allocation in allocations:
+        try:
+            os.kill(allocation['pid'], 0)
+            alive.append(allocation)
+        except OSError:
+            pass
+    return alive
+
+
+def write_ledger(ledger, allocations):
+    with open(ledger + '.tmp', 'w') as f:
+        json.dump(dict(allocations=allocations), f, indent=2)
+    os.rename(ledger + '.tmp', ledger)
+
+
+# Function to bind all threads of this process to a set of cores
+def set_affinity(cores):
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            os.sched_setaffinity(int(tid), cores)
+        except OSError:
+            # thread ended in the meantime
+            pass
+
+
+# Function to run a pipeline with cores and memory of the host budget
+# Yields the cores given to it, or None without host scheduler. Subswath
+# workers run on a share of the slot of the pipeline that launched them
+# (SLIDEM_HOST_SLOT) instead of taking their own from the ledger.
+@contextlib.contextmanager
+def host_slot(stage, cpus=None, memory_mb=None, ledger=args.host_scheduler):
+    if ledger is None:
+        yield None
+        return
+    worker_slot = os.environ.get('SLIDEM_HOST_SLOT')
+    if worker_slot is not None:
+        cores = json.loads(worker_slot)
+    else:
+        all_cores = host_cores()
+        budget_cores = all_cores[:args.host_cpus] if args.host_cpus else all_cores
+        host_cpus = len(budget_cores)
+        host_memory_mb = args.host_memory * 1024 if args.host_memory else \
+            os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 2
+        cpus = min(cpus or args.stage_cpus or max(1, host_cpus // 4), host_cpus)
+        if memory_mb is None:
+            memory_mb = Runtime.getRuntime().maxMemory() / 1024 ** 2
+        waiting = False
+        while True:
+            with open(ledger + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                allocations = read_ledger(ledger)
+                used_cores = set(core for allocation in allocations for core in allocation['cores'])
+                free_cores = [core for core in budget_cores if core not in used_cores]
+                free_memory_mb = host_memory_mb - sum(allocation['memory_mb'] for allocation in allocations)
+                if not allocations or (len(free_cores) >= cpus and free_memory_mb >= memory_mb):
+                    cores = (free_cores or budget_cores)[:cpus]
+                    allocations.append(dict(pid=os.getpid(), pair=date_bundle, stage=stage,
+                                             cores=cores, memory_mb=int(memory_mb), since=time.time()))
+                    write_ledger(ledger, allocations)
+                    break
+            if not waiting:
+                print('Waiting for %d cores and %d MB on this host for %s...' % (cpus, memory_mb, stage))
+                waiting = True
+            time.sleep(HOST_SCHEDULER_POLL)
+    print('Running %s on cores %s' % (stage, ','.join(str(core) for core in cores)))
+    set_affinity(cores)
+    JAI = jpy.get_type('javax.media.jai.JAI')
+    JAI.getDefaultInstance().getTileScheduler().setParallelism(len(cores))
+    try:
+        yield cores
+    finally:
+        if worker_slot is None:
+            with open(ledger + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                write_ledger(ledger, [allocation for allocation in read_ledger(ledger)
+                                      if not (allocation['pid'] == os.getpid() and
+                                              allocation['stage'] == stage)])
+            # Do not keep running on cores the ledger gives to other runs now
+            set_affinity(host_cores())
+            JAI.getDefaultInstance().getTileScheduler().setParallelism(len(host_cores()))
+
+
+# [P1] Function to process several subswaths in parallel
+# Each subswath is handled by a worker, which is this same script
+# called with the --subswath argument. Every worker runs in its own
+# process (and JVM) and writes out_P1_<IW> to the output directory.
+# The heap planned for the run is shared between the workers, but not more
+# than the memory still available (which already excludes what this
+# process uses while it waits). If that leaves less than JVM_BASE_BYTES per
+# worker, fewer workers run at a time.
+def run_subswath_workers(subswaths):
+    env = dict(os.environ)
+    if 'resource_plan' in metrics:
+        heap_mb = metrics['resource_plan']['heap_mb']
+    else:
+        heap_mb = Runtime.getRuntime().maxMemory() / 1024 ** 2
+    budget_mb = min(heap_mb, 0.8 * available_memory() / 1024 ** 2)
+    parallel = max(1, min(len(subswaths), int(budget_mb // (JVM_BASE_BYTES / 1024 ** 2))))
+    worker_heap_mb = budget_mb / parallel
+    env['SLIDEM_RESOURCE_PLAN'] = '1'
+    env['_JAVA_OPTIONS'] = '-Xmx%dm -Dsnap.jai.tileCacheSize=%d' % (worker_heap_mb, worker_heap_mb / 2)
+    if args.host_scheduler is not None:
+        # Workers share the cores of the P1 slot, bound to this process
+        cores = sorted(os.sched_getaffinity(0))
+        if len(cores) >= parallel:
+            slots = [cores[i::parallel] for i in range(parallel)]
+        else:
+            slots = [cores] * parallel
+    failed = []
+    for start in range(0, len(subswaths), parallel):
+        batch = subswaths[start:start + parallel]
+        print('Launching workers for subswaths: ' + ', '.join(batch) +
+              ' (heap of %d MB each)' % worker_heap_mb)
+        workers = {}
+        for i, IW in enumerate(batch):
+            if args.host_scheduler is not None:
+                env = dict(env, SLIDEM_HOST_SLOT=json.dumps(slots[i]))
+            workers[IW] = subprocess.Popen(
+                [sys.executable, script_path] + sys.argv[1:] + ['--subswath', IW],
+                cwd=launch_dir, env=env
+            )
+        for IW, worker in workers.items():
+            worker.wait()
+            if worker.returncode != 0:
+                failed.append(IW)
+    if failed:
+        raise ValueError("Processing failed for subswaths: " +
+                         ', '.join(failed) + ". Pipeline [P1] incomplete.")
+
+
+# [P1] Function to get the scenes of the time-series stack of this pair
+# All scenes with Download=True of the same orbit and pass, by date.
+def stack_scenes(pairs, orbit, passf):
+    rows = pairs[(pairs['Orbit'] == orbit) & (pairs['Pass'] == passf)]
+    scene_ids = set(rows['ReferenceID'].tolist() + rows['MatchID'].tolist())
+    # Scene IDs hold the acquisition start, e.g. S1A_IW_SLC__1SDV_20210127T052305_...
+    return dict(sorted((scene_id[17:25], os.path.join(args.download_dir, scene_id + '.zip'))
+                       for scene_id in scene_ids))
+
+
+# [P1] Function to get the stack directory of this pair
+def stack_directory(polarization=args.polarization):
+    return os.path.join(args.output_dir,
+                        'stack_' + str(passf) + '_' + str(orbit) + '_' + polarization)
+
+
+# [P1] Function to coregister all scenes of the time series to one master
+# Scenes are split and orbit corrected, then back geocoded in a single
+# stack (the first source is the master) and refined with ESD, one stack per
+# subswath. The stack is written to out_stack_<IW> in the stack directory
+# with stack.json describing it. A lock on the directory makes other pairs
+# wait for the stack instead of building it again.
+def build_stack(scenes, aoi, polarization, dem, stack_dir, master_date=None):
+    if not os.path.exists(stack_dir):
+        os.makedirs(stack_dir, exist_ok=True)
+    stack_file = os.path.join(stack_dir, 'stack.json')
+    with open(os.path.join(stack_dir, 'stack.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(stack_file):
+            with open(stack_file) as f:
+                stack = json.load(f)
+            missing = set(scenes) - set(stack['scenes'])
+            if not missing:
+                print('Using coregistered stack in ' + stack_dir)
+                return stack
+            print('Stack misses dates ' + ', '.join(sorted(missing)) + ', building it again...')
+
+        dates = sorted(scenes)
+        if master_date is None:
+            # The middle of the time series keeps the temporal baselines short
+            master_date = dates[(len(dates) - 1) // 2]
+        if master_date not in scenes:
+            raise ValueError("Stack master " + master_date + " is not one of the scenes: " +
+                             ', '.join(dates))
+        print('Building stack of ' + str(len(dates)) + ' scenes with master ' + master_date + '...')
+        dates.remove(master_date)
+        dates = [master_date] + dates
+
+        aoi_bursts = dict((date, get_swath_burst(scenes[date], aoi, polar=polarization))
+                          for date in dates)
+        subswaths = sorted(set(aoi_bursts[master_date]['subswath']))
+        for date in dates:
+            if sorted(set(aoi_bursts[date]['subswath'])) != subswaths:
+                raise ValueError("Subswaths intersecting the AOI do not match for " + date + ".")
+        if not subswaths:
+            raise ValueError("No subswath intersects the AOI.")
+        dem = prepare_dem(dem, (
+            min(bursts['bounds'][0] for bursts in aoi_bursts.values()),
+            min(bursts['bounds'][1] for bursts in aoi_bursts.values()),
+            max(bursts['bounds'][2] for bursts in aoi_bursts.values()),
+            max(bursts['bounds'][3] for bursts in aoi_bursts.values())
+        ))
+        orbits = dict((date, find_orbit_file(scenes[date])[0]) for date in dates)
+
+        products = dict((date, read(scenes[date])) for date in dates)
+        for IW in subswaths:
+            print('Coregistering subswath ' + IW + '...')
+            sources = jpy.array('org.esa.snap.core.datamodel.Product', len(dates))
+            multiple_bursts = False
+            for i, date in enumerate(dates):
+                bursts = bursts_in_subswath(aoi_bursts[date], IW)
+                multiple_bursts = multiple_bursts or len(bursts) > 1
+                product = topsar_split(products[date], IW, min(bursts), max(bursts), polar=polarization)
+                sources[i] = apply_orbit_file(product, orbits[date], log_dir=stack_dir)
+            product = back_geocoding(sources, dem)
+            if multiple_bursts:
+                product = enhanced_spectral_diversity(product)
+            write_BEAM_DIMAP_format(product, os.path.join(stack_dir, 'out_stack_' + IW))
+
+        stack = dict(
+            directory=stack_dir,
+            master=master_date,
+            scenes=dict((date, os.path.basename(scenes[date]).replace('.zip', '')) for date in dates),
+            subswaths=subswaths,
+            dem=dem
+        )
+        with open(stack_file, 'w') as f:
+            json.dump(stack, f, indent=2)
+    return stack
+
+
+# [P1|P2] Function to get the band names of a pair in a coregistered stack
+# Back-Geocoding names the bands of the stack i_<pol>_mst_<date> for the
+# master and i_<pol>_slv<n>_<date> for the others (same for q_), with dates
+# like 27Jan2021. Returns the master bands and the bands of the other date
+# with the names they get as the only slave of the pair.
+def stack_pair_bands(band_names, master_date, slave_date):
+    suffix_master = '_' + pd.to_datetime(master_date).strftime('%d%b%Y')
+    suffix_slave = '_' + pd.to_datetime(slave_date).strftime('%d%b%Y')
+    master_bands = [band for band in band_names
+                    if band[:2] in ['i_', 'q_'] and band.endswith(suffix_master)]
+    slave_bands = dict((band, re.sub('_slv[0-9]+_', '_slv1_', band)) for band in band_names
+                       if band[:2] in ['i_', 'q_'] and band.endswith(suffix_slave))
+    return master_bands, slave_bands
+
+
+# [P1|P2] Function to get the pair of two dates from a coregistered stack
+# The stack keeps the abstracted metadata of the other scenes in
+# Slave_Metadata, which lists the master bands in Master_bands and the bands
+# of each slave in its Slave_bands. SNAP forms interferograms between the
+# master and its slaves, and the rasters are in the geometry of the stack
+# master, which its metadata describes. So one of the dates has to be the
+# stack master (see run_P1_stack): its bands and metadata are kept, the bands
+# of the other date are renamed to its only slave (see stack_pair_bands).
+def stack_pair(stack, IW, file1, file2):
+    ids = dict((scene_id, date) for date, scene_id in stack['scenes'].items())
+    dates = [ids[os.path.basename(file1).replace('.zip', '')],
+             ids[os.path.basename(file2).replace('.zip', '')]]
+    if stack['master'] not in dates:
+        raise ValueError("Pair " + ' '.join(dates) + " does not include the stack master " +
+                         stack['master'] + ". Process it without --stack.")
+    slave_date = [date for date in dates if date != stack['master']][0]
+    product = read(os.path.join(stack['directory'], 'out_stack_' + IW + '.dim'))
+    master_bands, slave_bands = stack_pair_bands(list(product.getBandNames()),
+                                                 stack['master'], slave_date)
+    pair = band_select(product, ','.join(master_bands + sorted(slave_bands)))
+    for band, name in slave_bands.items():
+        pair.getBand(band).setName(name)
+
+    # Only the other date stays as slave
+    slave_root = pair.getMetadataRoot().getElement('Slave_Metadata')
+    slave_root.setAttributeString('Master_bands', ' '.join(master_bands))
+    for element in list(slave_root.getElements()):
+        if element.getName().startswith(stack['scenes'][slave_date]):
+            element.setAttributeString('Slave_bands', ' '.join(sorted(slave_bands.values())))
+        else:
+            slave_root.removeElement(element)
+    return pair
+
+
+# Parameters of P2-P4 that can be compared in sweep mode
+SWEEP_PARAMETERS = ['ifg_squarepixel', 'ifg_cohwin_rg', 'ifg_cohwin_az',
+                    'multilook_range', 'gpf_fftsize', 'gpf_win', 'gpf_cohmask',
+                    'gpf_cohth', 'snaphu_costmode', 'unwrapper', 'pixel_size']
+
+
+# Function to get all variants of a sweep grid
+def sweep_variants(sweep_file):
+    with open(sweep_file) as f:
+        grid = json.load(f)
+    unknown = [key for key in grid if key not in SWEEP_PARAMETERS]
+    if unknown:
+        raise ValueError("Cannot sweep " + ', '.join(unknown) + ", use any of " +
+                         ', '.join(SWEEP_PARAMETERS))
+    keys = sorted(grid)
+    variants = []
+    for values in itertools.product(*[grid[key] for key in keys]):
+        settings = dict(zip(keys, values))
+        name = '_'.join(key + '-' + str(value) for key, value in settings.items())
+        variants.append(dict(name=name, settings=settings))
+    return variants
+
+
+# Function to run one variant of a sweep
+# Settings are added to the arguments of this run, where the last value
+# of an argument counts. Arguments of type bool are true for any non-empty
+# string, so False is given as ''.
+def run_variant(variant, env):
+    variant_dir = os.path.join(output_dir, 'sweep', variant['name'])
+    if not os.path.exists(variant_dir):
+        os.makedirs(variant_dir)
+    command = [sys.executable, script_path] + sys.argv[1:] + ['--variant', variant['name']]
+    for key, value in variant['settings'].items():
+        if isinstance(value, bool):
+            value = 'True' if value else ''
+        command += ['--' + key, str(value)]
+    start = time.time()
+    with open(os.path.join(variant_dir, 'sweep.log'), 'w') as log:
+        returncode = subprocess.call(command, cwd=launch_dir, env=env,
+                                     stdout=log, stderr=subprocess.STDOUT)
+    print('Variant ' + variant['name'] + (' complete' if returncode == 0 else ' failed'))
+    return dict(returncode=returncode, wall_seconds=round(time.time() - start, 1))
+
+
+# Function to get the coherence and valid pixel statistics of a variant
+# Only pixels with elevation and coherence count (see valid_pixels).
+def variant_statistics(variant_dir, threshold):
+    with rasterio.open(os.path.join(variant_dir, date_bundle + '_coherence.tif')) as src:
+        coherence = src.read(1)
+        coh_nodata = src.nodata
+    with rasterio.open(os.path.join(variant_dir, date_bundle + '_elevation.tif')) as src:
+        elevation = src.read(1)
+        elev_nodata = src.nodata
+        pixel_size = abs(src.transform.a)
+    valid = valid_pixels(elevation, coherence, elev_nodata, coh_nodata)
+    data = coherence[valid]
+    return dict(
+        pixel_size=pixel_size,
+        pixels=elevation.size,
+        valid_elevation=round(float(data.size) / elevation.size, 4),
+        coherence_mean=round(float(data.mean()), 4) if data.size else None,
+        coherence_median=round(float(np.median(data)), 4) if data.size else None,
+        coherent_pixels=round(float((data >= threshold).sum()) / elevation.size, 4)
+    )
+
+
+# Function to run a parameter sweep from the P1 output of this pair
+# Variants run in parallel, as many as the cores and the memory planned
+# for P2-P4 allow. Each of them gets the planned heap.
+def run_sweep(sweep_file, out_dir, workers=None, threshold=0.3):
+    variants = sweep_variants(sweep_file)
+    env = dict(os.environ)
+    if workers is None:
+        workers = os.cpu_count() or 1
+        if 'resource_plan' in metrics:
+            plan = metrics['resource_plan']
+            workers = min(workers, max(1, int(0.8 * plan['memory_mb'] / plan['heap_mb'])))
+    if 'resource_plan' in metrics:
+        plan = metrics['resource_plan']
+        env['SLIDEM_RESOURCE_PLAN'] = '1'
+        env['_JAVA_OPTIONS'] = '-Xmx%dm -Dsnap.jai.tileCacheSize=%d' % (plan['heap_mb'], plan['tile_cache_mb'])
+    workers = max(1, min(workers, len(variants)))
+    print('Running ' + str(len(variants)) + ' sweep variants, ' + str(workers) + ' at a time...')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda variant: run_variant(variant, env), variants))
+
+    rows = []
+    for variant, result in zip(variants, results):
+        row = dict(variant=variant['name'])
+        row.update(variant['settings'])
+        row.update(result)
+        if result['returncode'] == 0:
+            row.update(variant_statistics(os.path.join(out_dir, 'sweep', variant['name']), threshold))
+        rows.append(row)
+    comparison = pd.DataFrame(rows)
+    if 'coherent_pixels' in comparison:
+        comparison = comparison.sort_values('coherent_pixels', ascending=False)
+    comparison.to_csv(os.path.join(out_dir, 'sweep_comparison.csv'), index=False)
+    print(comparison.to_string(index=False))
+    return comparison
+
+
+# Function to get the free disk space in GB of the volume of a path
+def free_disk(path):
+    return shutil.disk_usage(path).free / 1024 ** 3
+
+
+# Function to wait until a volume has min_free GB free
+# Space is checked every DISK_POLL_SECONDS, e.g. while other pairs finish
+# and apply their retention policy. Fails after timeout seconds, if set.
+DISK_POLL_SECONDS = 60
+
+
+def wait_for_disk(path, min_free, timeout=None):
+    start = time.time()
+    while True:
+        free = free_disk(path)
+        if free >= min_free:
+            return
+        waited = time.time() - start
+        if timeout is not None and waited >= timeout:
+            raise ValueError(
+                "Only %.1f GB free on the output volume after waiting %d s, --min_free_disk "
+                "is %.1f GB. Free some space (e.g. with --retention) before starting this pair."
+                % (free, waited, min_free))
+        print('Only %.1f GB free on the output volume, --min_free_disk is %.1f GB, waiting...'
+              % (free, min_free))
+        sleep = DISK_POLL_SECONDS
+        if timeout is not None:
+            sleep = max(0, min(sleep, timeout - waited))
+        time.sleep(sleep)
+
+
+# Function to apply the retention policy to the output directory of a pair
+# Intermediate products are the out_P* files and folders, a BEAM-DIMAP
+# product being the .dim file and its .data folder. With "compressed" each
+# product is zipped (and can be unzipped to be read again by SNAP), with
+# "final" they are deleted, after copying the reports written into them
+# (e.g. unwrapping.json of the snaphu export) to the out_dir. Returns the
+# disk space freed in MB.
+def reclaim_disk(out_dir, retention):
+    if retention == 'all':
+        return 0
+    products = {}
+    for path in glob.glob(os.path.join(out_dir, 'out_P*')):
+        if path.endswith('.zip'):
+            continue
+        name = os.path.basename(path)
+        if name.endswith('.dim') or name.endswith('.data'):
+            name = os.path.splitext(name)[0]
+        products.setdefault(name, []).append(path)
+    freed = 0
+    for name, paths in sorted(products.items()):
+        size = sum(path_size(path) for path in paths)
+        if retention == 'compressed':
+            print('Compressing ' + name + '...')
+            zip_file = os.path.join(out_dir, name + '.zip')
+            with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+                for path in paths:
+                    if os.path.isfile(path):
+                        zf.write(path, os.path.relpath(path, out_dir))
+                    for root, _, files in os.walk(path):
+                        for f in files:
+                            zf.write(os.path.join(root, f),
+                                     os.path.relpath(os.path.join(root, f), out_dir))
+            size -= os.path.getsize(zip_file)
+        else:
+            print('Removing ' + name + '...')
+            for path in paths:
+                for report in glob.glob(os.path.join(path, '*.json')):
+                    shutil.copy(report, out_dir)
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        freed += size
+    freed_mb = round(freed / 1024 ** 2, 1)
+    file = open(os.path.join(out_dir, 'log.txt'), 'a')
+    file.write('\nRETENTION (' + retention + '): ' + str(freed_mb) + ' MB freed\n')
+    file.close()
+    print('Retention (' + retention + '): ' + str(freed_mb) + ' MB freed')
+    return freed_mb
+
+
+# Function to screen a pair with a quick look of its coherence
+# The coherence is formed like in P1 and P2, but without ESD (which only
+# refines the phase), subset to the AOI right after deburst and heavily
+# multilooked. SNAP computes operators on demand, so only the AOI is
+# processed and nothing but quicklook.json is written. Pixels without data
+# (coherence 0, e.g. outside the swath) do not count for the statistics.
+def run_quicklook(file1, file2, aoi, polarization, dem, out_dir,
+                  ml_rangelooks, threshold, min_valid):
+    print('Computing quick look...')
+    aoi_bursts_1 = get_swath_burst(file1, aoi, polar=polarization)
+    aoi_bursts_2 = get_swath_burst(file2, aoi, polar=polarization)
+    subswaths = sorted(set(aoi_bursts_1['subswath']))
+    if subswaths != sorted(set(aoi_bursts_2['subswath'])) or not subswaths:
+        raise ValueError("Subswaths intersecting the AOI do not match.")
+    dem = prepare_dem(dem, (
+        min(aoi_bursts_1['bounds'][0], aoi_bursts_2['bounds'][0]), min(aoi_bursts_1['bounds'][1], aoi_bursts_2['bounds'][1]),
+        max(aoi_bursts_1['bounds'][2], aoi_bursts_2['bounds'][2]), max(aoi_bursts_1['bounds'][3], aoi_bursts_2['bounds'][3])
+    ))
+    product_1 = read(file1)
+    product_2 = read(file2)
+    debursted = []
+    for IW in subswaths:
+        product = process_subswath(product_1, product_2, IW,
+                                   bursts_in_subswath(aoi_bursts_1, IW),
+                                   bursts_in_subswath(aoi_bursts_2, IW), dem,
+                                   find_orbit_file(file1)[0], find_orbit_file(file2)[0],
+                                   esd=False)
+        product = interferogram(product, args.ifg_squarepixel,
+                                args.ifg_cohwin_rg, args.ifg_cohwin_az)
+        debursted.append(topsar_deburst(product, polar=polarization))
+    product = debursted[0] if len(debursted) == 1 else topsar_merge(debursted, polar=polarization)
+    product = subset(product, aoi, buffer=args.aoi_buffer)
+    product = multilook(product, ML_nRgLooks=ml_rangelooks)
+    coh_band = [band for band in product.getBandNames() if band.startswith('coh')][0]
+    with measure('quicklook_coherence', kind='write'):
+        coherence = read_band(product, coh_band)
+    data = coherence[np.isfinite(coherence) & (coherence > 0)]
+    valid_fraction = float((data >= threshold).sum()) / data.size if data.size else 0.0
+    quicklook = dict(
+        pair=date_bundle,
+        multilook_range=ml_rangelooks,
+        pixels=int(coherence.size),
+        data_fraction=round(float(data.size) / coherence.size, 4),
+        coherence_mean=round(float(data.mean()), 4) if data.size else None,
+        coherence_median=round(float(np.median(data)), 4) if data.size else None,
+        coherence_threshold=threshold,
+        valid_fraction=round(valid_fraction, 4),
+        min_valid=min_valid,
+        passed=valid_fraction >= min_valid
+    )
+    with open(os.path.join(out_dir, 'quicklook.json'), 'w') as f:
+        json.dump(quicklook, f, indent=2)
+    print('Quick look:', quicklook)
+    return quicklook
+
+
+# Cost model of the dry run
+# Runtime and disk use of each pipeline scale with a workload in pixels:
+# P1 with the full resolution pixels of the bursts, P2 with the pixels
+# it processes before multilooking (only the AOI with early_subset), P3 and
+# P4 with the multilooked pixels of the AOI. The defaults per pixel are
+# rough values, they are replaced by the ratios of earlier runs when their
+# metrics.json (with a workload) are found in the output_dir.
+IW_AZIMUTH_SPACING = 14.1
+DEFAULT_SECONDS_PER_PIXEL = dict(P1=2e-6, P2=1e-6, P3=3e-4, P4=1e-4)
+DISK_BYTES_PER_PIXEL = dict(P1=16, P2=16, P3=20, P4=40)
+PIPELINES = ['P1', 'P2', 'P3', 'P4']
+
+
+# Function to get the workload of a pair
+def pair_workload(file1, file2):
+    n_bursts = max(len(get_swath_burst(file1, args.aoi_path)['burst']),
+                   len(get_swath_burst(file2, args.aoi_path)['burst']))
+    area = aoi_area(args.aoi_path, args.aoi_buffer)
+    ml_range = args.multilook_range if args.multilook_toggle else 1
+    burst_pixels = n_bursts * BURST_PIXELS
+    ml_pixels = area / (IW_GROUND_RANGE_SPACING * ml_range) ** 2
+    p2_pixels = burst_pixels
+    if args.early_subset:
+        p2_pixels = min(burst_pixels, area / (IW_GROUND_RANGE_SPACING * IW_AZIMUTH_SPACING))
+    return dict(
+        n_bursts=n_bursts,
+        aoi_area_km2=round(area / 1e6, 3),
+        # azimuth looks follow from the square pixel
+        ml_factor=ml_range * max(1, ml_range * IW_GROUND_RANGE_SPACING / IW_AZIMUTH_SPACING),
+        P1=burst_pixels,
+        P2=p2_pixels,
+        P3=ml_pixels,
+        P4=ml_pixels
+    )
+
+
+# Function to get the disk footprint in MB of a pair from its workload
+def workload_disk(workload):
+    disk = dict((stage, workload[stage] * DISK_BYTES_PER_PIXEL[stage]) for stage in PIPELINES)
+    # out_P2 is written after multilooking
+    disk['P2'] = disk['P2'] / workload['ml_factor']
+    return sum(disk.values()) / 1024 ** 2
+
+
+# Function to calibrate the cost model with the metrics of earlier runs
+def calibrate_cost_model(out_dir):
+    history = []
+    for metrics_file in glob.glob(os.path.join(out_dir, 'out_*', 'metrics.json')):
+        with open(metrics_file) as f:
+            pair_metrics = json.load(f)
+        if 'workload' in pair_metrics:
+            history.append(pair_metrics)
+    seconds = dict(DEFAULT_SECONDS_PER_PIXEL)
+    for stage in PIPELINES:
+        wall = pixels = 0
+        for pair_metrics in history:
+            records = [record for record in pair_metrics['records']
+                       if record['kind'] == 'stage' and record['name'] == stage]
+            if records and pair_metrics['workload'][stage]:
+                wall += records[-1]['wall_seconds']
+                pixels += pair_metrics['workload'][stage]
+        if pixels:
+            seconds[stage] = wall / pixels
+    disk_ratios = [pair_metrics['disk_mb'] / workload_disk(pair_metrics['workload'])
+                   for pair_metrics in history if pair_metrics.get('disk_mb')]
+    # The JVM needs memory outside of its heap too
+    memory_ratios = [max(record['peak_rss_mb'] for record in pair_metrics['records']) /
+                     pair_metrics['resource_plan']['heap_mb']
+                     for pair_metrics in history if 'resource_plan' in pair_metrics]
+    return dict(
+        pairs=len(history),
+        seconds_per_pixel=seconds,
+        disk_factor=float(np.median(disk_ratios)) if disk_ratios else 1.0,
+        memory_factor=float(np.median(memory_ratios)) if memory_ratios else 1.2
+    )
+
+
+# Function to estimate runtime, memory and disk of all pairs
+# In stack mode the stack is built by the first pair of each orbit and
+# pass, sweep variants repeat P2-P4, and the retention policy decides
+# how much of the disk footprint is kept once a pair is complete.
+def run_dry_run(pairs, out_dir):
+    model = calibrate_cost_model(out_dir)
+    print('Cost model (from ' + str(model['pairs']) + ' earlier pairs):', model)
+    variants = len(sweep_variants(args.sweep)) if args.sweep else 1
+    stacks = set()
+    rows = []
+    for _, row in pairs.iterrows():
+        scenes = sorted([(pd.to_datetime(row['ReferenceDate']), row['ReferenceID']),
+                         (pd.to_datetime(row['MatchDate']), row['MatchID'])])
+        file1, file2 = [os.path.join(args.download_dir, scene + '.zip') for _, scene in scenes]
+        workload = pair_workload(file1, file2)
+        seconds = dict((stage, workload[stage] * model['seconds_per_pixel'][stage])
+                       for stage in PIPELINES)
+        if args.stack:
+            stack_key = (row['Pass'], row['Orbit'])
+            if stack_key in stacks:
+                seconds['P1'] = 0
+            else:
+                n_scenes = len(stack_scenes(pairs, row['Orbit'], row['Pass']))
+                seconds['P1'] = seconds['P1'] * n_scenes / 2
+                stacks.add(stack_key)
+        for stage in ['P2', 'P3', 'P4']:
+            seconds[stage] = seconds[stage] * variants
+        plan = plan_resources(workload['n_bursts'], workload['aoi_area_km2'] * 1e6,
+                              args.multilook_range if args.multilook_toggle else 1,
+                              max_memory=args.max_memory)
+        disk = workload_disk(workload) * model['disk_factor'] * variants
+        if args.retention == 'final':
+            kept = workload['P4'] * 16 / 1024 ** 2 * variants
+        elif args.retention == 'compressed':
+            kept = disk / 2
+        else:
+            kept = disk
+        estimate = dict(
+            pair=scenes[0][1] + '_' + scenes[1][1],
+            n_bursts=workload['n_bursts'],
+            aoi_area_km2=workload['aoi_area_km2'],
+            fits=plan['fits']
+        )
+        for stage in PIPELINES:
+            estimate[stage + '_seconds'] = int(seconds[stage])
+        estimate['total_seconds'] = int(sum(seconds.values()))
+        estimate['peak_memory_mb'] = int(plan['heap_mb'] * model['memory_factor'])
+        estimate['disk_peak_mb'] = int(disk)
+        estimate['disk_kept_mb'] = int(kept)
+        rows.append(estimate)
+    estimates = pd.DataFrame(rows)
+    estimates.to_csv(os.path.join(out_dir, 'dry_run.csv'), index=False)
+    print(estimates.to_string(index=False))
+    # Pairs one after the other: kept outputs add up, the peak of one pair comes on top
+    print('\nBatch of ' + str(len(estimates)) + ' pairs:\n' +
+          '- Runtime: %.1f h (one pair at a time)\n' % (estimates['total_seconds'].sum() / 3600) +
+          '- Peak memory: %d MB\n' % estimates['peak_memory_mb'].max() +
+          '- Disk: %.1f GB\n' % ((estimates['disk_kept_mb'].sum() +
+                                   (estimates['disk_peak_mb'] - estimates['disk_kept_mb']).max()) / 1024) +
+          '- Pairs that do not fit into memory: ' + str(int((~estimates['fits']).sum())))
+    return estimates
 
-# result.getBand('B2')
-# BandDescriptor = jpy.get_type('org.esa.snap.core.gpf.common.BandMathsOp$BandDescriptor')
-# targetBand1 = BandDescriptor()
-# targetBand1.name = 'B2'
-# targetBand1.type = 'int8'
-# **targetBand1.expression = 'if B2 <' + str(thres)+ ' then 1 else 0'**
-# targetBands = jpy.array('org.esa.snap.core.gpf.common.BandMathsOp$BandDescriptor', 1)
-# targetBands[0] = targetBand1
-# parameters = HashMap()
-# parameters.put('targetBands', targetBands)
-# result_bof = GPF.createProduct('BandMaths', parameters, result)
 
 # Pipe functions
 def run_P1(file1, file2, aoi, polarization, dem, out_dir):
@@ -543,40 +2559,45 @@ def run_P1(file1, file2, aoi, polarization, dem, out_dir):
         'Orbit: ' + str(orbit) + '\n' +
         'DEM for back-geocoding: ' + dem + '\n'
     )
-    file.close
-
-    # Apply stsa workflow
-    stsa_1 = get_swath_burst(file1, aoi, polar=polarization)
-    stsa_2 = get_swath_burst(file2, aoi, polar=polarization)
-    # Get subswath that intersects AOI
-    swath_1 = list(set(stsa_1['subswath']))
-    swath_2 = list(set(stsa_2['subswath']))
-    # TODO: Multiple subswaths are not supported but currently there is no way around it,
-    #  since the selection happens internally. The pipeline will exit with an Error, see below.
-    #  Options: ask user to input a different AOI?
-    if not len(swath_1) == len(swath_2) == 1:
-        raise ValueError("Multiple subswaths are not supported yet.")
-    # TODO: Add documentation here, subswaths should be the same because each of them is
-    #   processed separately.
+    file.close()
+
+    # Get subswaths and bursts intersecting the AOI from the burst index
+    aoi_bursts_1 = get_swath_burst(file1, aoi, polar=polarization)
+    aoi_bursts_2 = get_swath_burst(file2, aoi, polar=polarization)
+    # Get subswaths that intersect AOI
+    swath_1 = sorted(set(aoi_bursts_1['subswath']))
+    swath_2 = sorted(set(aoi_bursts_2['subswath']))
+    # Subswaths should be the same on both images because each
+    # of them is processed separately and merged afterwards (P2)
     if not swath_1 == swath_2:
         raise ValueError("Subswaths intersecting the AOI do not match.")
-    IW = swath_1[0]
-    # Get burst indices
-    burst_1 = stsa_1['burst']
-    burst_2 = stsa_2['burst']
-    firstBurstIndex_1 = min(burst_1)
-    lastBurstIndex_1 = max(burst_1)
-    firstBurstIndex_2 = min(burst_2)
-    lastBurstIndex_2 = max(burst_2)
+    if not swath_1:
+        raise ValueError("No subswath intersects the AOI.")
+    # Get the DEM covering the bursts of both images
+    dem = prepare_dem(dem, (
+        min(aoi_bursts_1['bounds'][0], aoi_bursts_2['bounds'][0]), min(aoi_bursts_1['bounds'][1], aoi_bursts_2['bounds'][1]),
+        max(aoi_bursts_1['bounds'][2], aoi_bursts_2['bounds'][2]), max(aoi_bursts_1['bounds'][3], aoi_bursts_2['bounds'][3])
+    ))
 
     # Write sub-swath and burst to log file
     file = open(os.path.join(out_dir, 'log.txt'), 'a')
+    file.write('\nAUTOMATICALLY EXTRACTED PARAMETERS IN PIPELINE 1:\n' +
+               'DEM used: ' + dem + '\n')
+    for IW in swath_1:
+        file.write(
+            'Subswath: ' + IW + '\n' +
+            'Bursts 1: ' + ','.join([str(item) for item in bursts_in_subswath(aoi_bursts_1, IW)]) + '\n' +
+            'Bursts 2: ' + ','.join([str(item) for item in bursts_in_subswath(aoi_bursts_2, IW)]) + '\n')
+    file.close()
+
+    # Get orbit files from the local orbit store
+    orbit_1, orbit_file_1 = find_orbit_file(file1)
+    orbit_2, orbit_file_2 = find_orbit_file(file2)
+    file = open(os.path.join(out_dir, 'log.txt'), 'a')
     file.write(
-        '\nAUTOMATICALLY EXTRACTED PARAMETERS IN PIPELINE 1:\n'
-        'Subswath: ' + IW + '\n' +
-        'Bursts 1: ' + ','.join([str(item) for item in burst_1]) + '\n' +
-        'Bursts 2: ' + ','.join([str(item) for item in burst_2]) + '\n')
-    file.close
+        'Orbit 1: ' + orbit_1 + ' ' + str(orbit_file_1) + '\n' +
+        'Orbit 2: ' + orbit_2 + ' ' + str(orbit_file_2) + '\n')
+    file.close()
 
     # Compute InSAR stack overview
     product_1 = read(file1)
@@ -599,31 +2620,97 @@ def run_P1(file1, file2, aoi, polarization, dem, out_dir):
             for baseline in list(baseline_metadata.getAttributeNames()):
                 file.write(f'{baseline}: {baseline_metadata.getAttributeString(baseline)}\n')
             file.write('')
-    file.close
+    file.close()
 
     # Proceed to SNAP workflow
-    product_TOPSAR_1 = topsar_split(product_1, IW,
-                                    firstBurstIndex_1, lastBurstIndex_1)
-    product_TOPSAR_2 = topsar_split(product_2,
-                                    IW, firstBurstIndex_2, lastBurstIndex_2)
-    product_orbitFile_1 = apply_orbit_file(product_TOPSAR_1)
-    product_orbitFile_2 = apply_orbit_file(product_TOPSAR_2)
-    product = back_geocoding([product_orbitFile_1, product_orbitFile_2], dem)
-    if len(burst_1) > 1 or len(burst_2) > 1:
-        product = enhanced_spectral_diversity(product)
-    out_filename = os.path.join(out_dir, 'out_P1')
-    write_BEAM_DIMAP_format(product, out_filename)
+    if len(swath_1) == 1:
+        IW = swath_1[0]
+        product = process_subswath(product_1, product_2, IW,
+                                   bursts_in_subswath(aoi_bursts_1, IW),
+                                   bursts_in_subswath(aoi_bursts_2, IW), dem,
+                                   orbit_1, orbit_2)
+        out_filename = os.path.join(out_dir, 'out_P1')
+        write_BEAM_DIMAP_format(product, out_filename)
+    else:
+        # Each subswath is processed in parallel and
+        # merged after the interferogram formation in P2
+        if args.subswath_workers == 'threads':
+            def write_subswath(IW):
+                product = process_subswath(product_1, product_2, IW,
+                                           bursts_in_subswath(aoi_bursts_1, IW),
+                                           bursts_in_subswath(aoi_bursts_2, IW), dem,
+                                           orbit_1, orbit_2)
+                write_BEAM_DIMAP_format(product, os.path.join(out_dir, 'out_P1_' + IW))
+            print('Launching threads for subswaths: ' + ', '.join(swath_1))
+            with ThreadPoolExecutor(max_workers=len(swath_1)) as executor:
+                list(executor.map(write_subswath, swath_1))
+        else:
+            run_subswath_workers(swath_1)
     print("Pipeline [P1] complete")
+    return swath_1, dem
+
+
+# P1 in stack mode, makes sure the stack with both scenes of the pair exists
+# Returns None for pairs without the stack master, which run_P1 processes.
+def run_P1_stack(file1, file2, aoi, polarization, dem, out_dir):
+    scenes = stack_scenes(productsIn, orbit, passf)
+    stack = build_stack(scenes, aoi, polarization, dem, stack_directory(polarization),
+                        master_date=args.stack_master)
+    if stack['master'] not in [ref_date_str, mat_date_str]:
+        # Interferograms of the stack are formed with its master only
+        print('Pair ' + date_bundle + ' does not include the stack master ' +
+              stack['master'] + ', processing it as a single pair.')
+        return None
+    file = open(os.path.join(out_dir, 'log.txt'), 'w')
+    file.write(
+        'USER-SETTINGS FOR PIPELINE 1 (STACK MODE):\n' +
+        'ReferenceID path: ' + file1 + '\n' +
+        'ReferenceID date: ' + ref_date + '\n' +
+        'MatchID path: ' + file2 + '\n' +
+        'MatchID date: ' + mat_date + '\n' +
+        'Polarization: ' + polarization + '\n' +
+        'Pass: ' + passf + '\n' +
+        'Orbit: ' + str(orbit) + '\n' +
+        'Stack: ' + stack['directory'] + '\n' +
+        'Stack master: ' + stack['master'] + '\n' +
+        'Stack dates: ' + ', '.join(sorted(stack['scenes'])) + '\n' +
+        'Subswaths: ' + ', '.join(stack['subswaths']) + '\n' +
+        'DEM used: ' + stack['dem'] + '\n'
+    )
+    file.close()
+    print("Pipeline [P1] complete")
+    return stack
+
+
+# Worker function for P1 when the AOI intersects multiple subswaths
+def run_P1_subswath(file1, file2, aoi, IW, polarization, dem, out_dir):
+    aoi_bursts_1 = get_swath_burst(file1, aoi, polar=polarization)
+    aoi_bursts_2 = get_swath_burst(file2, aoi, polar=polarization)
+    # DEM mosaic was already built by run_P1
+    dem = prepare_dem(dem, (
+        min(aoi_bursts_1['bounds'][0], aoi_bursts_2['bounds'][0]), min(aoi_bursts_1['bounds'][1], aoi_bursts_2['bounds'][1]),
+        max(aoi_bursts_1['bounds'][2], aoi_bursts_2['bounds'][2]), max(aoi_bursts_1['bounds'][3], aoi_bursts_2['bounds'][3])
+    ))
+    product_1 = read(file1)
+    product_2 = read(file2)
+    product = process_subswath(product_1, product_2, IW,
+                               bursts_in_subswath(aoi_bursts_1, IW),
+                               bursts_in_subswath(aoi_bursts_2, IW), dem,
+                               find_orbit_file(file1)[0], find_orbit_file(file2)[0])
+    out_filename = os.path.join(out_dir, 'out_P1_' + IW)
+    write_BEAM_DIMAP_format(product, out_filename)
+    print("Pipeline [P1] complete for subswath " + IW)
 
 
-def run_P2(out_dir, topophaseremove=False, dem=None,
+def run_P2(out_dir, subswaths=None, topophaseremove=False, dem=None,
            ifg_squarepixel=None, ifg_cohwin_rg=None,
            ifg_cohwin_az=None,
            multilooking=None, ml_rangelooks=None,
            goldsteinfiltering=None,
            gpf_fftsize=None, gpf_win=None,
            gpf_cohmask=None, gpf_cohth=None,
-           subsetting=None, aoi=None, subset_buffer=None):
+           subsetting=None, aoi=None, subset_buffer=None,
+           stack=None, p1_dir=None, early_subset_margin=None):
     # Write user settings to log file
     file = open(os.path.join(out_dir, 'log.txt'), 'a')
     file.write(
@@ -638,16 +2725,44 @@ def run_P2(out_dir, topophaseremove=False, dem=None,
         '- FFT size: ' + str(gpf_fftsize) + '\n' +
         '- Window size: ' + str(gpf_win) + '\n' +
         '- Coherence mask applied: ' + str(gpf_cohmask) + '\n' +
-        '- Coherence mask threshold: ' + str(gpf_cohth) + '\n'
+        '- Coherence mask threshold: ' + str(gpf_cohth) + '\n' +
+        'Early subset margin: ' + str(early_subset_margin) + '\n'
     )
-    file.close
-
-    # takes result from previous pipeline
-    in_filename = os.path.join(out_dir, 'out_P1')
-    product = read(in_filename + ".dim")  # reads .dim
-    product = interferogram(product,
-                            ifg_squarepixel, ifg_cohwin_rg, ifg_cohwin_az)
-    product = topsar_deburst(product)
+    file.close()
+
+    if p1_dir is None:
+        p1_dir = out_dir
+    if stack is not None:
+        # takes the pair from the coregistered stack of each subswath
+        debursted = []
+        for IW in subswaths:
+            product = stack_pair(stack, IW, file_path_1, file_path_2)
+            product = interferogram(product,
+                                    ifg_squarepixel, ifg_cohwin_rg, ifg_cohwin_az)
+            debursted.append(topsar_deburst(product))
+        product = debursted[0] if len(debursted) == 1 else topsar_merge(debursted)
+    elif subswaths is None or len(subswaths) == 1:
+        # takes result from previous pipeline
+        in_filename = os.path.join(p1_dir, 'out_P1')
+        product = read(in_filename + ".dim")  # reads .dim
+        product = interferogram(product,
+                                ifg_squarepixel, ifg_cohwin_rg, ifg_cohwin_az)
+        product = topsar_deburst(product)
+    else:
+        # takes the result of each subswath from previous pipeline
+        # and merges them once debursted
+        debursted = []
+        for IW in subswaths:
+            in_filename = os.path.join(p1_dir, 'out_P1_' + IW)
+            product = read(in_filename + ".dim")  # reads .dim
+            product = interferogram(product,
+                                    ifg_squarepixel, ifg_cohwin_rg, ifg_cohwin_az)
+            debursted.append(topsar_deburst(product))
+        product = topsar_merge(debursted)
+    if early_subset_margin is not None:
+        # Operators are computed on demand, so the steps before the subset
+        # (interferogram, deburst, merge) are only computed for the AOI
+        product = subset(product, aoi, buffer=(subset_buffer or 0) + early_subset_margin)
     if topophaseremove:
         product = topophase_removal(product, dem)
     if multilooking:
@@ -666,18 +2781,8 @@ def run_P2(out_dir, topophaseremove=False, dem=None,
 
 
 def run_P3(out_dir, tiles, cost_mode, tile_overlap_row,
-           tile_overlap_col, subset=None):
-    # Write user settings to log file
-    file = open(os.path.join(out_dir, 'log.txt'), 'a')
-    file.write(
-        '\nUSER-SETTINGS FOR PIPELINE 3:\n' +
-        'Tiles: ' + str(tiles) + '\n'
-        'Tiles overlap: row ' + str(tile_overlap_row) +
-        ', col ' + str(tile_overlap_row) + '\n'
-        'Cost mode: ' + cost_mode + '\n'
-    )
-    file.close
-
+           tile_overlap_col, nproc=None, subset=None,
+           unwrapper='snaphu', benchmark=False):
     if subset:
         # takes subset result from previous pipeline
         in_filename = os.path.join(out_dir, 'out_P2_subset')
@@ -696,14 +2801,42 @@ def run_P3(out_dir, tiles, cost_mode, tile_overlap_row,
         # product.getBand(bands[3]).setNoDataValueUsed(True)
         # product.getBand(bands[4]).setGeophysicalNoDataValue(-99999)
         # product.getBand(bands[4]).setNoDataValueUsed(True)
+    plan = plan_snaphu_tiles(
+        product.getSceneRasterWidth(), product.getSceneRasterHeight(),
+        tiles=tiles, tile_overlap_row=tile_overlap_row,
+        tile_overlap_col=tile_overlap_col, nproc=nproc
+    )
+
+    # Write user settings to log file
+    file = open(os.path.join(out_dir, 'log.txt'), 'a')
+    file.write(
+        '\nUSER-SETTINGS FOR PIPELINE 3:\n' +
+        'Tiles: ' + str(plan['tiles']) + '\n'
+        'Tiles overlap: row ' + str(plan['tile_overlap_row']) +
+        ', col ' + str(plan['tile_overlap_col']) + '\n'
+        'Processors: ' + str(plan['nproc']) + '\n'
+        'Cost mode: ' + cost_mode + '\n'
+        'Unwrapping backend: ' + unwrapper + '\n'
+    )
+    file.close()
+
     out_dir_snaphu = os.path.join(output_dir, "out_P3_snaphu")
-    snaphu_export(product, out_dir_snaphu, tiles, cost_mode,
-                  tile_overlap_row, tile_overlap_col)
-    snaphu_unwrapping(out_dir_snaphu)
+    snaphu_export(product, out_dir_snaphu, plan['tiles'], cost_mode,
+                  plan['tile_overlap_row'], plan['tile_overlap_col'],
+                  plan['nproc'])
+    info = unwrapping(out_dir_snaphu, plan, backend=unwrapper, benchmark=benchmark)
+    metrics['unwrapping'] = info
+    file = open(os.path.join(out_dir, 'log.txt'), 'a')
+    file.write('Unwrapping time: ' + str(info['total_seconds']) + ' s\n')
+    if 'seams_ok' in info:
+        file.write('Tile seams OK: ' + str(info['seams_ok']) + '\n')
+    file.close()
     print("Pipeline [P3] complete")
 
 
-def run_P4(out_dir, dem=None, subset=None, proj=None, pixel_size=None):
+def run_P4(out_dir, dem=None, subset=None, proj=None, pixel_size=None,
+           subswaths=None, geocoding_cache=None, geocoding_tolerance=5,
+           coherence_thresholds=None):
     if subset:
         #  takes subset result from previous pipeline
         in_filename = os.path.join(out_dir, 'out_P2_subset')
@@ -720,14 +2853,6 @@ def run_P4(out_dir, dem=None, subset=None, proj=None, pixel_size=None):
     elevation = phase_to_elev(product_unwrapped, dem)
     elevation.getBand('elevation').setGeophysicalNoDataValue(-99999)
     elevation.getBand('elevation').setNoDataValueUsed(True)
-    elevation_tc = terrain_correction(elevation, band='elevation',
-                                      projected=proj, pixel_size=pixel_size)
-    out_filename = os.path.join(out_dir, 'out_P4')
-    write_BEAM_DIMAP_format(elevation_tc, out_filename)
-    # Save elevation to TIFF
-    out_elev_tiff = os.path.join(out_dir, date_bundle + '_elevation.tif')
-    write_TIFF_format(elevation_tc, out_elev_tiff)
-    # Terrain correct coherence, wrapped and unwrapped phase and save to TIFF
     band_unw = list(product_unwrapped.getBandNames())
     product_unwrapped.getBand(band_unw[3]).setGeophysicalNoDataValue(-99999)
     product_unwrapped.getBand(band_unw[3]).setNoDataValueUsed(True)
@@ -735,60 +2860,219 @@ def run_P4(out_dir, dem=None, subset=None, proj=None, pixel_size=None):
     product_unwrapped.getBand(band_unw[4]).setNoDataValueUsed(True)
     product_unwrapped.getBand(band_unw[5]).setGeophysicalNoDataValue(-99999)
     product_unwrapped.getBand(band_unw[5]).setNoDataValueUsed(True)
-    coh_tc = terrain_correction(product_unwrapped, band=band_unw[4],
-                                projected=proj, pixel_size=pixel_size)
-    out_coh_tiff = os.path.join(out_dir, date_bundle + '_coherence.tif')
-    write_TIFF_format(coh_tc, out_coh_tiff)
-    wrapped_tc = terrain_correction(product_unwrapped, band=band_unw[3],
-                                    projected=proj, pixel_size=pixel_size)
-    out_w_tiff = os.path.join(out_dir, date_bundle + '_wrapped_phase.tif')
-    write_TIFF_format(wrapped_tc, out_w_tiff)
-    unwrapped_tc = terrain_correction(product_unwrapped, band=band_unw[5],
-                                      projected=proj, pixel_size=pixel_size)
-    out_unw_tiff = os.path.join(out_dir, date_bundle + '_unwrapped_phase.tif')
-    write_TIFF_format(unwrapped_tc, out_unw_tiff)
-    # TODO: save elevation filtered by coherence threshold
-    #   Probably using GDAL or rasterio
+    # Terrain correct elevation, coherence, wrapped and unwrapped phase
+    # in a single pass, so the geocoding is computed only once
+    bands = dict(
+        elevation='elevation',
+        coherence=band_unw[4],
+        wrapped_phase=band_unw[3],
+        unwrapped_phase=band_unw[5]
+    )
+    product = band_merge([band_select(elevation, 'elevation'), product_unwrapped])
+    lut = None
+    if geocoding_cache:
+        key, corners = geocoding_geometry(product, subswaths, dem, proj, pixel_size)
+        lut = load_geocoding_lut(geocoding_cache, key, corners, geocoding_tolerance)
+    if lut is not None:
+        print('Geocoding with cached lookup table ' + key + '...')
+        for name, band in bands.items():
+            out_tiff = os.path.join(out_dir, date_bundle + '_' + name + '.tif')
+            geocode_with_lut(product, band, lut, out_tiff)
+            finalize_tiff(out_tiff)
+    else:
+        product_tc = terrain_correction(product, dem, band=','.join(bands.values()),
+                                        projected=proj, pixel_size=pixel_size)
+        out_filename = os.path.join(out_dir, 'out_P4')
+        write_BEAM_DIMAP_format(product_tc, out_filename)
+        # Save each band to TIFF from the terrain corrected product
+        product_tc = read(out_filename + '.dim')
+        for name, band in bands.items():
+            out_tiff = os.path.join(out_dir, date_bundle + '_' + name + '.tif')
+            write_TIFF_format(band_select(product_tc, band), out_tiff)
+            finalize_tiff(out_tiff)
+        if geocoding_cache:
+            build_geocoding_lut(product, geocoding_cache, key, corners, dem, proj, pixel_size)
+    # Save elevation filtered by coherence thresholds
+    if coherence_thresholds:
+        stats = mask_elevation_by_coherence(
+            os.path.join(out_dir, date_bundle + '_elevation.tif'),
+            os.path.join(out_dir, date_bundle + '_coherence.tif'),
+            coherence_thresholds, out_dir
+        )
+        file = open(os.path.join(out_dir, 'log.txt'), 'a')
+        file.write('\nCOHERENCE MASKED ELEVATION IN PIPELINE 4:\n')
+        for _, row in stats.iterrows():
+            file.write('Threshold ' + str(row['threshold']) + ': ' +
+                       str(row['kept_pixels']) + ' of ' + str(row['valid_pixels']) +
+                       ' valid pixels kept\n')
+        file.close()
     print("Pipeline [P4] complete")
 
 
 # Run the workflow
-run_P1(
-    file1=file_path_1, file2=file_path_2,
-    aoi=args.aoi_path, polarization=args.polarization,
-    dem=args.dem, out_dir=output_dir
-)
-
-run_P2(
-    out_dir=output_dir,
-    ifg_squarepixel=args.ifg_squarepixel,
-    ifg_cohwin_rg=args.ifg_cohwin_rg,
-    ifg_cohwin_az=args.ifg_cohwin_az,
-    multilooking=args.multilook_toggle,
-    ml_rangelooks=args.multilook_range,
-    goldsteinfiltering=args.goldstein_toggle,
-    gpf_fftsize=args.gpf_fftsize,
-    gpf_win=args.gpf_win,
-    gpf_cohmask=args.gpf_cohmask,
-    gpf_cohth=args.gpf_cohth,
-    subsetting=args.subset_toggle,
-    aoi=args.aoi_path,
-    subset_buffer=args.aoi_buffer,
-)
-
-run_P3(
-    out_dir=output_dir,
-    tiles=args.snaphu_tiles,
-    cost_mode=args.snaphu_costmode,
-    tile_overlap_row=args.snaphu_tile_overlap_row,
-    tile_overlap_col=args.snaphu_tile_overlap_col,
-    subset=args.subset_toggle
-)
-
-run_P4(
-    out_dir=output_dir,
-    dem=args.dem,
-    proj=args.output_projected,
-    subset=args.subset_toggle,
-    pixel_size=args.pixel_size
+if args.build_burst_index:
+    for scene_id in set(productsIn['ReferenceID'].tolist() + productsIn['MatchID'].tolist()):
+        index_scene(os.path.join(args.download_dir, scene_id + '.zip'))
+    print('Burst index written to ' + args.burst_index)
+    sys.exit(0)
+
+if args.dry_run:
+    run_dry_run(productsIn, args.output_dir)
+    sys.exit(0)
+
+if args.subswath is not None:
+    # Worker for a single subswath, launched from run_P1
+    with measure('P1_' + args.subswath), host_slot('P1_' + args.subswath):
+        run_P1_subswath(
+            file1=file_path_1, file2=file_path_2,
+            aoi=args.aoi_path, IW=args.subswath,
+            polarization=args.polarization,
+            dem=args.dem, out_dir=output_dir
+        )
+    write_metrics(output_dir)
+    sys.exit(0)
+
+# Do not start a pair that could fill up the output volume
+if args.min_free_disk is not None and args.variant is None:
+    wait_for_disk(args.output_dir, args.min_free_disk, timeout=args.min_free_disk_timeout)
+
+# Size JVM heap and tile cache for this pair
+bursts_1 = get_swath_burst(file_path_1, args.aoi_path)['burst']
+bursts_2 = get_swath_burst(file_path_2, args.aoi_path)['burst']
+n_bursts = max(len(bursts_1), len(bursts_2))
+if args.stack and not os.path.exists(os.path.join(stack_directory(), 'stack.json')):
+    # All scenes of the stack are coregistered at once, the
+    # memory model counts the bursts of a pair of scenes
+    n_bursts = n_bursts * max(2, len(stack_scenes(productsIn, orbit, passf))) // 2
+resource_plan = plan_resources(
+    n_bursts,
+    aoi_area(args.aoi_path, args.aoi_buffer),
+    args.multilook_range if args.multilook_toggle else 1,
+    max_memory=args.max_memory
 )
+print('Resource plan:', resource_plan)
+if not resource_plan['fits'] and not args.ignore_memory_check:
+    raise ValueError(
+        "This pair needs about %d MB but only %d MB can be used. Use a smaller "
+        "AOI (fewer bursts), more multilooking, or --ignore_memory_check."
+        % (max(resource_plan['estimate_mb'][stage] for stage in ['P1', 'P2', 'P4']),
+           0.8 * resource_plan['memory_mb'])
+    )
+apply_resource_plan(resource_plan)
+metrics['resource_plan'] = resource_plan
+metrics['workload'] = pair_workload(file_path_1, file_path_2)
+
+if args.quicklook and args.variant is None:
+    with measure('quicklook'), host_slot('quicklook'):
+        quicklook = run_quicklook(
+            file1=file_path_1, file2=file_path_2,
+            aoi=args.aoi_path, polarization=args.polarization,
+            dem=args.dem, out_dir=output_dir,
+            ml_rangelooks=args.quicklook_multilook,
+            threshold=args.coherence_thresholds[0] if args.coherence_thresholds else 0.3,
+            min_valid=args.quicklook_min_valid
+        )
+    metrics['quicklook'] = quicklook
+    write_metrics(output_dir)
+    if not quicklook['passed']:
+        print('Pair ' + date_bundle + ' did not pass the quick look: ' +
+              str(quicklook['valid_fraction']) + ' of the AOI is coherent, ' +
+              str(args.quicklook_min_valid) + ' needed. Skipping it.')
+        sys.exit(0)
+    if args.quicklook_only:
+        sys.exit(0)
+
+if args.variant is not None:
+    # Variant of a sweep, P1 was run for the pair already
+    with open(os.path.join(p1_dir, 'p1.json')) as f:
+        p1 = json.load(f)
+    subswaths, dem, stack = p1['subswaths'], p1['dem'], p1['stack']
+    shutil.copy(os.path.join(p1_dir, 'log.txt'), os.path.join(output_dir, 'log.txt'))
+else:
+    stack = None
+    with measure('P1'), host_slot('P1'):
+        if args.stack:
+            stack = run_P1_stack(
+                file1=file_path_1, file2=file_path_2,
+                aoi=args.aoi_path, polarization=args.polarization,
+                dem=args.dem, out_dir=output_dir
+            )
+        if stack is not None:
+            subswaths, dem = stack['subswaths'], stack['dem']
+        else:
+            subswaths, dem = run_P1(
+                file1=file_path_1, file2=file_path_2,
+                aoi=args.aoi_path, polarization=args.polarization,
+                dem=args.dem, out_dir=output_dir
+            )
+    # Keep what later pipelines need to know about P1, for sweep variants
+    with open(os.path.join(output_dir, 'p1.json'), 'w') as f:
+        json.dump(dict(subswaths=subswaths, dem=dem, stack=stack), f, indent=2)
+    write_metrics(output_dir)
+
+if args.sweep is not None and args.variant is None:
+    run_sweep(args.sweep, output_dir, workers=args.sweep_workers,
+              threshold=args.coherence_thresholds[0] if args.coherence_thresholds else 0.3)
+    # Variants applied the retention policy to their own outputs
+    metrics['reclaimed_mb'] = reclaim_disk(output_dir, args.retention)
+    write_metrics(output_dir)
+    sys.exit(0)
+
+with measure('P2'), host_slot('P2'):
+    run_P2(
+        out_dir=output_dir,
+        subswaths=subswaths,
+        dem=dem,
+        ifg_squarepixel=args.ifg_squarepixel,
+        ifg_cohwin_rg=args.ifg_cohwin_rg,
+        ifg_cohwin_az=args.ifg_cohwin_az,
+        multilooking=args.multilook_toggle,
+        ml_rangelooks=args.multilook_range,
+        goldsteinfiltering=args.goldstein_toggle,
+        gpf_fftsize=args.gpf_fftsize,
+        gpf_win=args.gpf_win,
+        gpf_cohmask=args.gpf_cohmask,
+        gpf_cohth=args.gpf_cohth,
+        subsetting=args.subset_toggle,
+        aoi=args.aoi_path,
+        subset_buffer=args.aoi_buffer,
+        stack=stack,
+        p1_dir=p1_dir,
+        early_subset_margin=args.early_subset_margin if args.early_subset else None
+    )
+write_metrics(output_dir)
+
+# snaphu runs outside the JVM, with as many processors as cores
+snaphu_memory_mb = Runtime.getRuntime().maxMemory() / 1024 ** 2 + \
+    resource_plan['estimate_mb']['P3']
+with measure('P3'), host_slot('P3', cpus=args.snaphu_nproc, memory_mb=snaphu_memory_mb) as cores:
+    run_P3(
+        out_dir=output_dir,
+        tiles=args.snaphu_tiles,
+        cost_mode=args.snaphu_costmode,
+        tile_overlap_row=args.snaphu_tile_overlap_row,
+        tile_overlap_col=args.snaphu_tile_overlap_col,
+        nproc=len(cores) if cores else args.snaphu_nproc,
+        subset=args.subset_toggle,
+        unwrapper=args.unwrapper,
+        benchmark=args.unwrap_benchmark
+    )
+write_metrics(output_dir)
+
+with measure('P4'), host_slot('P4'):
+    run_P4(
+        out_dir=output_dir,
+        dem=dem,
+        proj=args.output_projected,
+        subset=args.subset_toggle,
+        pixel_size=args.pixel_size,
+        subswaths=subswaths,
+        geocoding_cache=args.geocoding_cache,
+        geocoding_tolerance=args.geocoding_cache_tolerance,
+        coherence_thresholds=args.coherence_thresholds
+    )
+write_metrics(output_dir)
+
+metrics['disk_mb'] = round(path_size(output_dir) / 1024 ** 2, 1)
+metrics['reclaimed_mb'] = reclaim_disk(output_dir, args.retention)
+write_metrics(output_dir)
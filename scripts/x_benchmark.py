@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+
+# Import modules
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import from_origin
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+from xml.etree import ElementTree
+import zipfile
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='''Benchmark the SliDEM scripts offline and compare against stored baselines.
+
+Four kinds of benchmarks are run:
+  - burst_index: synthetic SAFE-like .zip files (annotation files only) are
+    generated and indexed with 2_dem_generation.py --build_burst_index.
+  - query: 0_query_s1.py is run against a local stand-in for the ASF
+    baseline service, with a stored geographic search result.
+  - snap_subset: a synthetic two-band GeoTIFF (like the i and q bands of a
+    measurement) is read, subset to the AOI and written as BEAM-DIMAP with
+    real SNAP operators, so every run covers SNAP without downloading scenes.
+  - cases: end-to-end runs of 2_dem_generation.py with real SNAP operators,
+    as listed in a JSON file (ideally real scenes with tiny AOIs). Per-stage
+    wall time, peak memory and throughput are read from their metrics.json.
+
+Each benchmark records wall time and peak memory. Results are compared with
+a baseline JSON file, and the script exits with an error if any of them is
+slower or uses more memory than the baseline plus the tolerance.
+''',
+    epilog='''
+Versions:
+  v0.1 - 10/2026 - Offline benchmark suite''',
+    formatter_class=argparse.RawTextHelpFormatter
+)
+parser.add_argument(
+    '--work_dir',
+    type=str,
+    default='data/benchmark',
+    help='''relative path (refers to mounted volume) to the directory where
+    synthetic inputs and benchmark outputs are written'''
+)
+parser.add_argument(
+    '--cases',
+    type=str,
+    default=None,
+    help='''path to a JSON file with end-to-end cases for 2_dem_generation.py,
+    given as a list of {"name": ..., "args": [...]} objects. The args are
+    passed to the script as they are and should include --output_dir.'''
+)
+parser.add_argument(
+    '--n_scenes',
+    type=int,
+    default=20,
+    help='''Number of synthetic scenes to generate, defaults to 20'''
+)
+parser.add_argument(
+    '--baseline',
+    type=str,
+    default=None,
+    help='''path to the baseline JSON file.
+    Defaults to baseline.json in the work_dir'''
+)
+parser.add_argument(
+    '--save_baseline',
+    action='store_true',
+    help='''Store the results as the new baseline instead of comparing'''
+)
+parser.add_argument(
+    '--tolerance',
+    type=float,
+    default=0.2,
+    help='''Relative increase over the baseline that is still accepted,
+    defaults to 0.2 (20%%)'''
+)
+parser.add_argument(
+    '--snap_chain',
+    type=str,
+    nargs=3,
+    default=None,
+    metavar=('TIFF', 'AOI', 'OUTPUT'),
+    help='''Used by the snap_subset benchmark to run its SNAP chain in a
+    process of its own: read TIFF, subset it to AOI and write OUTPUT.'''
+)
+args = parser.parse_args()
+
+# Keep track of how scripts should be called before changing directory
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+launch_dir = os.getcwd()
+os.chdir('home/')
+
+if not os.path.exists(args.work_dir):
+    os.makedirs(args.work_dir)
+if args.baseline is None:
+    args.baseline = os.path.join(args.work_dir, 'baseline.json')
+
+# Synthetic scenes around a fixed location
+CENTER_LON = 13.3
+CENTER_LAT = 47.2
+BURSTS = 9
+LINES_PER_BURST = 1500
+SAMPLES = 21000
+# Synthetic measurement of MEASUREMENT_SIZE pixels a side over 0.2 degrees
+MEASUREMENT_SIZE = 4000
+
+
+# Function to get a synthetic scene ID, 12 days apart
+def scene_id(i):
+    start = pd.Timestamp('2020-06-01 05:12:30') + pd.Timedelta(days=12 * i)
+    stop = start + pd.Timedelta(seconds=27)
+    return 'S1A_IW_SLC__1SDV_' + start.strftime('%Y%m%dT%H%M%S') + '_' + \
+        stop.strftime('%Y%m%dT%H%M%S') + '_0%05d_000000_%04X' % (30000 + i, i)
+
+
+# Function to write the annotation XML of one subswath
+# Only the elements read by the burst index are included
+def annotation_xml(swath, i):
+    points = []
+    lon_0 = CENTER_LON - 1.0 + 0.8 * (swath - 1)
+    lat_0 = CENTER_LAT - 0.8 + 0.001 * i
+    for burst in range(BURSTS + 1):
+        for pixel in range(0, SAMPLES + 1, SAMPLES // 20):
+            points.append(
+                '<geolocationGridPoint><line>%d</line><pixel>%d</pixel>'
+                '<latitude>%.6f</latitude><longitude>%.6f</longitude></geolocationGridPoint>' %
+                (burst * LINES_PER_BURST, pixel, lat_0 + 0.18 * burst, lon_0 + 0.9 * pixel / SAMPLES)
+            )
+    return ('<?xml version="1.0" encoding="UTF-8"?><product>'
+            '<swathTiming><linesPerBurst>%d</linesPerBurst><samplesPerBurst>%d</samplesPerBurst>'
+            '<burstList count="%d">%s</burstList></swathTiming>'
+            '<geolocationGrid><geolocationGridPointList count="%d">%s</geolocationGridPointList>'
+            '</geolocationGrid></product>' %
+            (LINES_PER_BURST, SAMPLES, BURSTS, '<burst/>' * BURSTS, len(points), ''.join(points)))
+
+
+# Function to write synthetic SAFE-like scenes, a query result and an AOI
+def make_synthetic_inputs(work_dir, n_scenes):
+    scenes_dir = os.path.join(work_dir, 'scenes')
+    if not os.path.exists(scenes_dir):
+        os.makedirs(scenes_dir)
+    ids = [scene_id(i) for i in range(n_scenes)]
+    for i, s in enumerate(ids):
+        zip_path = os.path.join(scenes_dir, s + '.zip')
+        if os.path.exists(zip_path):
+            continue
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(s + '.SAFE/manifest.safe', '<xfdu:XFDU/>')
+            for swath in [1, 2, 3]:
+                for polar in ['vv', 'vh']:
+                    name = 's1a-iw%d-slc-%s-%s-%s-0%05d-000000-%03d' % (
+                        swath, polar, s[17:32].lower(), s[33:48].lower(), 30000 + i, swath)
+                    zf.writestr(s + '.SAFE/annotation/' + name + '.xml', annotation_xml(swath, i))
+    # Consecutive scenes form the pairs to process
+    pairs = pd.DataFrame(dict(
+        ReferenceID=ids[:-1], MatchID=ids[1:],
+        ReferenceDate=[pd.to_datetime(s[17:25]).strftime('%Y-%m-%d') for s in ids[:-1]],
+        MatchDate=[pd.to_datetime(s[17:25]).strftime('%Y-%m-%d') for s in ids[1:]],
+        Orbit=117, Pass='ASCENDING', TemporalBaseline=12, PerpendicularBaseline=150,
+        inAOInDates=True, Download=True
+    ))
+    pairs.to_csv(os.path.join(scenes_dir, 'query_result.csv'), index=False)
+    pd.DataFrame(dict(fileID=[s + '-SLC' for s in ids])).to_csv(
+        os.path.join(work_dir, 'geo_search.csv'), index=False)
+    aoi = dict(type='FeatureCollection', features=[dict(
+        type='Feature', properties={},
+        geometry=dict(type='Polygon', coordinates=[[
+            [CENTER_LON - 0.02, CENTER_LAT - 0.02], [CENTER_LON + 0.02, CENTER_LAT - 0.02],
+            [CENTER_LON + 0.02, CENTER_LAT + 0.02], [CENTER_LON - 0.02, CENTER_LAT + 0.02],
+            [CENTER_LON - 0.02, CENTER_LAT - 0.02]
+        ]])
+    )])
+    with open(os.path.join(work_dir, 'aoi.geojson'), 'w') as f:
+        json.dump(aoi, f)
+    return ids
+
+
+# Function to write a synthetic measurement as a GeoTIFF
+# Two float32 bands of noise (i and q) around the synthetic scenes
+def make_measurement_tiff(work_dir):
+    tiff = os.path.join(work_dir, 'measurement.tif')
+    if os.path.exists(tiff):
+        return tiff
+    random = np.random.RandomState(0)
+    profile = dict(
+        driver='GTiff', width=MEASUREMENT_SIZE, height=MEASUREMENT_SIZE, count=2,
+        dtype='float32', crs='EPSG:4326', tiled=True, blockxsize=512, blockysize=512,
+        transform=from_origin(CENTER_LON - 0.1, CENTER_LAT + 0.1,
+                              0.2 / MEASUREMENT_SIZE, 0.2 / MEASUREMENT_SIZE)
+    )
+    with rasterio.open(tiff, 'w', **profile) as dst:
+        for band in [1, 2]:
+            dst.write(random.normal(0, 100, (MEASUREMENT_SIZE, MEASUREMENT_SIZE))
+                      .astype('float32'), band)
+    return tiff
+
+
+# Function to read a GeoTIFF, subset it to an AOI and write it with SNAP
+# The Subset is given the AOI polygon as WKT, like 2_dem_generation.py does
+def run_snap_chain(tiff, aoi, output):
+    from snappy import ProductIO, jpy, GPF
+    HashMap = jpy.get_type('java.util.HashMap')
+    with open(aoi) as f:
+        ring = json.load(f)['features'][0]['geometry']['coordinates'][0]
+    wkt = 'POLYGON ((' + ', '.join('%f %f' % (lon, lat) for lon, lat in ring) + '))'
+    product = ProductIO.readProduct(tiff)
+    parameters = HashMap()
+    parameters.put('geoRegion', wkt)
+    parameters.put('copyMetadata', True)
+    subset = GPF.createProduct('Subset', parameters, product)
+    ProductIO.writeProduct(subset, output, 'BEAM-DIMAP')
+
+
+# Function to get the number of pixels of a BEAM-DIMAP product
+def dimap_pixels(dim_file):
+    dimensions = ElementTree.parse(dim_file).getroot().find('Raster_Dimensions')
+    return int(dimensions.find('NCOLS').text) * int(dimensions.find('NROWS').text) * \
+        int(dimensions.find('NBANDS').text)
+
+
+# Local stand-in for the ASF baseline service
+# Answers every reference scene with all synthetic scenes as matches
+def make_baseline_handler(ids):
+    class BaselineHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            reference = parse_qs(urlparse(self.path).query).get('reference', [''])[0]
+            i = [s.startswith(reference) for s in ids].index(True) if reference else 0
+            rows = ['"Granule Name","Path Number","Ascending or Descending?",'
+                    '"TemporalBaseline","PerpendicularBaseline"']
+            for j, s in enumerate(ids):
+                rows.append('"%s",117,"ASCENDING",%d,%d' % (s, 12 * (j - i), 150 + 10 * (j - i)))
+            body = '\n'.join(rows).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_POST = do_GET
+
+        def log_message(self, *log_args):
+            pass
+    return BaselineHandler
+
+
+# Function to run a script and measure its wall time and peak memory
+def run_script(script, script_args):
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(scripts_dir, script)] + script_args,
+        cwd=launch_dir, stdout=subprocess.DEVNULL
+    )
+    # wait4 gives the resource usage of this child only, the Popen
+    # object is told its return code as it did not wait itself
+    _, status, usage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    if process.returncode != 0:
+        raise ValueError(script + ' failed with ' + ' '.join(script_args))
+    return dict(
+        wall_seconds=round(time.time() - start, 3),
+        # ru_maxrss is given in kB on Linux
+        peak_rss_mb=round(usage.ru_maxrss / 1024, 1)
+    )
+
+
+# SNAP chain of the snap_subset benchmark, run by it in this script
+if args.snap_chain is not None:
+    run_snap_chain(*args.snap_chain)
+    sys.exit(0)
+
+results = {}
+ids = make_synthetic_inputs(args.work_dir, args.n_scenes)
+scenes_dir = os.path.join(args.work_dir, 'scenes')
+
+# Burst index from synthetic scenes
+print('Benchmarking burst index...')
+burst_index = os.path.join(args.work_dir, 'burst_index.gpkg')
+if os.path.exists(burst_index):
+    os.remove(burst_index)
+results['burst_index'] = run_script('2_dem_generation.py', [
+    '--download_dir', scenes_dir, '--query_result', 'query_result.csv',
+    '--output_dir', os.path.join(args.work_dir, 'out'),
+    '--aoi_path', os.path.join(args.work_dir, 'aoi.geojson'),
+    '--burst_index', burst_index, '--build_burst_index'
+])
+results['burst_index']['scenes_per_second'] = round(
+    len(ids) / results['burst_index']['wall_seconds'], 2)
+
+# Query against the local baseline service
+print('Benchmarking query...')
+server = HTTPServer(('127.0.0.1', 0), make_baseline_handler(ids))
+threading.Thread(target=server.serve_forever, daemon=True).start()
+try:
+    results['query'] = run_script('0_query_s1.py', [
+        '--download_folder', args.work_dir, '--query_result', 'query_benchmark.csv',
+        '--date_start', '2020/06/01', '--date_end', '2021/06/01',
+        '--aoi', os.path.join(args.work_dir, 'aoi.geojson'),
+        '--geo_search_csv', os.path.join(args.work_dir, 'geo_search.csv'),
+        '--baseline_url', 'http://127.0.0.1:%d/services/search/baseline' % server.server_port
+    ])
+finally:
+    server.shutdown()
+results['query']['scenes_per_second'] = round(len(ids) / results['query']['wall_seconds'], 2)
+
+# Read, Subset and Write with SNAP on a synthetic measurement
+print('Benchmarking SNAP subset...')
+snap_output = os.path.join(args.work_dir, 'snap_subset.dim')
+results['snap_subset'] = run_script('x_benchmark.py', [
+    '--work_dir', args.work_dir, '--snap_chain', make_measurement_tiff(args.work_dir),
+    os.path.join(args.work_dir, 'aoi.geojson'), snap_output
+])
+results['snap_subset']['pixels_per_second'] = round(
+    dimap_pixels(snap_output) / results['snap_subset']['wall_seconds'], 1)
+
+# End-to-end cases with SNAP
+if args.cases is not None:
+    with open(args.cases) as f:
+        cases = json.load(f)
+    for case in cases:
+        print('Benchmarking case ' + case['name'] + '...')
+        results[case['name']] = run_script('2_dem_generation.py', case['args'])
+        output_dir = case['args'][case['args'].index('--output_dir') + 1]
+        metrics_files = sorted(
+            [os.path.join(root, f) for root, _, files in os.walk(output_dir)
+             for f in files if f == 'metrics.json'],
+            key=os.path.getmtime
+        )
+        with open(metrics_files[-1]) as f:
+            metrics = json.load(f)
+        pixels = sum(r.get('width', 0) * r.get('height', 0)
+                     for r in metrics['records'] if r['kind'] == 'write')
+        for record in metrics['records']:
+            if record['kind'] == 'stage':
+                results[case['name'] + '_' + record['name']] = dict(
+                    wall_seconds=record['wall_seconds'],
+                    peak_rss_mb=record['peak_rss_mb']
+                )
+        results[case['name']]['pixels_per_second'] = round(
+            pixels / results[case['name']]['wall_seconds'], 1)
+
+# Store or compare with the baseline
+if args.save_baseline or not os.path.exists(args.baseline):
+    with open(args.baseline, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Baseline written to ' + args.baseline)
+    sys.exit(0)
+
+with open(args.baseline) as f:
+    baseline = json.load(f)
+# Benchmarks added since the baseline was stored start their own baseline
+missing = [name for name in results if name not in baseline]
+if missing:
+    baseline.update((name, results[name]) for name in missing)
+    with open(args.baseline, 'w') as f:
+        json.dump(baseline, f, indent=2)
+    print('Baseline of ' + ', '.join(missing) + ' added to ' + args.baseline)
+rows = []
+for name, result in results.items():
+    for metric, value in result.items():
+        reference = baseline.get(name, {}).get(metric)
+        if reference is None or reference == 0:
+            continue
+        # Rates should not decrease, times and memory should not increase
+        if metric.endswith('_per_second'):
+            regression = value < reference * (1 - args.tolerance)
+        else:
+            regression = value > reference * (1 + args.tolerance)
+        rows.append(dict(benchmark=name, metric=metric, baseline=reference,
+                         current=value, change=round(value / reference - 1, 3),
+                         regression=regression))
+comparison = pd.DataFrame(rows)
+comparison.to_csv(os.path.join(args.work_dir, 'benchmark_comparison.csv'), index=False)
+print(comparison.to_string(index=False))
+if comparison['regression'].any():
+    print('Performance regression found!')
+    sys.exit(1)
+print('No performance regression found.')
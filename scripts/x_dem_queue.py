@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+# Import modules
+import argparse
+import os
+import pandas as pd
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='''Process the pairs of a query result on several machines.
+The pairs with Download=True are put into a job queue, a SQLite database
+on storage shared by all machines. Each machine then runs one or more
+workers, which claim the next pair from the queue and process it with
+2_dem_generation.py --pair_index. Adding a machine only needs a worker
+to be started on it.
+
+Commands:
+  init    add all pairs of the query result to the queue (again)
+  worker  claim and process pairs until the queue is empty
+  status  print the state of all pairs in the queue
+
+A worker holds a lease on its pair and renews it while the pair is
+processed (heartbeat). If a worker or its machine dies, the lease expires
+and another worker takes the pair over. Failed pairs are retried until
+--max_attempts is reached.
+
+Arguments not listed here are passed to 2_dem_generation.py, e.g.
+  python3.6 home/scripts/x_dem_queue.py worker --download_dir data/s1/ \\
+    --output_dir data/results/ --query_result s1_scenes.csv \\
+    --aoi_path data/aoi/alta.geojson --stack
+''',
+    epilog='''
+Versions:
+  v0.1 - 10/2026 - Job queue for distributed pair processing''',
+    formatter_class=argparse.RawTextHelpFormatter
+)
+parser.add_argument(
+    'command',
+    type=str,
+    choices=['init', 'worker', 'status'],
+    help='''what to do with the queue, see above'''
+)
+parser.add_argument(
+    '--download_dir',
+    type=str,
+    default='data',
+    help='''relative path (refers to mounted volume) to the directory
+    where S1 scenes were downloaded'''
+)
+parser.add_argument(
+    '--output_dir',
+    type=str,
+    default='data',
+    help='''relative path (refers to mounted volume) to the directory where
+    results should be written into'''
+)
+parser.add_argument(
+    '--query_result',
+    type=str,
+    help='''path to the CSV file with query results from 0_query_s1.py.
+    Should be located in the specified download_dir, and should have been
+    edited to set Download=True where relevant.'''
+)
+parser.add_argument(
+    '--queue',
+    type=str,
+    default=None,
+    help='''path to the SQLite queue on shared storage,
+    defaults to dem_queue.sqlite in the output_dir'''
+)
+parser.add_argument(
+    '--lease',
+    type=int,
+    default=300,
+    help='''Seconds a claimed pair stays with a worker without heartbeat,
+    defaults to 300. The lease is renewed every third of it.'''
+)
+parser.add_argument(
+    '--max_attempts',
+    type=int,
+    default=3,
+    help='''How often a pair is tried before it is marked as failed, defaults to 3'''
+)
+parser.add_argument(
+    '--wait',
+    action='store_true',
+    help='''Keep the worker waiting for new pairs when the queue is empty,
+    instead of exiting once all pairs are done or failed'''
+)
+parser.add_argument(
+    '--min_free_disk',
+    type=float,
+    default=None,
+    help='''Free disk space in GB that must be left on the output volume.
+    Below it, the worker waits before claiming its next pair (and the
+    value is passed on to 2_dem_generation.py).'''
+)
+parser.add_argument(
+    '--poll',
+    type=int,
+    default=30,
+    help='''Seconds between queue checks while waiting for pairs, defaults to 30'''
+)
+args, dem_generation_args = parser.parse_known_args()
+if args.min_free_disk is not None:
+    dem_generation_args += ['--min_free_disk', str(args.min_free_disk)]
+
+# Keep track of how scripts should be called before changing directory
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+launch_dir = os.getcwd()
+os.chdir('home/')
+
+if args.queue is None:
+    args.queue = os.path.join(args.output_dir, 'dem_queue.sqlite')
+worker_id = socket.gethostname() + ':' + str(os.getpid())
+
+
+# Function to connect to the queue
+# Write transactions wait for each other, which is what makes claiming
+# a pair safe between workers. SQLite relies on the file locks of the
+# shared storage for this (NFS needs working locks, e.g. lockd).
+def connect(queue=args.queue):
+    connection = sqlite3.connect(queue, timeout=120, isolation_level=None)
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            pair TEXT PRIMARY KEY,
+            pair_index INTEGER,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            worker TEXT,
+            lease_until REAL,
+            started REAL,
+            finished REAL,
+            last_error TEXT
+        )''')
+    return connection
+
+
+# Function to add the pairs of the query result to the queue
+# Pairs already in the queue keep their state, except that
+# failed pairs get queued again.
+def init_queue(connection):
+    products = pd.read_csv(
+        os.path.join(args.download_dir, args.query_result),
+        sep=None, engine='python'
+    )
+    productsIn = products[products['Download']].reset_index(drop=True)
+    connection.execute('BEGIN IMMEDIATE')
+    for pair_index, row in productsIn.iterrows():
+        pair = row['ReferenceID'] + '_' + row['MatchID']
+        connection.execute(
+            "INSERT OR IGNORE INTO jobs (pair, pair_index, status) VALUES (?, ?, 'pending')",
+            (pair, int(pair_index)))
+        connection.execute(
+            "UPDATE jobs SET status = 'pending', attempts = 0, pair_index = ? "
+            "WHERE pair = ? AND status = 'failed'", (int(pair_index), pair))
+    connection.execute('COMMIT')
+    print(str(len(productsIn)) + ' pairs in queue ' + args.queue)
+
+
+# Function to claim the next pair
+# Pending pairs come first, then pairs whose worker stopped renewing
+# its lease. Returns None when there is nothing to claim.
+def claim(connection):
+    now = time.time()
+    connection.execute('BEGIN IMMEDIATE')
+    job = connection.execute(
+        "SELECT pair, pair_index, attempts FROM jobs "
+        "WHERE status = 'pending' OR (status = 'running' AND lease_until < ?) "
+        "ORDER BY status, pair_index LIMIT 1", (now,)).fetchone()
+    if job is None:
+        connection.execute('COMMIT')
+        return None
+    pair, pair_index, attempts = job
+    if attempts >= args.max_attempts:
+        # Worker died on its last attempt
+        connection.execute(
+            "UPDATE jobs SET status = 'failed', finished = ?, "
+            "last_error = 'lease expired on worker ' || worker WHERE pair = ?", (now, pair))
+        connection.execute('COMMIT')
+        return claim(connection)
+    connection.execute(
+        "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, "
+        "lease_until = ?, started = ? WHERE pair = ?",
+        (worker_id, now + args.lease, now, pair))
+    connection.execute('COMMIT')
+    return dict(pair=pair, pair_index=pair_index, attempt=attempts + 1)
+
+
+# Function to renew the lease of a pair while it is processed
+# Runs on its own thread (and connection) until stop is set.
+def heartbeat(pair, stop):
+    connection = connect()
+    while not stop.wait(args.lease / 3):
+        connection.execute(
+            "UPDATE jobs SET lease_until = ? WHERE pair = ? AND worker = ?",
+            (time.time() + args.lease, pair, worker_id))
+    connection.close()
+
+
+# Function to record the result of a pair
+# Failed pairs go back to the queue until max_attempts is reached.
+def finish(connection, job, returncode, error):
+    if returncode == 0:
+        status = 'done'
+    elif job['attempt'] < args.max_attempts:
+        status = 'pending'
+    else:
+        status = 'failed'
+    connection.execute(
+        "UPDATE jobs SET status = ?, finished = ?, last_error = ?, lease_until = NULL "
+        "WHERE pair = ? AND worker = ?",
+        (status, time.time(), error, job['pair'], worker_id))
+    return status
+
+
+# Function to process one pair with 2_dem_generation.py
+# The last lines of the output are kept as error message.
+def process_pair(job):
+    command = [sys.executable, os.path.join(scripts_dir, '2_dem_generation.py'),
+               '--download_dir', args.download_dir,
+               '--output_dir', args.output_dir,
+               '--query_result', args.query_result,
+               '--pair_index', str(job['pair_index'])] + dem_generation_args
+    log_file = os.path.join(args.output_dir, 'queue_' + job['pair'] + '.log')
+    with open(log_file, 'a') as log:
+        log.write('\n### ' + worker_id + ', attempt ' + str(job['attempt']) + '\n')
+        log.flush()
+        returncode = subprocess.call(command, cwd=launch_dir, stdout=log, stderr=subprocess.STDOUT)
+    error = None
+    if returncode != 0:
+        with open(log_file) as log:
+            error = ''.join(log.readlines()[-5:])
+    return returncode, error
+
+
+# Function to wait until the output volume has enough free space
+def wait_for_disk():
+    while args.min_free_disk is not None:
+        free = shutil.disk_usage(args.output_dir).free / 1024 ** 3
+        if free >= args.min_free_disk:
+            return
+        print('Only %.1f GB free on the output volume, waiting...' % free)
+        time.sleep(args.poll)
+
+
+# Function to run a worker
+def run_worker(connection):
+    processed = 0
+    while True:
+        wait_for_disk()
+        job = claim(connection)
+        if job is None:
+            running = connection.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'running'").fetchone()[0]
+            # Other workers may still fail and requeue their pairs
+            if running == 0 and not args.wait:
+                break
+            time.sleep(args.poll)
+            continue
+        print('Processing pair ' + job['pair'] + ' (index ' + str(job['pair_index']) +
+              ', attempt ' + str(job['attempt']) + ')...')
+        stop = threading.Event()
+        beat = threading.Thread(target=heartbeat, args=(job['pair'], stop))
+        beat.daemon = True
+        beat.start()
+        try:
+            returncode, error = process_pair(job)
+        finally:
+            stop.set()
+            beat.join()
+        status = finish(connection, job, returncode, error)
+        print('Pair ' + job['pair'] + ': ' + status)
+        processed += 1
+    print('Queue is empty, ' + str(processed) + ' pairs processed by ' + worker_id)
+
+
+# Function to print the state of the queue
+def print_status(connection):
+    jobs = pd.read_sql_query("SELECT * FROM jobs ORDER BY pair_index", connection)
+    now = time.time()
+    jobs.loc[(jobs['status'] == 'running') & (jobs['lease_until'] < now), 'status'] = 'expired'
+    for column in ['started', 'finished']:
+        jobs[column] = pd.to_datetime(jobs[column], unit='s').dt.strftime('%Y-%m-%d %H:%M')
+    print(jobs.groupby('status').size().to_string())
+    print()
+    print(jobs[['pair_index', 'pair', 'status', 'attempts', 'worker', 'started', 'finished']]
+          .to_string(index=False))
+    failed = jobs[jobs['status'] == 'failed']
+    for _, job in failed.iterrows():
+        print('\nLast error of ' + job['pair'] + ':\n' + str(job['last_error']))
+
+
+connection = connect()
+if args.command == 'init':
+    init_queue(connection)
+elif args.command == 'worker':
+    run_worker(connection)
+else:
+    print_status(connection)
+connection.close()
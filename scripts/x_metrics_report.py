@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# Import modules
+import argparse
+import glob
+import json
+import os
+import pandas as pd
+
+# Arguments
+parser = argparse.ArgumentParser(
+    description='''Aggregate the performance metrics of a batch of pairs.
+2_dem_generation.py writes a metrics.json file to each out_<dates> directory,
+with wall time, CPU time, peak memory, JVM heap, bytes read and written and
+output sizes per pipeline (stage), SNAP operator and written product.
+
+This script collects them for all pairs in the output directory and writes
+one CSV row per pair and record, plus a summary per stage across the batch.
+''',
+    epilog='''
+Versions:
+  v0.1 - 10/2026 - Aggregate per-pair performance metrics''',
+    formatter_class=argparse.RawTextHelpFormatter
+)
+parser.add_argument(
+    '--output_dir',
+    type=str,
+    default='data',
+    help='''relative path (refers to mounted volume) to the directory where
+    the results of 2_dem_generation.py were written into'''
+)
+parser.add_argument(
+    '--report',
+    type=str,
+    default='metrics_batch.csv',
+    help='''name of the CSV file with all records, written to the output_dir.
+    The summary per stage is written next to it with a _summary suffix.'''
+)
+args = parser.parse_args()
+
+os.chdir('home/')
+
+# Collect metrics of all pairs (and subswath workers)
+records = []
+for metrics_file in sorted(glob.glob(os.path.join(args.output_dir, 'out_*', 'metrics*.json'))):
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    for record in metrics['records']:
+        record['pair'] = metrics['pair']
+        record['subswath'] = metrics.get('subswath')
+        records.append(record)
+
+if not records:
+    raise ValueError("No metrics found in " + args.output_dir)
+
+records_df = pd.DataFrame(records)
+records_df.to_csv(os.path.join(args.output_dir, args.report), index=False)
+
+# Summary of the pipelines across all pairs
+stages_df = records_df[records_df['kind'] == 'stage']
+summary_df = stages_df.groupby('name').agg(
+    pairs=('pair', 'nunique'),
+    wall_seconds_mean=('wall_seconds', 'mean'),
+    wall_seconds_max=('wall_seconds', 'max'),
+    cpu_seconds_mean=('cpu_seconds', 'mean'),
+    peak_rss_mb_max=('peak_rss_mb', 'max'),
+    jvm_heap_used_mb_max=('jvm_heap_used_mb', 'max'),
+    written_mb_sum=('written_mb', 'sum')
+)
+summary_file = os.path.splitext(args.report)[0] + '_summary.csv'
+summary_df.to_csv(os.path.join(args.output_dir, summary_file))
+
+print(summary_df.to_string())
+print("\nSlowest SNAP writes:")
+writes_df = records_df[records_df['kind'] == 'write']
+print(writes_df.sort_values('wall_seconds', ascending=False)
+      [['pair', 'name', 'wall_seconds', 'output_mb']].head(10).to_string(index=False))
+print("Metrics of " + str(records_df['pair'].nunique()) + " pairs written to " +
+      os.path.join(args.output_dir, args.report))
@@ -1,229 +1,287 @@
-import os.path
+# -*- coding: utf-8 -*-
+
+# Import modules
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import os
+import pandas as pd
+import time
 
 import xdem
 import geoutils as gu
 
-# reference_dem = xdem.DEM("home/data/ref_dem/NDH_Alta_2pkt_2018_DTM.tif")
-# reference_dem = xdem.DEM("home/data/ref_dem/dgm5m_con.tif")
-reference_dem = xdem.DEM("home/data/ref_dem/dgm_50413_1m_32633.tif")
-# reference_dem = xdem.DEM("home/data/ref_dem/dgm_50413.tif")
-# reference_dem = xdem.DEM("home/data/ref_dem/Gjerdrum_Ullensaker_Nannestad_5pkt_DTM_2020_subset.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/ref_dem/AltaLandslide_UAV_DTM_EPSG25835_50cm.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/ref_dem/Huttschlag_Austria_UAV_Oct2021_DTM_1m_clipped.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_kleinarl/pre_event_2017/out_P4.data/elevation_VV_20170706_0718.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_grossarl/pre_event_201808/out_P4.data/elevation_VV_20180830_0905.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_grossarl/pos_event_201908/out_P4.data/elevation_VV_20190801_0807.tif")
-# dem_to_be_aligned = xdem.DEM(
-#     "home/data/tests/test_pipes_grossarl/pos_event_201907/out_P4.data/elevation_VV_20190726_0801.tif")
-# dem_to_be_aligned = xdem.DEM(
-#     "home/data/tests/test_pipes_grossarl/pos_event_202006_07_08/elevation_VV_20200608_0813.tif")
-# dem_to_be_aligned = xdem.DEM(
-#     "home/data/tests/test_pipes_grossarl/out_20200712_20200730/elevation_VV_20200712_0730.tif")
-# dem_to_be_aligned = xdem.DEM(
-#     "home/data/tests/test_pipes_grossarl/out_20200712_20200730/coreg/elevation_VV_20200712_0730_dgm1m_coreg_deramp3_aoi.tif"
-# )
-# dem_to_be_aligned = xdem.DEM(
-#     "home/data/tests/test_pipes_grossarl/pre_event_201808/out_P4.data/coreg/elevation_VV_20180830_0905_dgm1m_coreg_deramp3_aoi.tif"
-# )
-# dem_to_be_aligned = xdem.DEM(
-#     "home/data/tests/test_pipes_grossarl/out_20170624_20170718/coreg_2/elevation_VV_20170624_0718_dgm1m_coreg_deramp3_aoi.tif"
-# )
-dem_to_be_aligned = xdem.DEM(
-    'home/data/tests/test_pipes_grossarl/pos_event_202006_07_08/coreg/elevation_VV_20200720_0825_dgm1m_coreg_deramp3_Aoi.tif'
-)
-# dem_to_be_aligned = xdem.DEM(
-#     "home/data/tests/test_pipes_grossarl/out_20170624_20170718/elevation_VV_20170624_0718.tif"
-# )
-# dem_to_be_aligned = xdem.DEM(
-#     "home/data/tests/test_pipes_grossarl/pos_event_202006_07_08/elevation_VV_20200720_0825.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_grossarl/pos_event_202006/elevation_VV_20200602_0813.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_alta/pre_event_201906/elevation_VV_20190612_0618.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_alta/pos_event_202006/elevation_VV_20200605_0729.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_alta/pos_event_202006_08/elevation_VV_20200605_0810.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_gjerdrum/pos_event_202106_1/elevation_20210603_0609.tif", bands=1)
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_gjerdrum/pos_event_202106_07/elevation_20210604_0710.tif", bands=1)
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_gjerdrum/pre_event_202008/out_P4.data/elevation_vv.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_gjerdrum/pre_event_202008_1/out_P4.data/elevation_vv.tif")
-# dem_to_be_aligned = xdem.DEM("home/data/tests/test_pipes_gjerdrum/pre_event_202008_2/elevation_20200825_0831.tif")
-
-# Assign no data value if needed
-# dem_to_be_aligned.set_ndv(-9999)
-# Reproject reference dem to dem to be aligned
-reference_dem = reference_dem.reproject(dem_to_be_aligned)
-
-# set unstable areas
-# landslide = gu.Vector("home/data/ref_dem/Alta_unstable_area.shp")
-# landslide = gu.Vector("home/data/ref_dem/gjerdrum_unstable_area.gpkg")
-landslide = gu.Vector("home/data/ref_dem/arl_unstable_area.gpkg")
-
-# Create a stable ground mask (not slided) to mark "inlier data"
-inlier_mask = ~landslide.create_mask(reference_dem)
-
-# Set-up coregistration
-nuth_kaab = xdem.coreg.NuthKaab()
-nuth_kaab.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_nk = nuth_kaab.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-deramp = xdem.coreg.Deramp(degree=1)
-deramp.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_deramp = deramp.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-deramp2 = xdem.coreg.Deramp(degree=2)
-deramp2.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_deramp2 = deramp2.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-deramp3 = xdem.coreg.Deramp(degree=3)
-deramp3.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_deramp3 = deramp3.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-icp = xdem.coreg.ICP()
-icp.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_icp = icp.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-biascorr = xdem.coreg.BiasCorr()
-biascorr.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_biascorr = biascorr.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-pipeline_1 = nuth_kaab + deramp
-pipeline_1.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_pipeline_1 = pipeline_1.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-pipeline_2 = icp + nuth_kaab
-pipeline_2.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_pipeline_2 = pipeline_2.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-pipeline_3 = biascorr + icp + nuth_kaab
-pipeline_3.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_pipeline_3 = pipeline_3.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-pipeline_4 = biascorr + nuth_kaab
-pipeline_4.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_pipeline_4 = pipeline_4.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-pipeline_5 = deramp + nuth_kaab
-pipeline_5.fit(reference_dem.data, dem_to_be_aligned.data, inlier_mask=inlier_mask, transform=reference_dem.transform)
-aligned_dem_data_pipeline_5 = pipeline_5.apply(dem_to_be_aligned.data, transform=dem_to_be_aligned.transform)
-
-# DEM of differences pre-coregistration
-ddem_before = reference_dem.data - dem_to_be_aligned.data
-
-# DEM of differences post-coregistration
-ddem_after_nk = reference_dem.data - aligned_dem_data_nk
-ddem_after_deramp = reference_dem.data - aligned_dem_data_deramp
-ddem_after_deramp2 = reference_dem.data - aligned_dem_data_deramp2
-ddem_after_deramp3 = reference_dem.data - aligned_dem_data_deramp3
-ddem_after_icp = reference_dem.data - aligned_dem_data_icp
-ddem_after_biascorr = reference_dem.data - aligned_dem_data_biascorr
-ddem_after_p1 = reference_dem.data - aligned_dem_data_pipeline_1
-ddem_after_p2 = reference_dem.data - aligned_dem_data_pipeline_2
-ddem_after_p3 = reference_dem.data - aligned_dem_data_pipeline_3
-ddem_after_p4 = reference_dem.data - aligned_dem_data_pipeline_4
-ddem_after_p5 = reference_dem.data - aligned_dem_data_pipeline_5
-
-e1 = f"Error before: {xdem.spatialstats.nmad(ddem_before):.2f} m"
-e2 = f"Error after Nuth-Kaab: {xdem.spatialstats.nmad(ddem_after_nk):.2f} m"
-e3 = f"Error after Deramping (deg1): {xdem.spatialstats.nmad(ddem_after_deramp):.2f} m"
-e4 = f"Error after Deramping (deg2): {xdem.spatialstats.nmad(ddem_after_deramp2):.2f} m"
-e5 = f"Error after Deramping (deg3): {xdem.spatialstats.nmad(ddem_after_deramp3):.2f} m"
-e6 = f"Error after ICP: {xdem.spatialstats.nmad(ddem_after_icp):.2f} m"
-e7 = f"Error after Bias Correction: {xdem.spatialstats.nmad(ddem_after_biascorr):.2f} m"
-e8 = f"Error after P1 - Nuth-Kaab+Deramp (deg1): {xdem.spatialstats.nmad(ddem_after_p1):.2f} m"
-e9 = f"Error after P2 - ICP+Nuth-Kaab: {xdem.spatialstats.nmad(ddem_after_p2):.2f} m"
-e10 = f"Error after P3 - Bias Correction+ICP+Nuth-Kaab: {xdem.spatialstats.nmad(ddem_after_p3):.2f} m"
-e11 = f"Error after P4 - Bias Correction+Nuth-Kaab: {xdem.spatialstats.nmad(ddem_after_p4):.2f} m"
-e12 = f"Error after P5 - Deramp (deg1)+Nuth-Kaab: {xdem.spatialstats.nmad(ddem_after_p5):.2f} m"
-
-# Export
-aligned_dem_nk = xdem.DEM.from_array(
-    aligned_dem_data_nk,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
-)
-aligned_dem_deramp = xdem.DEM.from_array(
-    aligned_dem_data_deramp,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
-)
-aligned_dem_deramp2 = xdem.DEM.from_array(
-    aligned_dem_data_deramp2,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
+# Arguments
+parser = argparse.ArgumentParser(
+    description='''Compare coregistration methods of xdem for a generated DEM.
+The DEM to be aligned is coregistered to a reference DEM with each method
+and pipeline (several methods one after the other) listed below, on the
+stable ground outside the unstable area. The NMAD of the DEM of differences
+before and after coregistration is reported for each of them.
+
+Methods and pipelines run in parallel worker processes, which read the
+reference and the DEM to be aligned from shared memory. Methods and
+pipelines that start with the same steps share them: each step is fitted
+once for a given input and reused by all pipelines that start with it.
+Results are written to coregistration_results.csv (and readme.txt) in
+the out_dir.
+
+Methods:
+  nuth_kaab, deramp (degree 1), deramp2, deramp3, icp, biascorr
+Pipelines:
+  p1: nuth_kaab + deramp
+  p2: icp + nuth_kaab
+  p3: biascorr + icp + nuth_kaab
+  p4: biascorr + nuth_kaab
+  p5: deramp + nuth_kaab
+''',
+    epilog='''
+Versions:
+  v0.1 - 10/2026 - Parallel comparison of coregistration methods
+  v0.2 - 10/2026 - Reuse fitted steps shared by pipelines''',
+    formatter_class=argparse.RawTextHelpFormatter
 )
-aligned_dem_deramp3 = xdem.DEM.from_array(
-    aligned_dem_data_deramp3,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
+parser.add_argument(
+    '--reference_dem',
+    type=str,
+    help='''path to the reference DEM, e.g. home/data/ref_dem/dgm_50413_1m_32633.tif'''
 )
-aligned_dem_icp = xdem.DEM.from_array(
-    aligned_dem_data_icp,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
+parser.add_argument(
+    '--dem',
+    type=str,
+    help='''path to the DEM to be aligned, e.g. the elevation GeoTIFF of 2_dem_generation.py'''
 )
-aligned_dem_biascorr = xdem.DEM.from_array(
-    aligned_dem_data_biascorr,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
+parser.add_argument(
+    '--unstable_area',
+    type=str,
+    default=None,
+    help='''path to a vector file with the unstable area (e.g. the landslide),
+    which is left out when fitting. By default all pixels are used.'''
 )
-aligned_dem_p1 = xdem.DEM.from_array(
-    aligned_dem_data_pipeline_1,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
+parser.add_argument(
+    '--out_dir',
+    type=str,
+    help='''path to the directory where results are written into'''
 )
-aligned_dem_p2 = xdem.DEM.from_array(
-    aligned_dem_data_pipeline_2,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
+parser.add_argument(
+    '--ref_dem_alias',
+    type=str,
+    default='dgm1m',
+    help='''short name of the reference DEM used in the names of
+    the aligned DEMs, defaults to dgm1m'''
 )
-aligned_dem_p3 = xdem.DEM.from_array(
-    aligned_dem_data_pipeline_3,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
+parser.add_argument(
+    '--methods',
+    type=str,
+    nargs='*',
+    default=None,
+    help='''methods and pipelines to compare, defaults to all of them'''
 )
-aligned_dem_p4 = xdem.DEM.from_array(
-    aligned_dem_data_pipeline_4,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
+parser.add_argument(
+    '--save_dems',
+    action='store_true',
+    help='''Save the aligned DEM of each method to the out_dir'''
 )
-aligned_dem_p5 = xdem.DEM.from_array(
-    aligned_dem_data_pipeline_5,
-    transform=dem_to_be_aligned.transform,
-    crs=dem_to_be_aligned.crs,
-    nodata=-9999
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=None,
+    help='''Number of worker processes, defaults to the number of cores'''
 )
-aligned_dem_ref_name = dem_to_be_aligned.filename.split("/")[-1].split(".")[0]
-
-# out_dir = "home/data/tests/test_pipes_alta/pre_event_201906/coreg"
-# out_dir = "home/data/tests/test_pipes_grossarl/pre_event_201808/out_P4.data/coreg"
-# out_dir = "home/data/tests/test_pipes_grossarl/pos_event_201907/out_P4.data/coreg"
-# out_dir = "home/data/tests/test_pipes_grossarl/pos_event_202006_07_08/coreg"
-out_dir = "home/data/tests/test_pipes_grossarl/errors"
-# out_dir = "home/data/tests/test_pipes_grossarl/out_20170624_20170718/coreg"
-# out_dir = "home/data/ref_dem/coreg/huettschlag_uav/"
-# ref_dem_alias = 'ndh50cm'
-ref_dem_alias = 'dgm1m'
-
-# aligned_dem_nk.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_nk.tif'))
-# aligned_dem_deramp.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_deramp.tif'))
-# aligned_dem_deramp2.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_deramp2.tif'))
-# aligned_dem_deramp3.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_deramp3.tif'))
-# aligned_dem_icp.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_icp.tif'))
-# aligned_dem_biascorr.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_biascorr.tif'))
-# aligned_dem_p2.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_p2.tif'))
-# aligned_dem_p3.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_p3.tif'))
-# aligned_dem_p4.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_p4.tif'))
-# aligned_dem_p1.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_p1.tif'))
-# aligned_dem_p5.save(os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias + '_coreg_p5.tif'))
-
-errors = [e1, e2, e3, e4, e5, e6, e7, e8, e9, e10, e11, e12]
-with open(os.path.join(out_dir, 'readme.txt'), 'w') as f:
-    f.writelines('\n'.join(errors))
+args = parser.parse_args()
+
+# Coregistration methods, by name: description, xdem.coreg class and parameters
+METHODS = {
+    'nuth_kaab': ('Nuth-Kaab', 'NuthKaab', {}),
+    'deramp': ('Deramping (deg1)', 'Deramp', dict(degree=1)),
+    'deramp2': ('Deramping (deg2)', 'Deramp', dict(degree=2)),
+    'deramp3': ('Deramping (deg3)', 'Deramp', dict(degree=3)),
+    'icp': ('ICP', 'ICP', {}),
+    'biascorr': ('Bias Correction', 'BiasCorr', {}),
+}
+# Pipelines, by name: description and methods, applied in this order
+PIPELINES = {
+    'p1': ('P1 - Nuth-Kaab+Deramp (deg1)', ['nuth_kaab', 'deramp']),
+    'p2': ('P2 - ICP+Nuth-Kaab', ['icp', 'nuth_kaab']),
+    'p3': ('P3 - Bias Correction+ICP+Nuth-Kaab', ['biascorr', 'icp', 'nuth_kaab']),
+    'p4': ('P4 - Bias Correction+Nuth-Kaab', ['biascorr', 'nuth_kaab']),
+    'p5': ('P5 - Deramp (deg1)+Nuth-Kaab', ['deramp', 'nuth_kaab']),
+}
+NODATA = -9999
+
+
+# Function to get the methods a comparison runs, as name: (description, steps)
+def comparison_steps(names=None):
+    steps = dict((name, (label, [name])) for name, (label, _, _) in METHODS.items())
+    steps.update(PIPELINES)
+    if names:
+        unknown = [name for name in names if name not in steps]
+        if unknown:
+            raise ValueError("Unknown methods " + ', '.join(unknown) + ", use any of " +
+                             ', '.join(steps))
+        steps = dict((name, steps[name]) for name in names)
+    return steps
+
+
+# Function to put an array into shared memory
+# Returns the shared memory block (to be closed and unlinked by the
+# caller) and what workers need to attach to it.
+def share_array(array):
+    shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, dict(name=shm.name, shape=array.shape, dtype=array.dtype.str)
+
+
+# Worker state, set once per worker process by attach_arrays
+worker = {}
+
+
+# Function to attach a worker to the arrays in shared memory
+def attach_arrays(shared, transform, crs):
+    for key, spec in shared.items():
+        shm = shared_memory.SharedMemory(name=spec['name'])
+        # keep a reference, the array is only valid as long as the block is open
+        worker[key + '_shm'] = shm
+        worker[key] = np.ndarray(spec['shape'], dtype=np.dtype(spec['dtype']), buffer=shm.buf)
+    worker['transform'] = transform
+    worker['crs'] = crs
+
+
+# Function to get the statistics of a DEM of differences
+def ddem_statistics(ddem):
+    valid = ddem[np.isfinite(ddem)]
+    return dict(
+        nmad=float(xdem.spatialstats.nmad(valid)),
+        median=float(np.median(valid)),
+        mean=float(np.mean(valid)),
+        std=float(np.std(valid)),
+        valid_pixels=int(valid.size)
+    )
+
+
+# Function to get the key of a step: the method and its parameters
+def step_key(step):
+    _, method, parameters = METHODS[step]
+    return (method, tuple(sorted(parameters.items())))
+
+
+# Function to group methods and pipelines by their first step
+# Each group is a tree of steps, with its first step as root.
+def group_by_root(methods):
+    groups = {}
+    for name, (label, steps) in methods.items():
+        groups.setdefault(step_key(steps[0]), []).append((name, label, steps))
+    return list(groups.values())
+
+
+# Function to fit and apply the methods and pipelines of a tree in a worker
+# A pipeline fits each step on the output of the steps before it, like
+# xdem.coreg.CoregPipeline. So a step fitted after the same steps (the same
+# input state) gives the same transform: fitted steps and their output are
+# kept by the keys of the steps up to them (the prefix) and reused by all
+# methods of the tree that start with that prefix. Arrays are read from
+# shared memory, nodata is NaN.
+def run_tree(tree, out_files):
+    reference, tba = worker['reference'], worker['tba']
+    # prefix: (fitted coreg, output, fit seconds, apply seconds)
+    fitted = {(): (None, tba, 0, 0)}
+    results = []
+    for name, label, steps in sorted(tree, key=lambda method: len(method[2])):
+        keys = tuple(step_key(step) for step in steps)
+        reused = 0
+        fit_seconds = apply_seconds = 0
+        for i, step in enumerate(steps):
+            prefix = keys[:i + 1]
+            if prefix in fitted:
+                reused += 1
+                continue
+            _, method, parameters = METHODS[step]
+            coreg = getattr(xdem.coreg, method)(**parameters)
+            tba_step = fitted[keys[:i]][1]
+            start = time.time()
+            coreg.fit(reference, tba_step, inlier_mask=worker['inlier_mask'],
+                      transform=worker['transform'])
+            step_fit_seconds = time.time() - start
+            start = time.time()
+            aligned = coreg.apply(tba_step, transform=worker['transform'])
+            aligned = np.ma.filled(np.ma.masked_invalid(aligned).astype('float32'), np.nan)
+            fitted[prefix] = (coreg, aligned, step_fit_seconds, time.time() - start)
+        for i in range(len(keys)):
+            fit_seconds += fitted[keys[:i + 1]][2]
+            apply_seconds += fitted[keys[:i + 1]][3]
+        aligned = fitted[keys][1]
+        result = dict(method=name, description=label, steps='+'.join(steps))
+        result.update(ddem_statistics(reference - aligned))
+        # Times include steps reused from other methods of the tree
+        result.update(fit_seconds=round(fit_seconds, 2), apply_seconds=round(apply_seconds, 2),
+                      reused_steps=reused)
+        if out_files.get(name) is not None:
+            xdem.DEM.from_array(np.nan_to_num(aligned, nan=NODATA), transform=worker['transform'],
+                                crs=worker['crs'], nodata=NODATA).save(out_files[name])
+        results.append(result)
+    return results
+
+
+# Function to compare the methods in parallel worker processes
+def compare_methods(reference_dem, dem_to_be_aligned, inlier_mask, methods, out_dir,
+                    workers=None, save_dems=False, ref_dem_alias='dgm1m'):
+    aligned_dem_ref_name = os.path.basename(dem_to_be_aligned.filename).split(".")[0]
+    arrays = dict(
+        reference=np.ma.filled(reference_dem.data.astype('float32'), np.nan).squeeze(),
+        tba=np.ma.filled(dem_to_be_aligned.data.astype('float32'), np.nan).squeeze(),
+        inlier_mask=np.asarray(inlier_mask, dtype=bool).squeeze()
+    )
+    blocks = []
+    shared = {}
+    try:
+        for key, array in arrays.items():
+            shm, shared[key] = share_array(array)
+            blocks.append(shm)
+        before = dict(method='before', description='before', steps='')
+        before.update(ddem_statistics(arrays['reference'] - arrays['tba']))
+        results = [before]
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach_arrays,
+                                 initargs=(shared, dem_to_be_aligned.transform,
+                                           dem_to_be_aligned.crs)) as executor:
+            out_files = dict((name, os.path.join(out_dir, aligned_dem_ref_name + '_' + ref_dem_alias +
+                                                 '_coreg_' + name + '.tif') if save_dems else None)
+                             for name in methods)
+            # One worker per tree, so that its steps can be reused
+            futures = [executor.submit(run_tree, tree, out_files) for tree in group_by_root(methods)]
+            for future in futures:
+                for result in future.result():
+                    print('Error after ' + result['description'] + ': %.2f m' % result['nmad'])
+                    results.append(result)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    reference_dem = xdem.DEM(args.reference_dem)
+    dem_to_be_aligned = xdem.DEM(args.dem)
+    # Reproject reference dem to dem to be aligned
+    reference_dem = reference_dem.reproject(dem_to_be_aligned)
+
+    # Create a stable ground mask (not slided) to mark "inlier data"
+    if args.unstable_area is not None:
+        landslide = gu.Vector(args.unstable_area)
+        inlier_mask = ~landslide.create_mask(reference_dem)
+    else:
+        inlier_mask = np.ones(reference_dem.data.shape, dtype=bool)
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    results = compare_methods(reference_dem, dem_to_be_aligned, inlier_mask,
+                              comparison_steps(args.methods), args.out_dir,
+                              workers=args.workers, save_dems=args.save_dems,
+                              ref_dem_alias=args.ref_dem_alias)
+    results.to_csv(os.path.join(args.out_dir, 'coregistration_results.csv'), index=False)
+
+    errors = ['Error ' + ('before' if row['method'] == 'before' else 'after ' + row['description']) +
+              ': %.2f m' % row['nmad'] for _, row in results.iterrows()]
+    with open(os.path.join(args.out_dir, 'readme.txt'), 'w') as f:
+        f.writelines('\n'.join(errors))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+# Import modules
+import ast
+import os
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts')
+
+
+# Function to load functions and constants of a script without running it
+# The scripts parse arguments and start SNAP when they are run, so only the
+# top-level definitions with the given names are taken from the script and
+# run in a namespace with the given globals (modules, args, ...).
+def load_functions(script, names, **namespace):
+    filename = os.path.join(SCRIPTS_DIR, script)
+    with open(filename) as f:
+        tree = ast.parse(f.read(), filename)
+    body = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name in names:
+            body.append(node)
+        elif isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and target.id in names for target in node.targets):
+            body.append(node)
+    exec(compile(ast.Module(body=body, type_ignores=[]), filename, 'exec'), namespace)
+    missing = [name for name in names if name not in namespace]
+    if missing:
+        raise ValueError("Not found in " + script + ": " + ', '.join(missing))
+    return namespace
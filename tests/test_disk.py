@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# Import modules
+import pytest
+
+from helpers import load_functions
+
+
+# Clock that only moves when slept on
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+# Function to load wait_for_disk with a volume freeing up over time
+def disk_functions(clock, free):
+    return load_functions('2_dem_generation.py', ['DISK_POLL_SECONDS', 'wait_for_disk'],
+                          time=clock, free_disk=lambda path: free(clock.now))
+
+
+def test_wait_for_disk_waits_until_space_is_free():
+    clock = Clock()
+    functions = disk_functions(clock, lambda now: 5.0 if now < 150 else 50.0)
+    functions['wait_for_disk']('results', 20.0)
+    assert clock.now == 3 * functions['DISK_POLL_SECONDS']
+
+
+def test_wait_for_disk_times_out():
+    clock = Clock()
+    functions = disk_functions(clock, lambda now: 5.0)
+    with pytest.raises(ValueError):
+        functions['wait_for_disk']('results', 20.0, timeout=90)
+    assert clock.now == 90
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# Import modules
+import glob
+import os
+import re
+import shutil
+import subprocess
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+from helpers import load_functions
+
+SCENE = 'S1A_IW_SLC__1SDV_20210127T052305_20210127T052332_036306_04428C_6B2F.zip'
+# Values Apply-Orbit-File accepts for Sentinel-1 scenes
+SENTINEL_ORBIT_TYPES = ['Sentinel Precise (Auto Download)', 'Sentinel Restituted (Auto Download)']
+
+
+# Function to load find_orbit_file for an orbit store
+def orbit_functions(orbit_dir, offline=False):
+    args = SimpleNamespace(orbit_dir=str(orbit_dir), orbit_offline=offline)
+    return load_functions('2_dem_generation.py', ['ORBIT_TYPES', 'find_orbit_file'],
+                          args=args, glob=glob, os=os, pd=pd)
+
+
+# Function to add an orbit file to an orbit store
+def add_orbit_file(orbit_dir, folder, validity):
+    month_dir = orbit_dir / folder / 'S1A' / '2021' / '01'
+    month_dir.mkdir(parents=True, exist_ok=True)
+    orbit_file = month_dir / ('S1A_OPER_AUX_' + folder + '_OPOD_20210216T121602_V' + validity + '.EOF.zip')
+    orbit_file.write_bytes(b'')
+    return str(orbit_file)
+
+
+def test_precise_orbit_found(tmp_path):
+    orbit_file = add_orbit_file(tmp_path, 'POEORB', '20210126T225942_20210128T005942')
+    add_orbit_file(tmp_path, 'RESORB', '20210127T040000_20210127T070000')
+    orbit_type, found = orbit_functions(tmp_path)['find_orbit_file'](SCENE)
+    assert orbit_type == 'Sentinel Precise (Auto Download)'
+    assert orbit_type in SENTINEL_ORBIT_TYPES
+    assert found == orbit_file
+
+
+def test_restituted_orbit_found(tmp_path):
+    orbit_file = add_orbit_file(tmp_path, 'RESORB', '20210127T040000_20210127T070000')
+    orbit_type, found = orbit_functions(tmp_path)['find_orbit_file'](SCENE)
+    assert orbit_type == 'Sentinel Restituted (Auto Download)'
+    assert orbit_type in SENTINEL_ORBIT_TYPES
+    assert found == orbit_file
+
+
+def test_no_orbit_found(tmp_path):
+    orbit_type, found = orbit_functions(tmp_path)['find_orbit_file'](SCENE)
+    assert orbit_type in SENTINEL_ORBIT_TYPES
+    assert found is None
+    with pytest.raises(ValueError):
+        orbit_functions(tmp_path, offline=True)['find_orbit_file'](SCENE)
+
+
+@pytest.mark.skipif(shutil.which('gpt') is None, reason='SNAP gpt not installed')
+def test_orbit_types_accepted_by_snap(tmp_path):
+    help_text = subprocess.run(['gpt', 'Apply-Orbit-File', '-h'], stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, universal_newlines=True).stdout
+    # Long lines are wrapped in the help
+    help_text = ' '.join(help_text.split())
+    value_set = re.search(r'-PorbitType=<string> .*?Value must be one of (.*?)\. Default value', help_text)
+    assert value_set is not None
+    allowed = [value.strip().strip("'") for value in value_set.group(1).split("',")]
+    for orbit_type in orbit_functions(tmp_path)['ORBIT_TYPES'].values():
+        assert orbit_type in allowed
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+# Import modules
+import math
+import os
+
+from helpers import load_functions
+
+SNAPHU = load_functions(
+    '2_dem_generation.py',
+    ['SNAPHU_TILE_PIXELS', 'SNAPHU_BYTES_PER_PIXEL', 'SNAPHU_MIN_OVERLAP',
+     'SNAPHU_MAX_TILES', 'plan_snaphu_tiles', 'snaphu_command'],
+    math=math, os=os, available_memory=lambda: 64 * 1024 ** 3
+)
+
+
+def test_explicit_overlap_is_whole_pixels():
+    plan = SNAPHU['plan_snaphu_tiles'](10000, 8000, tiles=3, tile_overlap_row=200.0,
+                                       tile_overlap_col=150.0, nproc=2)
+    assert plan['tile_overlap_row'] == 200
+    assert plan['tile_overlap_col'] == 150
+    assert isinstance(plan['tile_overlap_row'], int)
+    assert isinstance(plan['tile_overlap_col'], int)
+
+
+def test_snaphu_command_with_explicit_overlap():
+    plan = SNAPHU['plan_snaphu_tiles'](10000, 8000, tiles=3, tile_overlap_row=200.0,
+                                       tile_overlap_col=150.0, nproc=2)
+    command = SNAPHU['snaphu_command']('Phase_ifg.snaphu.img', '10000',
+                                       'UnwPhase_ifg.snaphu.img', plan, 'snaphu_tiles')
+    assert command[:5] == ['snaphu', '-f', 'snaphu.conf', 'Phase_ifg.snaphu.img', '10000']
+    assert 'ROWOVRLP 200' in command
+    assert 'COLOVRLP 150' in command
+    assert 'NTILEROW 3' in command and 'NTILECOL 3' in command
+    assert 'NPROC 2' in command
+
+
+def test_single_tile_has_no_overlap():
+    plan = SNAPHU['plan_snaphu_tiles'](500, 400)
+    assert plan['tiles'] == 1
+    assert plan['tile_overlap_row'] == 0 and plan['tile_overlap_col'] == 0
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# Import modules
+import os
+import re
+
+import pandas as pd
+
+from helpers import load_functions
+
+# Stack of three dates as written by Back-Geocoding (master 27Jan2021)
+SCENES = {
+    '20210115': 'S1A_IW_SLC__1SDV_20210115T052306_20210115T052333_036131_043C7A_1F0C',
+    '20210127': 'S1A_IW_SLC__1SDV_20210127T052305_20210127T052332_036306_04428C_6B2F',
+    '20210208': 'S1A_IW_SLC__1SDV_20210208T052305_20210208T052332_036481_04488F_0C4E',
+}
+BANDS = [
+    'i_IW1_VV_mst_27Jan2021', 'q_IW1_VV_mst_27Jan2021', 'Intensity_IW1_VV_mst_27Jan2021',
+    'i_IW1_VV_slv1_15Jan2021', 'q_IW1_VV_slv1_15Jan2021', 'Intensity_IW1_VV_slv1_15Jan2021',
+    'i_IW1_VV_slv2_08Feb2021', 'q_IW1_VV_slv2_08Feb2021', 'Intensity_IW1_VV_slv2_08Feb2021',
+]
+
+
+# Metadata element with attributes, as SNAP's MetadataElement
+class Element:
+    def __init__(self, name, attributes=None, elements=None):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.elements = list(elements or [])
+
+    def getName(self):
+        return self.name
+
+    def getElement(self, name):
+        return [element for element in self.elements if element.name == name][0]
+
+    def getElements(self):
+        return list(self.elements)
+
+    def removeElement(self, element):
+        self.elements.remove(element)
+
+    def setAttributeString(self, name, value):
+        self.attributes[name] = value
+
+
+# Band of a product, as SNAP's Band
+class Band:
+    def __init__(self, name):
+        self.name = name
+
+    def setName(self, name):
+        self.name = name
+
+
+# Product with bands and metadata, as SNAP's Product
+class Product:
+    def __init__(self, band_names, metadata_root):
+        self.bands = [Band(name) for name in band_names]
+        self.metadata_root = metadata_root
+
+    def getBandNames(self):
+        return [band.name for band in self.bands]
+
+    def getBand(self, name):
+        return [band for band in self.bands if band.name == name][0]
+
+    def getMetadataRoot(self):
+        return self.metadata_root
+
+
+# Function to build the product read from out_stack_IW1.dim
+def stack_product():
+    slaves = [
+        Element(SCENES['20210115'] + '_15Jan2021',
+                {'Slave_bands': 'i_IW1_VV_slv1_15Jan2021 q_IW1_VV_slv1_15Jan2021 '
+                                'Intensity_IW1_VV_slv1_15Jan2021'}),
+        Element(SCENES['20210208'] + '_08Feb2021',
+                {'Slave_bands': 'i_IW1_VV_slv2_08Feb2021 q_IW1_VV_slv2_08Feb2021 '
+                                'Intensity_IW1_VV_slv2_08Feb2021'}),
+    ]
+    slave_root = Element('Slave_Metadata', {
+        'Master_bands': 'i_IW1_VV_mst_27Jan2021 q_IW1_VV_mst_27Jan2021 '
+                        'Intensity_IW1_VV_mst_27Jan2021'
+    }, slaves)
+    root = Element('metadata', elements=[Element('Abstracted_Metadata'), slave_root])
+    return Product(BANDS, root)
+
+
+# Function to load stack_pair, reading the stack product above
+def stack_functions():
+    def band_select(product, bands):
+        names = bands.split(',')
+        return Product([name for name in product.getBandNames() if name in names],
+                       product.getMetadataRoot())
+    return load_functions('2_dem_generation.py', ['stack_pair_bands', 'stack_pair'],
+                          os=os, re=re, pd=pd, read=lambda filename: stack_product(),
+                          band_select=band_select)
+
+
+def test_stack_pair_bands():
+    master_bands, slave_bands = stack_functions()['stack_pair_bands'](
+        BANDS, '20210127', '20210208')
+    assert master_bands == ['i_IW1_VV_mst_27Jan2021', 'q_IW1_VV_mst_27Jan2021']
+    assert slave_bands == {'i_IW1_VV_slv2_08Feb2021': 'i_IW1_VV_slv1_08Feb2021',
+                           'q_IW1_VV_slv2_08Feb2021': 'q_IW1_VV_slv1_08Feb2021'}
+
+
+def test_stack_pair_renames_bands_and_prunes_metadata():
+    stack = dict(directory='stack_ASCENDING_117_VV', master='20210127', scenes=SCENES)
+    pair = stack_functions()['stack_pair'](stack, 'IW1', SCENES['20210208'] + '.zip',
+                                           SCENES['20210127'] + '.zip')
+    assert sorted(pair.getBandNames()) == ['i_IW1_VV_mst_27Jan2021', 'i_IW1_VV_slv1_08Feb2021',
+                                           'q_IW1_VV_mst_27Jan2021', 'q_IW1_VV_slv1_08Feb2021']
+    slave_root = pair.getMetadataRoot().getElement('Slave_Metadata')
+    assert slave_root.attributes['Master_bands'] == 'i_IW1_VV_mst_27Jan2021 q_IW1_VV_mst_27Jan2021'
+    assert [element.getName() for element in slave_root.getElements()] == [
+        SCENES['20210208'] + '_08Feb2021']
+    assert slave_root.getElements()[0].attributes['Slave_bands'] == \
+        'i_IW1_VV_slv1_08Feb2021 q_IW1_VV_slv1_08Feb2021'